@@ -0,0 +1,169 @@
+'''
+Compact adjacency format for precinct/VTD neighbor graphs.
+
+Neighbors are stored in compressed sparse row (CSR) form: the neighbors of
+the precinct in row i are indices[indptr[i]:indptr[i+1]], where every entry
+is a row position in the state GeoDataFrame. This replaces the
+literal_eval'd neighbors csv files, which store GEOID20 strings.
+'''
+import numpy as np
+
+
+def pairs_to_csr(n, left, right):
+    '''
+    Builds CSR arrays out of a list of neighboring pairs.
+
+    Inputs:
+        -n (int): number of precincts/VTDs in the state
+        -left, right (NumPy int arrays): row positions of each neighboring
+        pair, with both directions of each pair included. Must be sorted by
+        left (as returned by load_state_data.find_neighbor_pairs)
+
+    Returns (tuple of NumPy int32 arrays): indptr, indices
+    '''
+    indptr = np.searchsorted(left, np.arange(n + 1)).astype(np.int32)
+    indices = np.asarray(right, dtype=np.int32)
+    return indptr, indices
+
+
+def neighbors_to_csr(geoids, neighbors):
+    '''
+    Converts an adjacency list of GEOID20 strings (the 'neighbors' column
+    of a state GeoDataFrame) to CSR arrays of row positions.
+
+    Inputs:
+        -geoids (array-like of str): GEOID20 of each row, in row order
+        -neighbors (array-like of arrays of str): neighboring GEOID20s of
+        each row, in row order
+
+    Returns (tuple of NumPy int32 arrays): indptr, indices
+    '''
+    row_of = {geoid: i for i, geoid in enumerate(geoids)}
+    lengths = np.fromiter((len(nabes) for nabes in neighbors), dtype=np.int32,
+                          count=len(neighbors))
+    indptr = np.zeros(len(neighbors) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.fromiter((row_of[nabe] for nabes in neighbors for nabe in nabes),
+                          dtype=np.int32, count=indptr[-1])
+    return indptr, indices
+
+
+def csr_to_neighbors(geoids, indptr, indices):
+    '''
+    Converts CSR arrays back to an adjacency list of GEOID20 strings, as
+    used by the 'neighbors' column of a state GeoDataFrame.
+
+    Inputs:
+        -geoids (NumPy array of str): GEOID20 of each row, in row order
+        -indptr, indices (NumPy int arrays): CSR adjacency
+
+    Returns (list of NumPy arrays): neighboring GEOID20s of each row
+    '''
+    return np.split(np.asarray(geoids, dtype=object)[indices], indptr[1:-1])
+
+
+def save_adjacency(filepath, geoids, indptr, indices, edge_length=None,
+                   exterior_perimeter=None, area=None):
+    '''
+    Writes CSR adjacency to an uncompressed .npz file. The GEOID20s are
+    saved alongside so the file can be checked against the shapefile rows
+    when it is loaded.
+
+    Inputs:
+        -filepath (str): where to save the file (should end in .npz)
+        -geoids (array-like of str): GEOID20 of each row, in row order
+        -indptr, indices (NumPy int arrays): CSR adjacency
+        -edge_length (NumPy float array): if given, length of the boundary
+        shared by each neighboring pair, lined up with indices
+        -exterior_perimeter (NumPy float array): if given, length of each
+        precinct's boundary that isn't shared with any neighbor (i.e. lies
+        on the state line), by row
+        -area (NumPy float array): if given, area of each precinct, by row
+
+    Returns: None, writes file
+    '''
+    arrays = {'geoids': np.asarray(geoids, dtype=str),
+              'indptr': np.asarray(indptr, dtype=np.int32),
+              'indices': np.asarray(indices, dtype=np.int32)}
+    if edge_length is not None:
+        arrays['edge_length'] = np.asarray(edge_length, dtype=np.float64)
+        arrays['exterior_perimeter'] = np.asarray(exterior_perimeter, dtype=np.float64)
+    if area is not None:
+        arrays['area'] = np.asarray(area, dtype=np.float64)
+    np.savez(filepath, **arrays)
+
+
+def load_adjacency(filepath, geoids=None):
+    '''
+    Reads CSR adjacency saved by save_adjacency.
+
+    Inputs:
+        -filepath (str): location of the .npz file
+        -geoids (array-like of str): if given, GEOID20 of each row of the
+        GeoDataFrame the adjacency will be used with. Raises a ValueError if
+        the saved rows don't match.
+
+    Returns (tuple of NumPy int32 arrays): indptr, indices
+    '''
+    with np.load(filepath) as saved:
+        if geoids is not None and not np.array_equal(saved['geoids'],
+                                                     np.asarray(geoids, dtype=str)):
+            raise ValueError(f"Adjacency in {filepath} doesn't match the rows of this state's data")
+        return saved['indptr'], saved['indices']
+
+
+def load_edge_lengths(filepath):
+    '''
+    Reads the shared boundary lengths saved by save_adjacency, if the file
+    has them.
+
+    Inputs:
+        -filepath (str): location of the .npz file
+
+    Returns (tuple of NumPy float arrays): edge_length (lined up with the
+    CSR indices) and exterior_perimeter (by row), or None if the file was
+    saved without them
+    '''
+    with np.load(filepath) as saved:
+        if 'edge_length' not in saved.files:
+            return None
+        return saved['edge_length'], saved['exterior_perimeter']
+
+
+def load_precinct_areas(filepath):
+    '''
+    Reads the precinct areas saved by save_adjacency, if the file has them.
+
+    Inputs:
+        -filepath (str): location of the .npz file
+
+    Returns (NumPy float array): area of each precinct, by row, or None if
+    the file was saved without them
+    '''
+    with np.load(filepath) as saved:
+        if 'area' not in saved.files:
+            return None
+        return saved['area']
+
+
+def reverse_edges(indptr, indices):
+    '''
+    Finds, for every entry of a CSR adjacency, the entry for the same pair
+    in the other direction (the entry for j -> i, given i -> j).
+
+    Inputs:
+        -indptr, indices (NumPy int arrays): CSR adjacency, with both
+        directions of every pair included
+
+    Returns (NumPy int64 array): position in indices of each entry's
+    reverse, or -1 where the reverse entry is missing
+    '''
+    n = len(indptr) - 1
+    src = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr))
+    dst = np.asarray(indices, dtype=np.int64)
+    keys = src * n + dst
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    wanted = dst * n + src
+    found = np.minimum(np.searchsorted(sorted_keys, wanted), len(keys) - 1)
+    return np.where(sorted_keys[found] == wanted, order[found], -1)
@@ -1,7 +1,9 @@
 #This file, and organization of project into package, by: Matt Jackson
 
 from load_state_data import load_state 
-from draw_random_maps import draw_dart_throw_map, repeated_pop_swap, population_deviation, district_pops, target_dist_pop, dissolve_map, plot_dissolved_map
+from draw_random_maps import draw_dart_throw_map, repeated_pop_swap, population_deviation, district_pops, target_dist_pop, dissolve_map
+from priority_swap import priority_pop_swap
+from map_plot import plot_cut_edge_map
 from regression import predict_state_voteshare
 from collections import OrderedDict
 import time
@@ -45,7 +47,8 @@ def run(state_input=None):
     print(f"You typed: {state_input} (for {state_fullname})")
 
     print(f"Importing {state_input} 2020 Redistricting Data Hub data...")
-    df = load_state(state_input)
+    #polygons are only read if the map gets plotted
+    df = load_state(state_input, geometry=False)
 
     user_seed = ''
     while not type(user_seed) == int:
@@ -78,7 +81,7 @@ def run(state_input=None):
     print("(Note: In real life, a state's U.S. Congressional districts must be as close\nto equal as possible in population.)")
 
     print("Do you want to try to swap precincts between districts to balance their population?\nIf so, type 'yes'.")
-    swap_choice = input("WARNING: This swap process can take several minutes, and might not reach\nthe threshold you want:\n")
+    swap_choice = input("WARNING: This swap process can take a while for large states, and might not reach\nthe threshold you want:\n")
     YES = {'yes', 'Yes', 'YES', True, 1}
     if swap_choice not in YES:
         print("Okay, we'll leave these districts as is.")
@@ -93,12 +96,12 @@ def run(state_input=None):
             user_allowed_deviation = int(user_allowed_deviation)
         #Let user continue swapping process if they so choose
         while swap_choice in YES:
-            user_steps = input(f"How many times do you want to iterate the swapping process? Each iteration can take 60-90 seconds: ")
+            user_steps = input(f"How many times do you want to iterate the swapping process? Each iteration takes a few seconds: ")
             if not user_steps.isdigit():
                 print("That's not a valid integer, so let's go with 5.")
                 user_steps = 5
-            repeated_pop_swap(df, allowed_deviation=user_allowed_deviation, 
-                            plot_each_step=False, stop_after=int(user_steps))
+            priority_pop_swap(df, allowed_deviation=user_allowed_deviation, 
+                              plot_each_step=False, stop_after=int(user_steps))
             deviation = population_deviation(df)
             if deviation <= user_allowed_deviation:
                 break
@@ -116,8 +119,8 @@ def run(state_input=None):
 
     time.sleep(1)
 
-    print("Let's get the by-district results for your map. This may take a few seconds...")
-    df_dists = dissolve_map(df)
+    print("Let's get the by-district results for your map.")
+    df_dists = dissolve_map(df, geometry=False)
     print("Here are the 2020 presidential election vote margins in each district you drew:")
     print("positive point_swing: Democratic win; negative: Republican win")
     print(df_dists[['POP100', 'point_swing']])
@@ -131,7 +134,7 @@ def run(state_input=None):
     if not ntrials.isdigit():
         ntrials = 50
         print("Setting ntrials to 50 - input was not numeric")
-    prediction = predict_state_voteshare(state_input, int(ntrials))
+    prediction = predict_state_voteshare(state_input, int(ntrials), gdf=df)
     
     d_dists_on_map = 0
     r_dists_on_map = 0
@@ -154,7 +157,7 @@ def run(state_input=None):
     if plot_choice not in YES:
         print("Okay. Though you really should pick 'yes' next time to see the map plotting feature!")
     else:
-        fp = plot_dissolved_map(df_dists, state_input)
+        fp = plot_cut_edge_map(df, state_input)
         print(f"Map saved to filepath \"/{fp}\". Go open that file to look at your map!")
 
     print("Goodbye for now!")
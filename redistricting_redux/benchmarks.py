@@ -0,0 +1,403 @@
+'''
+Benchmarks for the slow stages of the pipeline, so that speedups (and
+slowdowns) can be measured on real state data and on synthetic grids.
+
+Each stage is run on each input and timed, its peak memory use is measured
+with tracemalloc (in a separate run, since tracing slows Python code down),
+and a few counts of the work it did are recorded. Results are written to a
+JSON file and compared against a stored baseline from an earlier run.
+
+Run from the repository root, e.g.:
+    python redistricting_redux/benchmarks.py GA TX
+    python redistricting_redux/benchmarks.py --grid 50x50 100x100 --stages dart_throw pop_swap
+    python redistricting_redux/benchmarks.py NV --save-baseline
+'''
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import contextlib
+import subprocess
+import tracemalloc
+import numpy as np
+import shapely
+import geopandas as gpd
+from datetime import datetime
+from load_state_data import (load_state, compute_precinct_neighbors, find_neighbor_pairs,
+                             find_neighbor_pairs_tiled, affix_neighbor_indices)
+from adjacency import pairs_to_csr, csr_to_neighbors
+from stats import target_dist_pop
+from draw_random_maps import (draw_dart_throw_map, clear_dist_ids, mapwide_pop_swap,
+                              recapture_orphan_precincts, dissolve_map, population_deviation)
+from ethan_balance import batch_balance_transfer
+from bfs_seed import draw_bfs_seed_map
+from multilevel import draw_multilevel_map
+from fm_refine import fm_pop_swap
+from checkpoint import df_assignment, restore_df_assignment
+from instrument import instrumented
+
+#number of districts in each bundled state, as in app.SUPPORTED_STATES (not
+#imported from there, since app also loads the regression model)
+STATE_DISTRICTS = {'AZ': 9, 'GA': 14, 'NV': 4, 'NC': 14, 'OH': 15, 'TX': 38}
+
+RESULTS_FILE = 'redistricting_redux/benchmark_results.json'
+BASELINE_FILE = 'redistricting_redux/benchmark_baseline.json'
+
+
+def benchmark_neighbors(state_postal, run_brute=True, workers=None):
+    '''
+    Times the spatial index neighbor builder against the original brute-force
+    touches/overlaps scan on one state, and checks that both give exactly the
+    same adjacency. Also times the tiled builder on a pool of workers, and
+    checks its pairs are identical to the serial builder's.
+
+    Inputs:
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+        -run_brute (boolean): if False, skip the (very slow) brute-force scan
+        -workers (int): worker processes for the tiled builder. Defaults to
+        the number of CPUs
+
+    Returns (dict): timings in seconds and whether the adjacencies match
+    '''
+    df = load_state(state_postal, affix_neighbors=False)
+    results = {'state': state_postal, 'precincts': len(df)}
+
+    start = time.perf_counter()
+    fast = compute_precinct_neighbors(df, method='strtree')
+    results['strtree_seconds'] = time.perf_counter() - start
+    print(f"{state_postal}: spatial index neighbors took {results['strtree_seconds']:.2f} s")
+
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    serial = find_neighbor_pairs(df.geometry)
+    results['serial_pairs_seconds'] = time.perf_counter() - start
+    start = time.perf_counter()
+    tiled = find_neighbor_pairs_tiled(df.geometry, workers)
+    results['tiled_pairs_seconds'] = time.perf_counter() - start
+    results['tiled_workers'] = workers
+    results['tiled_identical'] = all(np.array_equal(a, b) for a, b in zip(serial, tiled))
+    print(f"{state_postal}: tiled neighbor pairs on {workers} workers took "
+          f"{results['tiled_pairs_seconds']:.2f} s (serial: {results['serial_pairs_seconds']:.2f} s, "
+          f"identical: {results['tiled_identical']})")
+
+    if run_brute:
+        start = time.perf_counter()
+        slow = compute_precinct_neighbors(df, method='brute')
+        results['brute_seconds'] = time.perf_counter() - start
+        results['identical'] = all(set(a) == set(b) for a, b in zip(fast, slow))
+        print(f"{state_postal}: brute-force neighbors took {results['brute_seconds']:.2f} s")
+        print(f"{state_postal}: adjacency identical: {results['identical']}")
+
+    return results
+
+
+def synthetic_state(rows, cols, seed=2023):
+    '''
+    Builds a fake state of square precincts on a grid, with random
+    populations and votes, shaped like the data load_state returns (GEOID20,
+    POP100, G20PREDBID, G20PRERTRU, neighbors, neighbor_idx, dist_id).
+
+    Inputs:
+        -rows, cols (int): size of the grid
+        -seed (int): seed for random number generation
+
+    Returns (geopandas GeoDataFrame)
+    '''
+    rng = np.random.default_rng(seed)
+    n = rows * cols
+    x, y = np.meshgrid(np.arange(cols), np.arange(rows))
+    x, y = x.ravel(), y.ravel()
+    pop = rng.integers(200, 2000, n)
+    turnout = (pop * rng.uniform(0.4, 0.7, n)).round()
+    dem_share = rng.beta(4, 4, n)
+    df = gpd.GeoDataFrame({'GEOID20': [f"{i:011d}" for i in range(n)],
+                           'POP100': pop,
+                           'G20PREDBID': (turnout * dem_share).round(),
+                           'G20PRERTRU': (turnout * (1 - dem_share)).round()},
+                          geometry=shapely.box(x, y, x + 1, y + 1))
+
+    left, right = find_neighbor_pairs(df.geometry)
+    indptr, indices = pairs_to_csr(n, left, right)
+    df['neighbors'] = csr_to_neighbors(df['GEOID20'], indptr, indices)
+    affix_neighbor_indices(df, indptr, indices)
+    df['dist_id'] = None
+    return df
+
+
+def load_input(name, num_districts=None, seed=2023):
+    '''
+    Loads a benchmark input and draws the starting map the balancing and
+    dissolving stages run on.
+
+    Inputs:
+        -name (str): a state postal code (e.g. "GA"), or a grid size like
+        "50x50" for synthetic_state
+        -num_districts (int): number of districts. Defaults to the state's
+        real number, or 10 for grids.
+        -seed (int): seed for the starting map (and the grid)
+
+    Returns (dict): the benchmark context: 'name', 'df', 'num_districts',
+    'seed', 'allowed_deviation' (as app.run recommends), and 'start_map'
+    (assignment from draw_dart_throw_map)
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        if 'x' in name:
+            rows, cols = (int(side) for side in name.lower().split('x'))
+            df = synthetic_state(rows, cols, seed)
+            num_districts = num_districts or 10
+        else:
+            df = load_state(name)
+            num_districts = num_districts or STATE_DISTRICTS[name]
+        draw_dart_throw_map(df, num_districts, seed=seed)
+
+    return {'name': name, 'df': df, 'num_districts': num_districts, 'seed': seed,
+            'allowed_deviation': target_dist_pop(df, num_districts) // 10,
+            'start_map': df_assignment(df)}
+
+
+def moved_since(df, before):
+    '''
+    Number of precincts whose dist_id differs from an earlier assignment.
+    '''
+    return int((df_assignment(df) != before).sum())
+
+
+def run_neighbors(bench):
+    #set_precinct_neighbors minus writing the adjacency file, so that the
+    #state's saved adjacency isn't touched
+    neighbors = compute_precinct_neighbors(bench['df'])
+    return {'neighbor_pairs': sum(len(nabes) for nabes in neighbors) // 2}
+
+
+def run_dart_throw(bench):
+    clear_dist_ids(bench['df'])
+    draw_dart_throw_map(bench['df'], bench['num_districts'], seed=bench['seed'])
+    return {'precincts_assigned': int((df_assignment(bench['df']) > 0).sum())}
+
+
+def run_bfs_seed(bench):
+    draw_bfs_seed_map(bench['df'], bench['num_districts'], seed=bench['seed'])
+    return {'precincts_assigned': int((df_assignment(bench['df']) > 0).sum())}
+
+
+def run_multilevel(bench):
+    draw_multilevel_map(bench['df'], bench['num_districts'], bench['allowed_deviation'],
+                        seed=bench['seed'])
+    return {'deviation': int(population_deviation(bench['df']))}
+
+
+def run_pop_swap(bench):
+    mapwide_pop_swap(bench['df'], bench['allowed_deviation'])
+    return {'precincts_moved': moved_since(bench['df'], bench['start_map'])}
+
+
+def run_fm_balance(bench):
+    fm_pop_swap(bench['df'], bench['allowed_deviation'])
+    return {'precincts_moved': moved_since(bench['df'], bench['start_map'])}
+
+
+def run_recapture(bench):
+    recapture_orphan_precincts(bench['df'])
+    return {'precincts_moved': moved_since(bench['df'], bench['start_map'])}
+
+
+def run_batch_balance(bench):
+    run_dict = {}
+    batch_balance_transfer(bench['df'], run=0, run_dict=run_dict,
+                           allowed_deviation=bench['allowed_deviation'],
+                           stop_after=bench['balance_iterations'])
+    return {'iterations': len(run_dict),
+            'precincts_moved': moved_since(bench['df'], bench['start_map'])}
+
+
+def run_dissolve(bench):
+    return {'districts': len(dissolve_map(bench['df']))}
+
+
+def run_district_totals(bench):
+    return {'districts': len(dissolve_map(bench['df'], geometry=False))}
+
+
+#name -> function running the stage on a benchmark context. Every stage
+#starts from the context's start_map.
+STAGES = {'neighbors': run_neighbors,
+          'dart_throw': run_dart_throw,
+          'bfs_seed': run_bfs_seed,
+          'multilevel': run_multilevel,
+          'pop_swap': run_pop_swap,
+          'fm_balance': run_fm_balance,
+          'recapture': run_recapture,
+          'batch_balance': run_batch_balance,
+          'dissolve': run_dissolve,
+          'district_totals': run_district_totals}
+
+
+def benchmark_stage(bench, stage, repeat=1, memory=True):
+    '''
+    Runs one stage on one input: repeat timed runs (the fastest is kept),
+    then one run under tracemalloc for peak memory. Stages run with a silent
+    Instrument, whose counters (e.g. expand_rounds, swap_cycles) are added to
+    the stage's counts.
+
+    Inputs:
+        -bench (dict): benchmark context from load_input
+        -stage (str): key of STAGES
+        -repeat (int): number of timed runs
+        -memory (boolean): if False, skip the memory run
+
+    Returns (dict): input, stage, seconds, peak_mb (None if skipped), and
+    the stage's counts
+    '''
+    run = STAGES[stage]
+    times = []
+    for _ in range(repeat):
+        restore_df_assignment(bench['df'], bench['start_map'])
+        with instrumented('silent') as inst, contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            counts = run(bench)
+            times.append(time.perf_counter() - start)
+        counts = {**inst.counters, **counts}
+
+    peak_mb = None
+    if memory:
+        restore_df_assignment(bench['df'], bench['start_map'])
+        with instrumented('silent'), contextlib.redirect_stdout(io.StringIO()):
+            tracemalloc.start()
+            run(bench)
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+
+    return {'input': bench['name'], 'precincts': len(bench['df']), 'stage': stage,
+            'seconds': min(times), 'peak_mb': peak_mb, 'counts': counts}
+
+
+def run_benchmarks(inputs, stages=None, repeat=1, memory=True, num_districts=None,
+                   balance_iterations=5, seed=2023):
+    '''
+    Runs every stage on every input.
+
+    Inputs:
+        -inputs (list of str): state postal codes and/or grid sizes (see
+        load_input)
+        -stages (list of str): keys of STAGES. Defaults to all.
+        -repeat, memory: as in benchmark_stage
+        -num_districts (int): as in load_input
+        -balance_iterations (int): transfers batch_balance_transfer is
+        stopped after
+        -seed (int): seed for the starting maps and grids
+
+    Returns (dict): 'meta' (when and where the benchmarks ran) and 'results'
+    (list of dicts from benchmark_stage)
+    '''
+    stages = stages or list(STAGES)
+    results = []
+    for name in inputs:
+        print(f"Loading {name}...")
+        bench = load_input(name, num_districts, seed)
+        bench['balance_iterations'] = balance_iterations
+        for stage in stages:
+            result = benchmark_stage(bench, stage, repeat, memory)
+            peak = f"{result['peak_mb']:.1f} MB" if memory else "-"
+            print(f"{name:>9} {stage:<16} {result['seconds']:9.3f} s {peak:>10}  {result['counts']}")
+            results.append(result)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    meta = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.platform(), 'repeat': repeat,
+            'balance_iterations': balance_iterations, 'seed': seed}
+    return {'meta': meta, 'results': results}
+
+
+def compare_to_baseline(report, baseline, tolerance=0.25, min_seconds=0.05):
+    '''
+    Compares benchmark results to a baseline and prints each stage's change.
+
+    Inputs:
+        -report (dict): from run_benchmarks
+        -baseline (dict): an earlier report
+        -tolerance (float): how much slower than baseline (as a fraction)
+        a stage can be before it counts as a regression
+        -min_seconds (float): slowdowns smaller than this many seconds are
+        ignored as noise
+
+    Returns (list of dicts): the results that regressed
+    '''
+    before = {(result['input'], result['stage']): result for result in baseline['results']}
+    regressions = []
+    print(f"\nCompared to baseline from {baseline['meta']['timestamp']} "
+          f"(commit {baseline['meta']['commit']}):")
+    for result in report['results']:
+        old = before.get((result['input'], result['stage']))
+        if old is None:
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] > 0 else float('inf')
+        regressed = (ratio > 1 + tolerance and
+                     result['seconds'] - old['seconds'] > min_seconds)
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{result['input']:>9} {result['stage']:<16} {old['seconds']:9.3f} s -> "
+              f"{result['seconds']:9.3f} s ({ratio:5.2f}x){flag}")
+        if regressed:
+            regressions.append(result)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the map drawing and balancing stages.")
+    parser.add_argument('states', nargs='*', help="state postal codes (default: all bundled states)")
+    parser.add_argument('--grid', nargs='*', default=[], help="synthetic grid sizes, e.g. 50x50")
+    parser.add_argument('--stages', nargs='*', choices=list(STAGES), help="stages to run (default: all)")
+    parser.add_argument('--districts', type=int, help="number of districts (default: state's real number, 10 for grids)")
+    parser.add_argument('--repeat', type=int, default=1, help="timed runs per stage; the fastest is kept")
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc runs")
+    parser.add_argument('--balance-iterations', type=int, default=5,
+                        help="transfers batch_balance_transfer is stopped after")
+    parser.add_argument('--seed', type=int, default=2023)
+    parser.add_argument('--output', default=RESULTS_FILE, help="where to write results")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="results to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="also save results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="fraction slower than baseline that counts as a regression")
+    parser.add_argument('--brute', action='store_true',
+                        help="instead, compare the spatial index neighbor builder with the brute-force one")
+    parser.add_argument('--workers', type=int,
+                        help="worker processes for the tiled neighbor builder in --brute mode (default: all CPUs)")
+    args = parser.parse_args(argv)
+
+    states = [state.upper() for state in args.states]
+    if args.brute:
+        for state in states or ['GA', 'TX']:
+            benchmark_neighbors(state, workers=args.workers)
+        return 0
+    if not states and not args.grid:
+        states = list(STATE_DISTRICTS)
+
+    report = run_benchmarks(states + args.grid, args.stages, args.repeat, not args.no_memory,
+                            args.districts, args.balance_iterations, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {args.output}")
+
+    regressions = []
+    try:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+    except FileNotFoundError:
+        print(f"No baseline at {args.baseline} to compare against")
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Saved as baseline: {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
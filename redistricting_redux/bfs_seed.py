@@ -0,0 +1,177 @@
+'''
+Drawing a starting map by growing every district at once, as a
+multi-source breadth-first search on the precinct adjacency matrix.
+
+draw_dart_throw_map grows one district at a time, one precinct at a time.
+Here each round is a handful of array operations for the whole state: the
+sparse adjacency matrix times a sparse district indicator matrix counts, for
+every unassigned precinct, how many neighbors it has in each district. Each
+frontier precinct goes to the district it borders most (ties broken at
+random), and each district takes its new precincts in random order only
+while a cumulative sum of their populations keeps it at or under the target
+population. A whole state takes about as many rounds as districts are wide.
+
+Like draw_dart_throw_map, the result needs balancing afterwards (e.g. with
+priority_pop_swap).
+'''
+import random
+import numpy as np
+from scipy import sparse
+from partition import as_partition, sync_partition
+from draw_random_maps import fill_district_holes
+from instrument import get_instrument, timed
+
+
+def throw_darts(part, num_districts, rng):
+    '''
+    Picks a distinct random starting precinct for every district, the same
+    way draw_dart_throw_map does, and assigns it.
+
+    Inputs:
+        -part (Partition): map being drawn, with no precincts assigned
+        -num_districts (int): Number of districts to draw
+        -rng (random.Random): random number generator
+
+    Returns: None, modifies part in-place
+    '''
+    inst = get_instrument()
+    for id in range(1, num_districts + 1):
+        curr_index = rng.randint(0, len(part) - 1)
+        while part.assignment[curr_index] != 0:
+            curr_index = rng.randint(0, len(part) - 1)
+        inst.event('dart', f"Throwing dart for district {id} at precinct {part.geoids[curr_index]}...",
+                   district=id, precinct=part.geoids[curr_index])
+        part.assign(curr_index, id)
+
+
+def frontier_claims(part, frontier, open_dists, priority):
+    '''
+    Finds which district each frontier precinct would join: the open
+    district it has the most neighbors in, with ties going to the district
+    with the higher random priority.
+
+    Inputs:
+        -part (Partition): map being drawn
+        -frontier (NumPy int array): unassigned precincts that border an
+        assigned one
+        -open_dists (NumPy int array): dist_ids of districts still growing
+        -priority (NumPy float array): random tie-break key of each district,
+        indexed by dist_id
+
+    Returns (tuple of NumPy int arrays): row positions of the claimed
+    precincts, the dist_id claiming each one, and the dist_ids of every open
+    district that borders any unassigned precinct
+    '''
+    #indicator matrix: one column per open district, a 1 for each member
+    col_of = np.full(part.num_districts + 1, -1)
+    col_of[open_dists] = np.arange(len(open_dists))
+    cols = col_of[part.assignment]
+    is_member = cols >= 0
+    indptr = np.zeros(len(part) + 1, dtype=np.int64)
+    np.cumsum(is_member, out=indptr[1:])
+    indicator = sparse.csr_matrix((np.ones(indptr[-1], dtype=np.int32), cols[is_member], indptr),
+                                  shape=(len(part), len(open_dists)))
+    #neighbor counts of each frontier precinct in each open district
+    touching = (part.adjacency_matrix()[frontier] @ indicator).tocoo()
+
+    rows = frontier[touching.row]
+    dists = open_dists[touching.col]
+    bordering = np.unique(dists)
+    #for each precinct, most neighbors first, then highest priority
+    order = np.lexsort((-priority[dists], -touching.data, rows))
+    rows, dists = rows[order], dists[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    return rows[first], dists[first], bordering
+
+
+def unassigned_neighbors(part, precincts):
+    '''
+    Returns (NumPy int array): the unassigned neighbors of some precincts,
+    each listed once
+    '''
+    nabes = np.unique(part.adjacency_matrix()[precincts].indices)
+    return nabes[part.assignment[nabes] == 0]
+
+
+def capped_claims(part, precincts, dists, target_pop, rng):
+    '''
+    Lets each district take claimed precincts, in random order, only while
+    it is at or under the target population before each one (the same rule
+    draw_dart_throw_map applies one precinct at a time), using a cumulative
+    sum of population within each district.
+
+    Inputs:
+        -part (Partition): map being drawn
+        -precincts, dists (NumPy int arrays): claimed precincts and the
+        dist_id claiming each, from frontier_claims
+        -target_pop (int): population every district would have in a
+        perfectly balanced map
+        -rng (numpy Generator): random number generator
+
+    Returns (NumPy boolean array): which claims go through
+    '''
+    if len(precincts) == 0:
+        return np.zeros(0, dtype=bool)
+    order = np.lexsort((rng.random(len(precincts)), dists))
+    sorted_dists = dists[order]
+    pop = part.pop[precincts[order]]
+    #population each district would have before taking each precinct
+    running = np.cumsum(pop) - pop
+    group_start = np.flatnonzero(np.r_[True, sorted_dists[1:] != sorted_dists[:-1]])
+    group_sizes = np.diff(np.r_[group_start, len(sorted_dists)])
+    running -= np.repeat(running[group_start], group_sizes)
+    accepted = np.empty(len(order), dtype=bool)
+    accepted[order] = part.dist_pop[sorted_dists] + running <= target_pop
+    return accepted
+
+
+@timed
+def draw_bfs_seed_map(df, num_districts, seed=2023):
+    '''
+    Draws a starting map by throwing darts, as draw_dart_throw_map does, then
+    growing every district at once in vectorized rounds (see module
+    docstring). Districts stop growing when they pass the target population
+    or can't reach any more unassigned precincts; whatever is left is filled
+    with fill_district_holes.
+
+    Inputs:
+        -df (Geopandas GeoDataFrame or Partition): state data by precinct/VTD
+        -num_districts (int): Number of districts to draw
+        -seed (int or random.Random): Seed for random number generation, for
+        replicability, or a generator to draw from
+
+    Returns: None, modifies df in-place
+    '''
+    inst = get_instrument()
+    part = as_partition(df, num_districts)
+    part.clear()
+    rng = seed if isinstance(seed, random.Random) else random.Random(seed)
+    np_rng = np.random.default_rng(rng.getrandbits(64))
+    target_pop = part.target_pop
+
+    throw_darts(part, num_districts, rng)
+    open_dists = np.arange(1, num_districts + 1)
+    frontier = unassigned_neighbors(part, np.flatnonzero(part.assignment))
+    while len(open_dists) > 0 and part.dist_size[0] > 0:
+        inst.event('expand_round', f"{part.dist_size[0]} unfilled precincts remain",
+                   holes_left=int(part.dist_size[0]))
+        inst.count('expand_rounds')
+        priority = np_rng.random(num_districts + 1)
+        precincts, dists, bordering = frontier_claims(part, frontier, open_dists, priority)
+        accepted = capped_claims(part, precincts, dists, target_pop, np_rng)
+        part.assign_many(precincts[accepted], dists[accepted])
+        frontier = np.union1d(frontier[part.assignment[frontier] == 0],
+                              unassigned_neighbors(part, precincts[accepted]))
+
+        #a district stops once it passes the target population or has no
+        #unassigned neighbors left ("trapped")
+        for id in open_dists[part.dist_pop[open_dists] > target_pop]:
+            inst.event('district_full', f"District {id} has hit its target population size",
+                       district=int(id))
+        open_dists = bordering[part.dist_pop[bordering] <= target_pop]
+
+    if part.dist_size[0] > 0:
+        inst.event('fill_holes', "Switching methods to fill rest of map...")
+        fill_district_holes(part)
+    sync_partition(df, part)
@@ -0,0 +1,110 @@
+'''
+Checkpoint files for long-running balancing and map-drawing jobs.
+
+A checkpoint is a small .npz file holding the district assignment of every
+precinct plus a JSON record of everything else needed to pick the job back
+up: which function was running and with what arguments, iteration counters,
+the deviation history, and the state of the random number generator (if the
+job uses one). Checkpoints are written to a temporary file and renamed, so
+a crash mid-write leaves the previous checkpoint intact.
+'''
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+def numpy_to_json(value):
+    '''
+    Converts the NumPy scalars and arrays that turn up in balancing state
+    (e.g. int64 populations) to plain Python for json.dumps.
+
+    Inputs:
+        -value: object json can't serialize by itself
+
+    Returns: int, float, str, bool, or list
+    '''
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Can't save {type(value).__name__} in a checkpoint")
+
+
+def save_checkpoint(filepath, assignment, job, counters=None, history=None, rng=None,
+                    extra=None):
+    '''
+    Writes a checkpoint.
+
+    Inputs:
+        -filepath (str): where to save the checkpoint (should end in .npz)
+        -assignment (NumPy int array): dist_id of each precinct by row
+        position (0 = unassigned)
+        -job (dict): name of the function that was running ('function') and
+        the arguments needed to call it again
+        -counters (dict): iteration counters, e.g. {'count': 3}
+        -history (list): deviation after each iteration so far
+        -rng (random.Random): random number generator, if the job uses one
+        -extra (dict): any other JSON-serializable state the job needs
+
+    Returns: None, writes file
+    '''
+    record = {'job': job, 'counters': counters or {}, 'history': history or [],
+              'rng_state': None, 'extra': extra or {}}
+    if rng is not None:
+        version, internal, gauss_next = rng.getstate()
+        record['rng_state'] = [version, list(internal), gauss_next]
+
+    #np.savez adds .npz to names that don't end in it
+    tmp_path = filepath + '.tmp.npz'
+    np.savez(tmp_path, assignment=np.asarray(assignment, dtype=np.int32),
+             record=np.array(json.dumps(record, default=numpy_to_json)))
+    os.replace(tmp_path, filepath)
+
+
+def load_checkpoint(filepath):
+    '''
+    Reads a checkpoint written by save_checkpoint.
+
+    Inputs:
+        -filepath (str): location of the checkpoint
+
+    Returns (dict): 'assignment' (NumPy int32 array), 'job', 'counters',
+    'history', 'extra', and 'rng_state' (a tuple for random.Random.setstate,
+    or None)
+    '''
+    with np.load(filepath) as saved:
+        assignment = saved['assignment']
+        record = json.loads(str(saved['record']))
+    if record['rng_state'] is not None:
+        version, internal, gauss_next = record['rng_state']
+        record['rng_state'] = (version, tuple(internal), gauss_next)
+    record['assignment'] = assignment
+    return record
+
+
+def df_assignment(df):
+    '''
+    Reads the 'dist_id' column of a GeoDataFrame as an int array, for saving
+    in a checkpoint.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD
+
+    Returns (NumPy int32 array): dist_id by row position (0 = unassigned)
+    '''
+    dist_ids = df['dist_id'].to_numpy()
+    return np.where(pd.isna(dist_ids), 0, dist_ids).astype(np.int32)
+
+
+def restore_df_assignment(df, assignment):
+    '''
+    Writes a checkpointed assignment back into the 'dist_id' column.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD
+        -assignment (NumPy int array): as from load_checkpoint
+
+    Returns: None, modifies df in-place
+    '''
+    dist_ids = assignment.astype(object)
+    dist_ids[assignment == 0] = None
+    df['dist_id'] = dist_ids
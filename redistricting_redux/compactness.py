@@ -0,0 +1,240 @@
+'''
+Compactness of districts, measured from precinct areas and shared boundary
+lengths (see load_state_data.compute_edge_lengths) instead of dissolving
+polygons.
+
+A district's area is the sum of its precincts' areas. Its perimeter is the
+state-line perimeter of its precincts plus the length of every cut edge (a
+boundary shared by two neighboring precincts in different districts) along
+its side. From those:
+    Polsby-Popper   4*pi*area / perimeter**2: 1 for a circle, toward 0 for
+                    long or wiggly districts
+    Schwartzberg    circumference of the circle with the district's area,
+                    divided by the district's perimeter: also 1 for a
+                    circle (it is the square root of Polsby-Popper)
+    cut edges       number of neighboring precinct pairs split between
+                    this district and another one
+CompactnessTracker keeps all of these up to date as precincts move, looking
+only at the moved precinct's own edges, so swap and ReCom-style loops can
+score compactness on every move.
+'''
+import numpy as np
+import pandas as pd
+from partition import Partition, as_partition
+from adjacency import load_edge_lengths, load_precinct_areas
+from load_state_data import (compute_edge_lengths, compute_precinct_areas, add_edge_lengths,
+                             state_geometry)
+
+
+def precinct_measures(df, state_postal=None):
+    '''
+    Gets the precinct areas and boundary lengths compactness is computed
+    from.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD, with
+        neighbors (see load_state_data.load_state)
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia. Defaults to the one load_state
+        stored in df.attrs. If there is one, the measures are read from the
+        state's adjacency file (and measured and saved there first if the
+        file doesn't have them yet). If not, they are measured from df's
+        polygons.
+
+    Returns (dict): 'area' and 'exterior_perimeter' of each precinct by row,
+    and 'edge_length' lined up with the CSR adjacency of df's neighbors
+    '''
+    state_postal = state_postal or df.attrs.get('state_postal')
+    if state_postal is None:
+        part = Partition.from_df(df, 0)
+        geoms = state_geometry(df)
+        edge_length, exterior_perimeter = compute_edge_lengths(geoms, part.indptr, part.indices)
+        return {'area': compute_precinct_areas(geoms), 'edge_length': edge_length,
+                'exterior_perimeter': exterior_perimeter}
+
+    adjacency_fp = f'redistricting_redux/merged_shps/{state_postal}_2020_adjacency.npz'
+    lengths = load_edge_lengths(adjacency_fp)
+    area = load_precinct_areas(adjacency_fp)
+    if lengths is None or area is None:
+        edge_length, exterior_perimeter, area = add_edge_lengths(df, state_postal)
+    else:
+        edge_length, exterior_perimeter = lengths
+    return {'area': area, 'edge_length': edge_length, 'exterior_perimeter': exterior_perimeter}
+
+
+def polsby_popper(area, perimeter):
+    '''
+    Polsby-Popper score(s): 4*pi*area / perimeter**2.
+
+    Inputs:
+        -area, perimeter (float or NumPy float array)
+
+    Returns (float or NumPy float array): between 0 and 1 (NaN for an empty
+    district)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 4 * np.pi * np.asarray(area) / np.asarray(perimeter) ** 2
+
+
+def schwartzberg(area, perimeter):
+    '''
+    Schwartzberg score(s): circumference of a circle with the same area,
+    divided by the perimeter.
+
+    Inputs:
+        -area, perimeter (float or NumPy float array)
+
+    Returns (float or NumPy float array): between 0 and 1 (NaN for an empty
+    district)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 2 * np.sqrt(np.pi * np.asarray(area)) / np.asarray(perimeter)
+
+
+class CompactnessTracker:
+    '''
+    Area, perimeter and cut edges of every district of a Partition, kept up
+    to date in O(degree) per move. Move precincts with tracker.move instead
+    of partition.assign; if the assignment is changed any other way, call
+    recount().
+
+    Inputs:
+        -part (Partition): the plan to track
+        -area, exterior_perimeter (NumPy float arrays): of each precinct,
+        by row
+        -edge_length (NumPy float array): shared boundary length, lined up
+        with part.indices (see precinct_measures)
+
+    Attributes:
+        -dist_area, dist_perimeter (NumPy float arrays): by dist_id
+        -dist_cut_edges (NumPy int array): cut edges along each district's
+        side, by dist_id
+        -cut_edges (int): cut edges in the whole plan
+    (index 0 of each array counts unassigned precincts)
+    '''
+    def __init__(self, part, area, edge_length, exterior_perimeter):
+        assert len(edge_length) == len(part.indices), "edge lengths don't match the adjacency"
+        self.part = part
+        self.area = np.asarray(area, dtype=np.float64)
+        self.edge_length = np.asarray(edge_length, dtype=np.float64)
+        self.exterior_perimeter = np.asarray(exterior_perimeter, dtype=np.float64)
+        self.recount()
+
+    @classmethod
+    def from_df(cls, df, part=None, state_postal=None):
+        '''
+        Builds a tracker for a state, reading (or measuring) the precinct
+        areas and boundary lengths with precinct_measures.
+
+        Inputs:
+            -df (geopandas GeoDataFrame): state data by precinct/VTD
+            -part (Partition): the plan to track. Defaults to df's own
+            dist_ids
+            -state_postal (2-character string): as for precinct_measures
+
+        Returns (CompactnessTracker)
+        '''
+        if part is None:
+            part = as_partition(df)
+        measures = precinct_measures(df, state_postal)
+        return cls(part, measures['area'], measures['edge_length'],
+                   measures['exterior_perimeter'])
+
+    def recount(self):
+        '''
+        Recomputes every district's area, perimeter and cut edges from
+        scratch.
+        '''
+        bins = self.part.num_districts + 1
+        assignment = self.part.assignment
+        src, dst = self.part.edges()
+        side = assignment[src]
+        cut = side != assignment[dst]
+        self.dist_area = np.bincount(assignment, weights=self.area, minlength=bins)
+        self.dist_perimeter = (np.bincount(assignment, weights=self.exterior_perimeter,
+                                           minlength=bins)
+                               + np.bincount(side[cut], weights=self.edge_length[cut],
+                                             minlength=bins))
+        self.dist_cut_edges = np.bincount(side[cut], minlength=bins)
+        #both directions of every pair are in the adjacency
+        self.cut_edges = int(cut.sum()) // 2
+
+    def move(self, precinct, id):
+        '''
+        Moves a precinct to another district (via partition.assign) and
+        updates the scores, looking only at the precinct's own edges.
+
+        Inputs:
+            -precinct (int): row position of the precinct
+            -id (int): dist_id of the district to move it into
+
+        Returns: None, modifies tracker and partition in-place
+        '''
+        old = self.part.assignment[precinct]
+        if old == id:
+            return
+        start, end = self.part.indptr[precinct], self.part.indptr[precinct + 1]
+        nabe_ids = self.part.assignment[self.part.indices[start:end]]
+        lengths = self.edge_length[start:end]
+        was_cut = nabe_ids != old
+        now_cut = nabe_ids != id
+
+        #every cut edge counts once for the district on each side
+        change = now_cut.astype(np.int64) - was_cut
+        np.add.at(self.dist_perimeter, nabe_ids, lengths * change)
+        np.add.at(self.dist_cut_edges, nabe_ids, change)
+        self.dist_perimeter[old] -= lengths[was_cut].sum() + self.exterior_perimeter[precinct]
+        self.dist_perimeter[id] += lengths[now_cut].sum() + self.exterior_perimeter[precinct]
+        self.dist_cut_edges[old] -= was_cut.sum()
+        self.dist_cut_edges[id] += now_cut.sum()
+        self.dist_area[old] -= self.area[precinct]
+        self.dist_area[id] += self.area[precinct]
+        self.cut_edges += int(change.sum())
+
+        self.part.assign(precinct, id)
+
+    def polsby_popper(self):
+        '''
+        Returns (NumPy float array): Polsby-Popper score of districts 1
+        through num_districts
+        '''
+        return polsby_popper(self.dist_area[1:], self.dist_perimeter[1:])
+
+    def schwartzberg(self):
+        '''
+        Returns (NumPy float array): Schwartzberg score of districts 1
+        through num_districts
+        '''
+        return schwartzberg(self.dist_area[1:], self.dist_perimeter[1:])
+
+    def summary(self):
+        '''
+        Returns (pandas DataFrame): area, perimeter, polsby_popper,
+        schwartzberg and cut_edges of every district, indexed by dist_id
+        '''
+        return pd.DataFrame({'area': self.dist_area[1:],
+                             'perimeter': self.dist_perimeter[1:],
+                             'polsby_popper': self.polsby_popper(),
+                             'schwartzberg': self.schwartzberg(),
+                             'cut_edges': self.dist_cut_edges[1:]},
+                            index=pd.Index(np.arange(1, self.part.num_districts + 1),
+                                           name='dist_id'))
+
+
+def district_compactness(df, partition=None, state_postal=None):
+    '''
+    Scores the compactness of every district of a plan, without dissolving
+    any polygons.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD, with
+        neighbors
+        -partition (Partition): if given, the plan to score, in place of
+        df's own dist_id column
+        -state_postal (2-character string): as for precinct_measures
+
+    Returns (pandas DataFrame): area, perimeter, polsby_popper,
+    schwartzberg and cut_edges of every district, indexed by dist_id (see
+    CompactnessTracker.summary)
+    '''
+    return CompactnessTracker.from_df(df, partition, state_postal).summary()
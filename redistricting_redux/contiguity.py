@@ -0,0 +1,142 @@
+'''
+Contiguity checks for Partitions.
+
+Rather than letting swaps break districts apart and cleaning up afterwards
+(recapture_orphan_precincts, which rescans the whole map and only catches
+single-precinct islands), balancing code asks would_disconnect before each
+move and skips moves that would split the donor district.
+'''
+from collections import deque
+
+
+def would_disconnect(part, precinct):
+    '''
+    Determines whether taking a precinct out of its district would split
+    the district into disconnected pieces (or empty it out).
+
+    Runs one breadth-first search through the district (not through the
+    precinct itself) from each of the precinct's same-district neighbors,
+    taking turns one step at a time. Searches that run into each other are
+    merged. If they all merge, the district stays connected; if some group of
+    searches runs out of precincts first, it has found a piece that would be
+    cut off. Either way the work done is about the size of the smallest
+    piece involved, which is local for most precincts, and never more than
+    the size of the district.
+
+    Inputs:
+        -part (Partition): map with the precinct assigned
+        -precinct (int): row position of the precinct
+
+    Returns (boolean): True if removing the precinct breaks contiguity
+    '''
+    id = part.assignment[precinct]
+    if part.dist_size[id] <= 1:
+        return True
+    sources = [nabe for nabe in part.neighbors(precinct).tolist()
+               if part.assignment[nabe] == id]
+    #with 0 same-district neighbors it's already an island, and moving it 
+    #away can't split anything else
+    if len(sources) <= 1:
+        return False
+
+    #union-find over search labels
+    merged_into = list(range(len(sources)))
+    def find(label):
+        while merged_into[label] != label:
+            merged_into[label] = merged_into[merged_into[label]]
+            label = merged_into[label]
+        return label
+
+    owner = {precinct: None}
+    queues = []
+    for label, source in enumerate(sources):
+        owner[source] = label
+        queues.append(deque([source]))
+    groups = len(sources)
+
+    while True:
+        for label, queue in enumerate(queues):
+            if not queue:
+                continue
+            current = queue.popleft()
+            for nabe in part.neighbors(current).tolist():
+                if part.assignment[nabe] != id:
+                    continue
+                if nabe not in owner:
+                    owner[nabe] = label
+                    queue.append(nabe)
+                elif owner[nabe] is not None:
+                    root, other_root = find(label), find(owner[nabe])
+                    if root != other_root:
+                        merged_into[root] = other_root
+                        groups -= 1
+                        if groups == 1:
+                            return False
+            if not queue:
+                root = find(label)
+                if not any(queues[other] for other in range(len(sources))
+                           if find(other) == root):
+                    return True
+
+
+def can_move(part, precinct, to_dist):
+    '''
+    Determines whether a precinct can switch to another district while
+    keeping both districts contiguous: the precinct has to border the new
+    district, and leaving must not split its current district.
+
+    Inputs:
+        -part (Partition): map with every precinct assigned
+        -precinct (int): row position of the precinct
+        -to_dist (int): dist_id of the district it would move to
+
+    Returns (boolean)
+    '''
+    if part.assignment[precinct] == to_dist:
+        return False
+    if not (part.assignment[part.neighbors(precinct)] == to_dist).any():
+        return False
+    return not would_disconnect(part, precinct)
+
+
+def district_components(part, id):
+    '''
+    Splits a district into its connected pieces.
+
+    Inputs:
+        -part (Partition)
+        -id (int): dist_id of the district
+
+    Returns (list of lists of ints): row positions of the precincts in each
+    connected piece, largest piece first
+    '''
+    unvisited = set(part.members(id).tolist())
+    components = []
+    while unvisited:
+        start = unvisited.pop()
+        component = [start]
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            for nabe in part.neighbors(current).tolist():
+                if nabe in unvisited:
+                    unvisited.discard(nabe)
+                    component.append(nabe)
+                    queue.append(nabe)
+        components.append(component)
+    components.sort(key=len, reverse=True)
+    return components
+
+
+def is_contiguous(part, id=None):
+    '''
+    Checks whether a district (or every district) is in one connected piece.
+
+    Inputs:
+        -part (Partition)
+        -id (int): dist_id of the district to check. If None, checks all
+
+    Returns (boolean)
+    '''
+    ids = range(1, part.num_districts + 1) if id is None else [id]
+    return all(len(district_components(part, i)) <= 1 for i in ids)
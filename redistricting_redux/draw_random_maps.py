@@ -6,11 +6,17 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 import random 
+import heapq
 import re
-import time
 from datetime import datetime
 import matplotlib as plt
 from stats import population_sum, blue_red_margin, target_dist_pop, set_blue_red_diff #not sure i did this relative directory right
+from partition import Partition, as_partition, sync_partition
+from contiguity import can_move
+from checkpoint import save_checkpoint, load_checkpoint, df_assignment
+from map_plot import step_renderer
+from load_state_data import state_geometry
+from instrument import get_instrument, timed
 
 
 def clear_dist_ids(df):
@@ -18,11 +24,14 @@ def clear_dist_ids(df):
     Clears off any district IDs that precincts may have been assigned in the
     past. Call this between calls to any map-drawing function.
     Inputs:
-        df (geopandas GeoDataFrame)
+        df (geopandas GeoDataFrame or Partition)
 
     Returns: None, modifies GeoDataFrame in-place
     '''
-    df['dist_id'] = None
+    if isinstance(df, Partition):
+        df.clear()
+    else:
+        df['dist_id'] = None
 
 
 def draw_into_district(df, precinct, id):
@@ -32,14 +41,24 @@ def draw_into_district(df, precinct, id):
     rather than a spatially joined object, at least for now.
     Will get called repeatedly by district drawing methods.
 
+    Precincts are identified by their row position in the df, which is an
+    O(1) lookup. A GEOID20 string also works, but has to scan the whole column.
+    On a Partition, district totals are updated at the same time.
+
     Inputs:
-        -df (GeoPandas GeoDataFrame):
-        -precinct(str): ID of the precinct to find and draw into district.
+        -df (GeoPandas GeoDataFrame or Partition):
+        -precinct(int or str): row position (or GEOID20) of the precinct to 
+        find and draw into district.
         -id (int): Number of the district to be drawn into.
 
     Returns: Nothing, modifies df in-place
     '''
-    df.loc[df['GEOID20'] == precinct, 'dist_id'] = id
+    if isinstance(df, Partition):
+        df.assign(precinct, id)
+    elif isinstance(precinct, str):
+        df.loc[df['GEOID20'] == precinct, 'dist_id'] = id
+    else:
+        df.iat[precinct, df.columns.get_loc('dist_id')] = id
 
 
 def all_allowed_neighbors_of_district(df, id):
@@ -49,21 +68,26 @@ def all_allowed_neighbors_of_district(df, id):
     length 0, it is impossible to keep drawing a contiguous district.
 
     Inputs:
-        -df (geopandas GeoDataFrame): state level data by precinct/VTD
+        -df (geopandas GeoDataFrame or Partition): state level data by 
+        precinct/VTD
         -id (int): dist_id of the district you're investigating
 
-    Returns (list of strings): IDs of available precincts.
+    Returns (list of ints): row positions of available precincts, in
+    ascending order.
     '''
+    part = as_partition(df)
+    members = part.members(id)
+    if len(members) == 0:
+        return []
     #idea for np.concatenate: https://stackoverflow.com/questions/28125265/concatenate-numpy-arrays-which-are-elements-of-a-list
-    nabe_set = set(np.concatenate(df.loc[df.dist_id == id, 'neighbors'].values))
+    nabes = np.unique(np.concatenate([part.neighbors(p) for p in members]))
 
-    #seems to be faster as a list comprehension than as a set comprehension
-    allowed_neighbors = [nabe for nabe in nabe_set
-                         if df.loc[df.GEOID20 == nabe, 'dist_id'].isna().any()]
+    allowed_neighbors = nabes[part.assignment[nabes] == 0]
 
-    return allowed_neighbors
+    return allowed_neighbors.tolist()
 
 
+@timed
 def draw_dart_throw_map(df, num_districts, seed=2023, clear_first=True):
     '''
     Start by picking random precincts on the map, as if "throwing a dart" at it,
@@ -81,9 +105,10 @@ def draw_dart_throw_map(df, num_districts, seed=2023, clear_first=True):
     conversation with James Turk.
 
     Inputs:
-        -df (Geopandas GeoDataFrame): state data by precinct/VTD
+        -df (Geopandas GeoDataFrame or Partition): state data by precinct/VTD
         -num_districts (int): Number of districts to draw (for Georgia, that's 14)
-        -seed (int): Seed for random number generation, for replicability
+        -seed (int or random.Random): Seed for random number generation, for 
+        replicability, or a generator to draw from
         -clear_first (boolean): Determines whether to erase any dist_id
         assignments already in map. Should not be set to False unless
         debugging.
@@ -92,51 +117,86 @@ def draw_dart_throw_map(df, num_districts, seed=2023, clear_first=True):
 
     Returns: None, modifies df in-place
     '''
+    inst = get_instrument()
+    part = as_partition(df, num_districts)
     if clear_first:
-        print("Clearing off previous district drawings, if any...")
-        clear_dist_ids(df)
-        time.sleep(0.1)
+        inst.event('clear', "Clearing off previous district drawings, if any...")
+        part.clear()
 
-    random.seed(seed) 
+    #a generator of its own, rather than seeding the global random module,
+    #so maps can be drawn in parallel without interfering with each other
+    rng = seed if isinstance(seed, random.Random) else random.Random(seed)
     
-    target_pop = target_dist_pop(df, num_districts)
+    target_pop = part.target_pop
 
     #throw darts
     for id in range(1, num_districts+1):
-        curr_index = random.randint(0, len(df)-1)
-        while df.loc[curr_index, 'dist_id'] is not None:
-            curr_index = random.randint(0, len(df)-1)
-        curr_precinct = df.loc[curr_index, 'GEOID20']
-        print(f"Throwing dart for district {id} at precinct {curr_precinct}...")
-        draw_into_district(df, curr_precinct, id)
-
-    #expand into area around darts
-    holes_left = len(df.loc[df['dist_id'].isnull()])
+        curr_index = rng.randint(0, len(part)-1)
+        while part.assignment[curr_index] != 0:
+            curr_index = rng.randint(0, len(part)-1)
+        curr_precinct = part.geoids[curr_index]
+        inst.event('dart', f"Throwing dart for district {id} at precinct {curr_precinct}...",
+                   district=id, precinct=curr_precinct)
+        part.assign(curr_index, id)
+
+    #expand into area around darts. Each district keeps a frontier (set of
+    #precincts bordering it) that grows as it claims precincts, instead of
+    #recomputing its neighbors from all its members every round
+    frontiers = {id: set(all_allowed_neighbors_of_district(part, id)) 
+                 for id in range(1, num_districts+1)}
+    holes_left = part.dist_size[0]
     expand_order = [i for i in range(1,num_districts+1)]
     holes_by_step = []
     while holes_left > 0: 
-        holes_left = len(df.loc[df['dist_id'].isnull()])
+        holes_left = part.dist_size[0]
         holes_by_step.append(holes_left)
-        print(f"{holes_left} unfilled precincts remain")
+        inst.event('expand_round', f"{holes_left} unfilled precincts remain", 
+                   holes_left=holes_left)
         if holes_left == 0:
             break
+        inst.count('expand_rounds')
         if len(holes_by_step) > 2 and holes_by_step[-1] == holes_by_step[-2]:
-            print("Switching methods to fill rest of map...")
-            fill_district_holes(df)
+            inst.event('fill_holes', "Switching methods to fill rest of map...")
+            fill_district_holes(part)
             break
         #randomize the order in which districts expand each go-round
-        random.shuffle(expand_order) 
+        rng.shuffle(expand_order) 
         for id in expand_order:
-            allowed = all_allowed_neighbors_of_district(df, id)
+            #same precincts, in the same (ascending) order, as
+            #all_allowed_neighbors_of_district(part, id) would give
+            allowed = sorted(nabe for nabe in frontiers[id] if part.assignment[nabe] == 0)
+            frontiers[id] = set(allowed)
             for neighbor in allowed:
-                if population_sum(df, district=id) <= target_pop:
-                    draw_into_district(df, neighbor, id)
+                if part.dist_pop[id] <= target_pop:
+                    claim_precinct(part, frontiers[id], neighbor, id)
                 else:
-                    print(f"District {id} has hit its target population size")
+                    inst.event('district_full', f"District {id} has hit its target population size",
+                               district=id)
                     if id in expand_order:
                         expand_order.remove(id)
                     break
 
+    sync_partition(df, part)
+
+
+def claim_precinct(part, frontier, precinct, id):
+    '''
+    Draws a precinct into a growing district and adds the precinct's 
+    neighbors to that district's frontier. Helper for draw_dart_throw_map.
+
+    Inputs:
+        -part (Partition): map being drawn
+        -frontier (set of ints): row positions of precincts bordering the
+        district. Claimed precincts are left in it and skipped later.
+        -precinct (int): row position of the precinct to claim
+        -id (int): dist_id of the district claiming it
+
+    Returns: None, modifies part and frontier in-place
+    '''
+    part.assign(precinct, id)
+    frontier.discard(precinct)
+    frontier.update(part.neighbors(precinct).tolist())
+
 
 ### MAP CLEANUP FUNCTIONS ###
 
@@ -149,82 +209,92 @@ def fill_district_holes(df):
     and iterate until every precinct on the map has a dist_id.
 
     Inputs:
-        -df (geopandas GeoDataFrame): state data by precinct/VTD
+        -df (geopandas GeoDataFrame or Partition): state data by precinct/VTD
 
     Returns: None, returns df in-place
     '''
-    holes = df.loc[df['dist_id'].isnull()]
+    inst = get_instrument()
+    part = as_partition(df)
+    holes = np.flatnonzero(part.assignment == 0)
     go_rounds = 0
     while len(holes) > 0: 
         go_rounds += 1
-        holes = df.loc[df['dist_id'].isnull()]
-        print(f"{holes.shape[0]} unfilled precincts remaining")
-        time.sleep(1)
-        for index, hole in holes.iterrows():
-            real_dists_ard_hole = find_neighboring_districts(df, hole['neighbors'], include_None=False)
+        holes = np.flatnonzero(part.assignment == 0)
+        inst.event('fill_round', f"{holes.shape[0]} unfilled precincts remaining", 
+                   holes_left=holes.shape[0])
+        inst.count('fill_rounds')
+        for hole in holes:
+            real_dists_ard_hole = find_neighboring_districts(part, part.neighbors(hole), include_None=False)
             if len(real_dists_ard_hole) == 1:
-                draw_into_district(df, hole['GEOID20'], int(max(real_dists_ard_hole)))
+                part.assign(hole, int(max(real_dists_ard_hole)))
             elif len(real_dists_ard_hole) >= 2: 
-                draw_into_district(df, hole['GEOID20'], 
-                                   smallest_neighbor_district(df, real_dists_ard_hole))
+                part.assign(hole, smallest_neighbor_district(part, real_dists_ard_hole))
 
-    print("Cleanup complete. All holes in districts filled. Districts expanded to fill empty space.")
+    sync_partition(df, part)
+    inst.event('fill_done', "Cleanup complete. All holes in districts filled. Districts expanded to fill empty space.")
 
 
+@timed
 def mapwide_pop_swap(df, allowed_deviation=70000):
     '''
     Iterates through the precincts in a state with a drawn district map and 
     attempts to balance their population by moving  precincts from overpopulated
     districts into underpopulated ones.
 
-    This function is VERY SLOW - takes about 30 seconds to iterate
+    This function used to be VERY SLOW - about 30 seconds to iterate
     through 1000 rows of the df, and then up to 15 seconds to reclaim
-    'orphan' precincts. Attempts to vectorize and speed it up (visible in
-    UNUSED_FILES/mapwide_popswap_2.py) were largely unsuccessful and abandoned.
+    'orphan' precincts. Running it on a Partition, where district populations
+    are kept as running totals, takes a small fraction of that. Reassignments
+    that would split a district are skipped, so there are no more 'orphan'
+    precincts to reclaim afterwards.
 
     Inputs:
-        -df (geopandas GeoDataFrame): state data by precinct/VTD. Every precinct 
-        should have a dist_id assigned before calling this function.
+        -df (geopandas GeoDataFrame or Partition): state data by precinct/VTD. 
+        Every precinct should have a dist_id assigned before calling this 
+        function.
         -allowed_deviation (int): Largest allowable difference between the 
         population of the most populous district and the population of the 
         least populous district.
 
     Returns: None, modifies df in-place
     '''
-    target_pop = target_dist_pop(df, n=max(df['dist_id']))
+    inst = get_instrument()
+    part = as_partition(df)
+    target_pop = part.target_pop
     draws_to_do = []
-    print("Checking for precincts to move from overpopulated districts to underpopulated neighbors.")
-    print("This could take up to a minute...")
-    #source for itertuples:
-    #https://stackoverflow.com/questions/44634972/how-to-access-a-field-of-a-namedtuple-using-a-variable-for-the-field-name
-    idx = {name: i for i, name in enumerate(list(df), start=1)}
-    for row in df.itertuples():
-        neighboring_dists = find_neighboring_districts(df, row[idx['neighbors']])
-        proper_neighbors = {dist for dist in neighboring_dists if dist != row[idx['dist_id']]}
+    inst.event('swap_scan', "Checking for precincts to move from overpopulated districts to underpopulated neighbors.")
+    for precinct in range(len(part)):
+        dist_id = part.assignment[precinct]
+        neighboring_dists = find_neighboring_districts(part, part.neighbors(precinct))
+        proper_neighbors = {dist for dist in neighboring_dists if dist != dist_id}
         if len(proper_neighbors) > 0:
-            smallest_neighbor = smallest_neighbor_district(df, proper_neighbors)
-            if (population_sum(df, district=row[idx['dist_id']]) > target_pop and 
-                population_sum(df, district=smallest_neighbor) < target_pop):
-                draw_to_do = (row[idx['dist_id']], row[idx['GEOID20']], smallest_neighbor)
+            smallest_neighbor = smallest_neighbor_district(part, proper_neighbors)
+            if (part.dist_pop[dist_id] > target_pop and 
+                part.dist_pop[smallest_neighbor] < target_pop):
+                draw_to_do = (dist_id, precinct, smallest_neighbor)
                 draws_to_do.append(draw_to_do)
 
-    print("Doing all valid precinct reassignments...")
+    inst.event('swap_moves', "Doing all valid precinct reassignments...", 
+               candidates=len(draws_to_do))
+    inst.count('swap_candidates', len(draws_to_do))
     for draw in draws_to_do:
         donor_district, precinct, acceptor_district = draw
         #make sure acceptor district isn't too large to be accepting precincts
-        if population_sum(df, district=acceptor_district) >= target_pop + (allowed_deviation / 2):
+        if part.dist_pop[acceptor_district] >= target_pop + (allowed_deviation / 2):
             continue
         #make sure donor district isn't to small to be giving precincts
-        if population_sum(df, district=donor_district) <= target_pop - (allowed_deviation / 2):
+        if part.dist_pop[donor_district] <= target_pop - (allowed_deviation / 2):
             continue
-        draw_into_district(df, precinct, acceptor_district)
-
-    #fix any district that is fully surrounded by dist_ids other than its 
-    #own (redraw it to match majority dist_id surrounding it)
-    print("Reassigning districts 'orphaned' by swapping process...")
-    recapture_orphan_precincts(df, idx)
+        #make sure the move keeps both districts in one piece (earlier moves
+        #in this list may have changed what's around the precinct)
+        if not can_move(part, precinct, acceptor_district):
+            inst.count('moves_skipped_contiguity')
+            continue
+        part.assign(precinct, acceptor_district)
+        inst.count('precincts_moved')
 
-    print(district_pops(df))
+    sync_partition(df, part)
+    inst.event('district_pops', district_pops=district_pops(part))
 
 def population_deviation(df):
     '''
@@ -238,66 +308,130 @@ def population_deviation(df):
     return pop_dev
 
 
-def repeated_pop_swap(df, allowed_deviation=70000, plot_each_step=False, stop_after=20):
+def repeated_pop_swap(df, allowed_deviation=70000, plot_each_step=False, stop_after=20,
+                      checkpoint_path=None, resume=False):
     '''
     Repeatedly calls mapwide_pop_swap() until populations of districts are 
     within allowable deviation range. Terminates early if the procedure is 
     unable to equalize district populations any further. 
     
     Inputs:
-        -df (geopandas GeoDataFrame): state-level precinct/VTD data. Should
-        have dist_ids assigned to every precinct.
+        -df (geopandas GeoDataFrame or Partition): state-level precinct/VTD 
+        data. Should have dist_ids assigned to every precinct.
         -allowed_deviation (int): Largest allowable difference between the 
         population of the most populous district and the population of the 
         least populous district.
         -plot_each_step (boolean): if True, tells program to export a map
         of each iteration of mapwide_pop_swap(), to check for district 
-        fragmentation and/or inspect progress or cycles visually.
+        fragmentation and/or inspect progress or cycles visually (see 
+        map_plot.step_renderer). Requires df to be the state DataFrame from
+        load_state, not a Partition.
         -stop_after (int): manual number of steps to stop after if procedure
         hasn't yet terminated.
+        -checkpoint_path (str): if given, saves a checkpoint (see 
+        checkpoint.py) to this file after every swap cycle
+        -resume (boolean): if True, picks up from the checkpoint at 
+        checkpoint_path instead of starting over. See resume_pop_swap.
 
     Returns: None, modifies df in place
     '''
+    inst = get_instrument()
     count = 0
 
     pop_devs_so_far = []
-    while population_deviation(df) >= allowed_deviation:
-        #check whether method is repeatedly swapping same districts back & forth
-        if len(pop_devs_so_far) > 5 and pop_devs_so_far[-4:-2] == pop_devs_so_far[-2::]:
-            print("It looks like this swapping process is trapped in a cycle. Stopping")
-            break
-        count += 1
-        if count > stop_after:
-            print(f"You've now swapped {count-1} times. Stopping")
-            break
-        print(f"Now doing swap cycle #{count}...")
-        pop_devs_so_far.append(population_deviation(df))
-        mapwide_pop_swap(df, allowed_deviation)
-        if plot_each_step:
-            plot_dissolved_map(df, "test")
-        dist_pops = district_pops(df)
-        print(f"The most and least populous district differ by: {population_deviation(df)}")
-    if population_deviation(df) <= allowed_deviation:
-        print("You've reached your population balance target. Hooray!")
+    if not resume:
+        part = as_partition(df)
+    else:
+        saved = load_checkpoint(checkpoint_path)
+        part = as_partition(df, num_districts=int(saved['assignment'].max()))
+        part.assignment[:] = saved['assignment']
+        part.recount()
+        count = saved['counters']['count']
+        pop_devs_so_far = saved['history']
+        inst.event('resume', f"Resuming from swap cycle #{count}", cycle=count)
+    job = {'function': 'repeated_pop_swap', 'allowed_deviation': allowed_deviation,
+           'stop_after': stop_after}
+    renderer = None
+    if plot_each_step:
+        renderer = step_renderer(df)
+        plot_prefix = 'redistricting_redux/maps/test_' + datetime.now().strftime("%m%d-%H%M%S")
+
+    try:
+        while population_deviation(part) >= allowed_deviation:
+            #check whether method is repeatedly swapping same districts back & forth
+            if len(pop_devs_so_far) > 5 and pop_devs_so_far[-4:-2] == pop_devs_so_far[-2::]:
+                inst.event('stop', "It looks like this swapping process is trapped in a cycle. Stopping",
+                           reason='cycle')
+                break
+            count += 1
+            if count > stop_after:
+                inst.event('stop', f"You've now swapped {count-1} times. Stopping",
+                           reason='stop_after')
+                break
+            inst.event('swap_cycle', f"Now doing swap cycle #{count}...", cycle=count)
+            inst.count('swap_cycles')
+            pop_devs_so_far.append(population_deviation(part))
+            mapwide_pop_swap(part, allowed_deviation)
+            if plot_each_step:
+                renderer.render(part.assignment, f"{plot_prefix}_swap_{count:02d}.png",
+                                title=f"After swap cycle #{count}")
+            if checkpoint_path is not None:
+                save_checkpoint(checkpoint_path, part.assignment, job,
+                                counters={'count': count}, history=pop_devs_so_far)
+            deviation = population_deviation(part)
+            inst.record('deviation', deviation)
+            inst.event('deviation', f"The most and least populous district differ by: {deviation}",
+                       cycle=count, deviation=deviation)
+    finally:
+        if renderer is not None:
+            renderer.close()
+    sync_partition(df, part)
+    if population_deviation(part) <= allowed_deviation:
+        inst.event('balanced', "You've reached your population balance target. Hooray!")
+
+
+def resume_pop_swap(df, checkpoint_path, plot_each_step=False):
+    '''
+    Picks a repeated_pop_swap run back up from its last checkpoint, with the
+    same allowed_deviation and stop_after it was started with.
+
+    Inputs:
+        -df (geopandas GeoDataFrame or Partition): the same state-level 
+        precinct/VTD data the run was started on
+        -checkpoint_path (str): checkpoint file the run was saving to
+        -plot_each_step (boolean): as in repeated_pop_swap
+
+    Returns: None, modifies df in place
+    '''
+    job = load_checkpoint(checkpoint_path)['job']
+    repeated_pop_swap(df, allowed_deviation=job['allowed_deviation'],
+                      plot_each_step=plot_each_step, stop_after=job['stop_after'],
+                      checkpoint_path=checkpoint_path, resume=True)
 
 
 def find_neighboring_districts(df, lst, include_None=True):
     '''
-    Takes in a list of precinct names, and outputs a set of all districts 
+    Takes in a list of precincts, and outputs a set of all districts 
     those precincts have been drawn into.
 
     Inputs:
-        -df: geopandas GeoDataFrame
-        -lst (NumPy array): list of neighbors, as found by calling
-         df['neighbors']
+        -df: geopandas GeoDataFrame or Partition
+        -lst (NumPy array): list of neighbors, either as row positions (as 
+        found by calling df['neighbor_idx']) or as GEOID20s (as found by 
+        calling df['neighbors']). Row positions are much faster.
         -include_None (boolean): Determines whether the returned set includes
         None if some neighbors aren't drawn into districts.
 
     Returns (set): set of dist_ids
     '''
-    #multiindexing suggested by: Cole von Glahn
-    #Code inspired by: https://stackoverflow.com/questions/12096252/use-a-list-of-values-to-select-rows-from-a-pandas-dataframe
-    dists_theyre_in = set(df[df['GEOID20'].isin(lst)].dist_id)
+    if isinstance(df, Partition):
+        dists_theyre_in = {int(id) if id != 0 else None for id in df.assignment[lst]}
+    elif np.issubdtype(np.asarray(lst).dtype, np.integer):
+        dists_theyre_in = set(df['dist_id'].to_numpy()[lst])
+    else:
+        #multiindexing suggested by: Cole von Glahn
+        #Code inspired by: https://stackoverflow.com/questions/12096252/use-a-list-of-values-to-select-rows-from-a-pandas-dataframe
+        dists_theyre_in = set(df[df['GEOID20'].isin(lst)].dist_id)
     
     if include_None:
         return dists_theyre_in
@@ -312,7 +446,7 @@ def smallest_neighbor_district(df, neighbor_districts):
     Seeing about refactoring some code.
 
     Inputs:
-        -df (geopandas GeoDataFrame): State data by precinct/VTD
+        -df (geopandas GeoDataFrame or Partition): State data by precinct/VTD
         -precinct (str): GEOID20 field of precinct
     Returns (int): dist_id
     '''
@@ -321,26 +455,119 @@ def smallest_neighbor_district(df, neighbor_districts):
     return smallest_neighbor
 
 
-def recapture_orphan_precincts(df, idx):
+@timed
+def recapture_orphan_precincts(df, idx=None):
     '''
     Finds precincts that are entirely disconnected from the bulk of their 
-    district and reassigns them to a surrounding district. This is slow.
+    district and reassigns them to a surrounding district. Not needed after
+    mapwide_pop_swap, which doesn't create orphans.
 
     Inputs:
-        -df (geopandas GeoDataFrame): state level precinct/VTD data. Should
-        have dist_id assigned for every precinct.
-        -idx (dict): idx object created for earlier use of itertuples in
-        mapwide_pop_swap
+        -df (geopandas GeoDataFrame or Partition): state level precinct/VTD 
+        data. Should have dist_id assigned for every precinct.
+        -idx (dict): no longer used (precincts are looked up by row position
+        now); kept so older calls still work
 
     Returns: None, modifies df in-place 
     '''
-    for row in df.itertuples():
-        neighboring_districts = find_neighboring_districts(df, row[idx['neighbors']])
-        if row[idx['dist_id']] not in neighboring_districts: 
-            draw_into_district(df, row[idx['GEOID20']], smallest_neighbor_district(df, neighboring_districts))
+    part = as_partition(df)
+    #an orphan has neighbors, but none in its own district (and unassigned
+    #precincts count as having no district)
+    src, dst = part.edges()
+    same_district = np.bincount(src, weights=((part.assignment[src] == part.assignment[dst])
+                                              & (part.assignment[src] != 0)),
+                                minlength=len(part))
+    orphans = np.flatnonzero((np.diff(part.indptr) > 0) & (same_district == 0)).tolist()
+    #only orphans, and precincts further down whose neighbors got reassigned,
+    #can be recaptured, so check just those, in the same row order as a scan
+    #of every precinct would
+    heapq.heapify(orphans)
+    checked = -1
+    while orphans:
+        precinct = heapq.heappop(orphans)
+        if precinct <= checked:
+            continue
+        checked = precinct
+        neighboring_districts = find_neighboring_districts(part, part.neighbors(precinct))
+        if len(neighboring_districts) > 0 and part.assignment[precinct] not in neighboring_districts: 
+            part.assign(precinct, smallest_neighbor_district(part, neighboring_districts))
+            get_instrument().count('orphans_recaptured')
+            for nabe in part.neighbors(precinct).tolist():
+                if nabe > precinct:
+                    heapq.heappush(orphans, nabe)
+    sync_partition(df, part)
+
+
+def district_totals(df, partition=None):
+    '''
+    Adds up every numeric column of a precinct-level map by district, with one
+    np.bincount pass over the district assignment per column instead of a
+    polygon dissolve. Gives the same numbers as dissolve_map, without shapes.
+
+    Inputs:
+        -df (geopandas GeoDataFrame or pandas DataFrame): state preinct/VTD-level
+        data. Polygons aren't needed.
+        -partition (Partition): if given, the district assignment to add up
+        by, in place of df's own dist_id column
+
+    Returns (pandas DataFrame): state district-level data indexed by dist_id,
+    with raw_margin and point_swing columns as in dissolve_map
+    '''
+    if partition is not None:
+        assignment = partition.assignment
+    else:
+        assignment = df_assignment(df)
+    bins = int(assignment.max()) + 1
+    drawn = np.bincount(assignment, minlength=bins)[1:] > 0
+
+    totals = {}
+    for col in df.select_dtypes('number').columns.drop('dist_id', errors='ignore'):
+        values = df[col].to_numpy()
+        sums = np.bincount(assignment, weights=values, minlength=bins)[1:][drawn]
+        if np.issubdtype(values.dtype, np.integer):
+            sums = sums.round().astype(np.int64)
+        totals[col] = sums
+    df_dists = pd.DataFrame(totals, index=pd.Index(np.flatnonzero(drawn) + 1, name='dist_id'))
+
+    #may cause ZeroDivisionError in the edge case where a district is exactly tied
+    df_dists['raw_margin'] = (df_dists["G20PREDBID"] - df_dists["G20PRERTRU"]) / (df_dists["G20PREDBID"] + df_dists["G20PRERTRU"])
+    df_dists['point_swing'] = round(df_dists['raw_margin']*100, 2)
+
+    return df_dists
+
+
+def add_district_shapes(df_dists, df, partition=None):
+    '''
+    Dissolves precinct polygons into district polygons for a table of
+    district totals from district_totals. Only the geometry is dissolved; the
+    numbers are left as they are. Call this only when the shapes are needed,
+    e.g. right before plot_dissolved_map.
 
+    Inputs:
+        -df_dists (pandas DataFrame): district-level data from district_totals
+        -df (geopandas GeoDataFrame): state preinct/VTD-level data, with 
+        polygons (loaded now if the state was loaded without them)
+        -partition (Partition): as passed to district_totals, if any
 
-def dissolve_map(df):
+    Returns (geopandas GeoDataFrame): df_dists with geometry and center columns
+    '''
+    if partition is not None:
+        assignment = partition.assignment
+    else:
+        assignment = df_assignment(df)
+    drawn = assignment > 0
+    geoms = state_geometry(df)
+    shapes = gpd.GeoDataFrame({'dist_id': assignment[drawn]},
+                              geometry=geoms.to_numpy()[drawn], crs=geoms.crs
+                              ).dissolve(by='dist_id')
+    df_dists = gpd.GeoDataFrame(df_dists, geometry=shapes.geometry.reindex(df_dists.index),
+                                crs=geoms.crs)
+    df_dists['center'] = df_dists['geometry'].centroid #these points have a .x and .y attribute
+    return df_dists
+
+
+@timed
+def dissolve_map(df, partition=None, geometry=True):
     '''
     Dissolves a precinct-level map into districts. To be used only after
     district assignment is finalized (i.e. after any population balancing
@@ -349,17 +576,18 @@ def dissolve_map(df):
     Inputs:
         -df (geopandas GeoDataFrame): state preinct/VTD-level data, with 
         polygons. 
+        -partition (Partition): if given, the district assignment to dissolve
+        by, in place of df's own dist_id column (df is not modified)
+        -geometry (boolean): if False, only adds up the numbers (see
+        district_totals) and skips the slow polygon union. Shapes can be
+        added later with add_district_shapes.
     
     Returns (geopandas GeoDataFrame): state district-level data, by custom
-    disttricts we drew.
+    disttricts we drew. (A plain pandas DataFrame if geometry is False.)
     '''
-    df_dists = df.dissolve(by='dist_id', aggfunc=sum)
-    df_dists.reset_index(drop=True)
-
-    #may cause ZeroDivisionError in the edge case where a district is exactly tied
-    df_dists['raw_margin'] = (df_dists["G20PREDBID"] - df_dists["G20PRERTRU"]) / (df_dists["G20PREDBID"] + df_dists["G20PRERTRU"])
-    df_dists['center'] = df_dists['geometry'].centroid #these points have a .x and .y attribute
-    df_dists['point_swing'] = round(df_dists['raw_margin']*100, 2)
+    df_dists = district_totals(df, partition)
+    if geometry:
+        df_dists = add_district_shapes(df_dists, df, partition)
 
     return df_dists
 
@@ -408,11 +636,13 @@ def district_pops(df):
     Outputs the population of each district drawn so far.
 
     Inputs:
-        -df (geopandas GeoDataFrame): state data by precinct/VTD
+        -df (geopandas GeoDataFrame or Partition): state data by precinct/VTD
     
     Returns (dict): dictionary with dist_ids as keys and population totals
     as values
     '''
+    if isinstance(df, Partition):
+        return df.district_pops()
     pops_dict = {}
     for i in range(1, max([id for id in df.dist_id if id is not None])+1):
         pops_dict[i] = population_sum(df, district=i)
@@ -0,0 +1,221 @@
+'''
+Ensembles: drawing many random maps of one state, optionally across a pool
+of worker processes.
+
+Every plan gets its own random number generator, seeded from the pair
+(seed, plan index), so plan number i is the same no matter how many workers
+there are or which worker draws it. Each worker loads the state once and
+then draws plans from a copy of the same Partition.
+'''
+import io
+import os
+import json
+import random
+import contextlib
+import numpy as np
+from multiprocessing import Pool
+from load_state_data import load_state_arrays
+from partition import Partition
+from draw_random_maps import draw_dart_throw_map
+from bfs_seed import draw_bfs_seed_map
+from priority_swap import priority_pop_swap
+from recom import draw_recom_map
+from ensemble_io import EnsembleWriter, plan_summary, iter_shards
+from instrument import instrumented
+
+METHODS = ('recom', 'dart', 'bfs')
+
+#set in each worker process by init_worker
+_state_part = None
+
+
+def plan_seed(seed, plan_index):
+    '''
+    Derives an independent seed for one plan of an ensemble.
+
+    Inputs:
+        -seed (int): seed of the whole ensemble
+        -plan_index (int): which plan of the ensemble
+
+    Returns (int): seed for that plan's random number generator
+    '''
+    return int(np.random.SeedSequence([seed, plan_index]).generate_state(1)[0])
+
+
+def init_worker(state_postal, num_districts):
+    '''
+    Loads a state once per worker process, keeping only what map drawing
+    needs (the Partition arrays, not the GeoDataFrame). The arrays are
+    memory-mapped from the state's bundle cache, so workers share one copy.
+
+    Inputs:
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+        -num_districts (int): Number of districts to draw
+
+    Returns: None, sets a module-level variable
+    '''
+    global _state_part
+    with contextlib.redirect_stdout(io.StringIO()):
+        arrays = load_state_arrays(state_postal, ['GEOID20', 'POP100', 'G20PREDBID',
+                                                  'G20PRERTRU'])
+    _state_part = Partition(arrays['indptr'], arrays['indices'], arrays['POP100'],
+                            num_districts, dem=arrays['G20PREDBID'],
+                            rep=arrays['G20PRERTRU'], geoids=arrays['GEOID20'])
+
+
+def draw_plan(args):
+    '''
+    Draws one plan of an ensemble in the current worker.
+
+    Inputs:
+        -args (tuple): (plan_index, seed, method, allowed_deviation,
+        recom_steps), as set up by generate_ensemble
+
+    Returns (tuple): plan_index, the plan's assignment (NumPy int16 array
+    of dist_ids by row position), and its per-district summary (see
+    ensemble_io.plan_summary)
+    '''
+    plan_index, seed, method, allowed_deviation, recom_steps = args
+    part = _state_part.copy()
+    rng = random.Random(plan_seed(seed, plan_index))
+    with instrumented('silent'):
+        if method == 'recom':
+            draw_recom_map(part, part.num_districts, steps=recom_steps,
+                           allowed_deviation=allowed_deviation, seed=rng)
+        elif method == 'bfs':
+            draw_bfs_seed_map(part, part.num_districts, seed=rng)
+            priority_pop_swap(part, allowed_deviation=allowed_deviation)
+        else:
+            draw_dart_throw_map(part, part.num_districts, seed=rng)
+            priority_pop_swap(part, allowed_deviation=allowed_deviation)
+    return plan_index, part.assignment.astype(np.int16), plan_summary(part)
+
+
+def generate_ensemble(state_postal, num_districts, num_plans, seed=2023, workers=1,
+                      method='recom', allowed_deviation=70000, recom_steps=100,
+                      plan_indices=None):
+    '''
+    Draws an ensemble of random maps for a state, yielding each plan as soon
+    as it (and every plan before it) is done.
+
+    Inputs:
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+        -num_districts (int): Number of districts to draw
+        -num_plans (int): Number of plans to draw
+        -seed (int): Seed of the whole ensemble, for replicability
+        -workers (int): Number of worker processes. 1 draws every plan in
+        this process.
+        -method (str): 'recom' (recursive_tree_partition plus recom_steps
+        ReCom steps), 'dart' (draw_dart_throw_map plus priority_pop_swap) or
+        'bfs' (draw_bfs_seed_map plus priority_pop_swap)
+        -allowed_deviation (int): Largest allowable difference between the
+        population of the most populous district and the population of the
+        least populous district.
+        -recom_steps (int): ReCom steps per plan, for method 'recom'
+        -plan_indices (iterable of ints): which plans to draw. Defaults to
+        all of range(num_plans)
+
+    Yields (tuple): plan_index, assignment and summary of each plan, in
+    plan order (see draw_plan)
+    '''
+    assert method in METHODS, f"method must be one of {METHODS}"
+    if plan_indices is None:
+        plan_indices = range(num_plans)
+    tasks = ((i, seed, method, allowed_deviation, recom_steps) for i in plan_indices)
+
+    if workers <= 1:
+        init_worker(state_postal, num_districts)
+        for task in tasks:
+            yield draw_plan(task)
+    else:
+        with Pool(workers, initializer=init_worker,
+                  initargs=(state_postal, num_districts)) as pool:
+            yield from pool.imap(draw_plan, tasks)
+
+
+def run_ensemble(state_postal, num_districts, num_plans, seed=2023, workers=1,
+                 method='recom', allowed_deviation=70000, recom_steps=100):
+    '''
+    Draws an ensemble of random maps for a state and collects them in
+    memory. Takes the same inputs as generate_ensemble. For large ensembles,
+    use write_ensemble instead.
+
+    Returns (NumPy int16 array): one row per plan, with the dist_id of
+    every precinct by row position (no rows if num_plans is 0)
+    '''
+    plans = [assignment for _, assignment, _ in
+             generate_ensemble(state_postal, num_districts, num_plans, seed, workers,
+                               method, allowed_deviation, recom_steps)]
+    if not plans:
+        num_precincts = len(load_state_arrays(state_postal, [])['indptr']) - 1
+        return np.zeros((0, num_precincts), dtype=np.int16)
+    return np.vstack(plans)
+
+
+def write_ensemble(directory, state_postal, num_districts, num_plans, seed=2023,
+                   workers=1, method='recom', allowed_deviation=70000,
+                   recom_steps=100, shard_size=1000):
+    '''
+    Draws an ensemble of random maps for a state and streams each plan to
+    shards in directory as it finishes (see ensemble_io), so memory use stays
+    the same however many plans are drawn. Takes the same inputs as
+    generate_ensemble, plus:
+        -directory (str): ensemble directory to write to
+        -shard_size (int): number of plans per shard
+
+    Returns: None, writes files. The arguments are saved to job.json in
+    directory so an interrupted run can be finished with resume_ensemble.
+    '''
+    job = {'state_postal': state_postal, 'num_districts': num_districts,
+           'num_plans': num_plans, 'seed': seed, 'method': method,
+           'allowed_deviation': allowed_deviation, 'recom_steps': recom_steps,
+           'shard_size': shard_size}
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'job.json'), 'w') as f:
+        json.dump(job, f)
+    write_plans(directory, job, range(num_plans), workers)
+
+
+def write_plans(directory, job, plan_indices, workers=1):
+    '''
+    Draws the given plans of an ensemble and appends them to its directory.
+
+    Inputs:
+        -directory (str): ensemble directory to write to
+        -job (dict): arguments of the ensemble, as saved in job.json
+        -plan_indices (iterable of ints): which plans to draw
+        -workers (int): Number of worker processes
+
+    Returns: None, writes files
+    '''
+    with EnsembleWriter(directory, job['shard_size']) as writer:
+        for plan_index, assignment, summary in generate_ensemble(
+                job['state_postal'], job['num_districts'], job['num_plans'],
+                job['seed'], workers, job['method'], job['allowed_deviation'],
+                job['recom_steps'], plan_indices):
+            writer.append(plan_index, assignment, summary)
+
+
+def resume_ensemble(directory, workers=1):
+    '''
+    Finishes an ensemble that write_ensemble didn't get to the end of,
+    drawing only the plans missing from its complete shards. Since every
+    plan's seed comes from its plan index, the finished ensemble is the same
+    as one drawn without interruption (only the shard boundaries differ).
+
+    Inputs:
+        -directory (str): ensemble directory written by write_ensemble
+        -workers (int): Number of worker processes
+
+    Returns: None, writes files
+    '''
+    with open(os.path.join(directory, 'job.json')) as f:
+        job = json.load(f)
+    done = set()
+    for shard in iter_shards(directory, ['plan_index']):
+        done.update(shard['plan_index'].tolist())
+    remaining = [i for i in range(job['num_plans']) if i not in done]
+    print(f"{len(done)} plans already drawn, {len(remaining)} to go")
+    write_plans(directory, job, remaining, workers)
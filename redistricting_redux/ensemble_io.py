@@ -0,0 +1,186 @@
+'''
+Streaming storage for ensembles of plans.
+
+Plans are written as they finish, in shards of (by default) 1000 plans, so
+memory use doesn't grow with the size of the ensemble. Each shard is a
+directory of .npy files, one per column:
+    plan_index      (plans,)                which plan of the ensemble
+    assignment      (plans, precincts)      dist_id of each precinct
+    POP100          (plans, districts)      population of each district
+    G20PREDBID      (plans, districts)      Biden votes in each district
+    G20PRERTRU      (plans, districts)      Trump votes in each district
+    margin          (plans, districts)      two-way margin, as raw_margin in
+                                            dissolve_map
+Column k of the per-district arrays is district k+1.
+
+Shards are written under a temporary name and renamed when complete, so an
+ensemble directory only ever gains whole shards, and readers never see a
+half-written one. The .npy files can be memory-mapped when read.
+'''
+import os
+import numpy as np
+
+SUMMARY_COLUMNS = ('POP100', 'G20PREDBID', 'G20PRERTRU', 'margin')
+
+
+def plan_summary(part):
+    '''
+    Per-district summary of a finished plan, from the running totals of its
+    Partition.
+
+    Inputs:
+        -part (Partition)
+
+    Returns (dict): NumPy arrays of POP100, G20PREDBID, G20PRERTRU and margin
+    for districts 1 through num_districts
+    '''
+    dem = part.dist_dem[1:].copy()
+    rep = part.dist_rep[1:].copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        margin = (dem - rep) / (dem + rep)
+    return {'POP100': part.dist_pop[1:].copy(), 'G20PREDBID': dem,
+            'G20PRERTRU': rep, 'margin': margin}
+
+
+def shard_paths(directory):
+    '''
+    Lists the complete shards in an ensemble directory, in order.
+
+    Inputs:
+        -directory (str): ensemble directory
+
+    Returns (list of str): paths of shard directories
+    '''
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.startswith('shard_') and not name.endswith('.tmp')]
+
+
+class EnsembleWriter:
+    '''
+    Appends plans to an ensemble directory, one shard at a time. New shards
+    are numbered after any already in the directory. Use as a context
+    manager, or call close() when done so the last partial shard is written.
+
+    Inputs:
+        -directory (str): ensemble directory (created if needed)
+        -shard_size (int): number of plans per shard
+    '''
+    def __init__(self, directory, shard_size=1000):
+        self.directory = directory
+        self.shard_size = shard_size
+        os.makedirs(directory, exist_ok=True)
+        existing = [int(os.path.basename(path)[len('shard_'):])
+                    for path in shard_paths(directory)]
+        self.next_shard = max(existing, default=-1) + 1
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, plan_index, assignment, summary):
+        '''
+        Adds one plan. Writes a shard whenever shard_size plans are buffered.
+
+        Inputs:
+            -plan_index (int): which plan of the ensemble
+            -assignment (NumPy int array): dist_id of each precinct
+            -summary (dict): per-district arrays, as from plan_summary
+
+        Returns: None
+        '''
+        self.buffer.append((plan_index, assignment, summary))
+        if len(self.buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes buffered plans out as a new shard.
+        '''
+        if not self.buffer:
+            return
+        name = os.path.join(self.directory, f"shard_{self.next_shard:05d}")
+        os.makedirs(name + '.tmp', exist_ok=True)
+        columns = {'plan_index': np.array([plan[0] for plan in self.buffer], dtype=np.int64),
+                   'assignment': np.vstack([plan[1] for plan in self.buffer])}
+        for col in SUMMARY_COLUMNS:
+            columns[col] = np.vstack([plan[2][col] for plan in self.buffer])
+        for col, values in columns.items():
+            np.save(os.path.join(name + '.tmp', f"{col}.npy"), values)
+        os.rename(name + '.tmp', name)
+        self.next_shard += 1
+        self.buffer = []
+
+    def close(self):
+        '''
+        Writes any plans still buffered.
+        '''
+        self.flush()
+
+
+def read_shard(shard_path, columns=None, mmap=True):
+    '''
+    Reads one shard.
+
+    Inputs:
+        -shard_path (str): path of a shard directory
+        -columns (list of str): which columns to read. Defaults to all
+        -mmap (boolean): if True, memory-map the arrays instead of reading
+        them into memory
+
+    Returns (dict): column name -> NumPy array
+    '''
+    if columns is None:
+        columns = ('plan_index', 'assignment') + SUMMARY_COLUMNS
+    mmap_mode = 'r' if mmap else None
+    return {col: np.load(os.path.join(shard_path, f"{col}.npy"), mmap_mode=mmap_mode)
+            for col in columns}
+
+
+def iter_shards(directory, columns=None, mmap=True):
+    '''
+    Reads the shards of an ensemble directory one at a time.
+
+    Inputs:
+        -directory (str): ensemble directory
+        -columns, mmap: as in read_shard
+
+    Yields (dict): column name -> NumPy array, for each shard
+    '''
+    for path in shard_paths(directory):
+        yield read_shard(path, columns, mmap)
+
+
+def iter_plans(directory, mmap=True):
+    '''
+    Reads the plans of an ensemble directory one at a time.
+
+    Inputs:
+        -directory (str): ensemble directory
+        -mmap (boolean): as in read_shard
+
+    Yields (tuple): plan_index, assignment, and a dict of per-district
+    summary arrays
+    '''
+    for shard in iter_shards(directory, mmap=mmap):
+        for row, plan_index in enumerate(shard['plan_index']):
+            summary = {col: shard[col][row] for col in SUMMARY_COLUMNS}
+            yield int(plan_index), shard['assignment'][row], summary
+
+
+def load_column(directory, column):
+    '''
+    Reads one column of every shard into a single array, e.g. 'margin' to
+    look at the distribution of district margins across the ensemble.
+
+    Inputs:
+        -directory (str): ensemble directory
+        -column (str): column name
+
+    Returns (NumPy array): the column for every plan, in shard order
+    '''
+    return np.concatenate([shard[column] for shard in iter_shards(directory, [column])])
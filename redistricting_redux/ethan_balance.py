@@ -11,8 +11,11 @@ import re
 import time
 from datetime import datetime
 import matplotlib as plt
-from stats import population_sum, blue_red_margin, target_dist_pop, metric_area, population_density, set_blue_red_diff #not sure i did this relative directory right
+from stats import population_sum, blue_red_margin, target_dist_pop, set_blue_red_diff #not sure i did this relative directory right
 from draw_random_maps import * #i know this is bad practice but idk where he used it and not
+from checkpoint import save_checkpoint, load_checkpoint, df_assignment, restore_df_assignment
+from partition import as_partition, sync_partition
+from instrument import get_instrument, timed
 
 run = 0
 run_dict = {}
@@ -23,106 +26,138 @@ run_dict = {}
 import warnings
 warnings.filterwarnings("ignore")
 
-def batch_balance_transfer(df, neighbor_dict=None, run=run, run_dict=run_dict, allowed_deviation=70000):
+def district_adjacency(part, src, dst):
+    '''
+    Counts the edges between every pair of districts.
+
+    Inputs:
+        -part (Partition): map with every precinct assigned
+        -src, dst (NumPy int arrays): edge list of precinct row positions
+
+    Returns (NumPy int array): (num_districts + 1) x (num_districts + 1)
+    matrix; entry [a, b] is the number of edges from a precinct in district a
+    to a precinct in district b
+    '''
+    bins = part.num_districts + 1
+    keys = part.assignment[src].astype(np.int64) * bins + part.assignment[dst]
+    return np.bincount(keys, minlength=bins * bins).reshape(bins, bins)
+
+
+@timed
+def batch_balance_transfer(df, neighbor_dict=None, run=run, run_dict=run_dict, allowed_deviation=70000,
+                           checkpoint_path=None, resume=False, stop_after=None):
     '''
     Identifies the border between the smallest population and its largest
     neighbor and trade all precincts on that border from the larger district
     to the smaller district. This is a heavy-handed approach, but
     it does a lot of balancing before a slower, more careful approach is needed.
 
+    Works on a Partition: each transfer recounts a district-to-district
+    adjacency matrix to find the smallest district's neighbors, and finds the
+    border precincts with one mask over the edge list, instead of looking up
+    each neighbor's dist_id in the GeoDataFrame.
+
     Inputs:
-        -df (geopandas GeoDataFrame): state data by precinct/VTD. Every precinct 
-        should have a dist_id assigned before calling this function.
+        -df (geopandas GeoDataFrame or Partition): state data by precinct/VTD.
+        Every precinct should have a dist_id assigned before calling this
+        function.
         -allowed_deviation (int): Largest allowable difference between the 
         population of the most populous district and the population of the 
         least populous district.
+        -checkpoint_path (str): if given, saves a checkpoint (see 
+        checkpoint.py) to this file after every transfer
+        -resume (boolean): if True, picks up from the checkpoint at 
+        checkpoint_path instead of starting over. See resume_balance_transfer.
+        -stop_after (int): if given, stop after this many transfers even if
+        populations aren't balanced yet
     
     Returns: none, modifies df in-place.
     '''
-    neighbor_dict = {
-        id: n for (id, n) in zip(df.GEOID20, df.neighbors)
-    }
-
-    df_trade = pd.DataFrame(df)
-    df_trade_pop = district_pops(df) #swapping in preexisting function
-    #df_trade_pop = df_trade.groupby('dist_id').sum()[['POP100']].reset_index()
+    inst = get_instrument()
     recent_transfer = []
-    while (population_deviation(df_trade) > allowed_deviation):
-    #while (df_trade_pop.POP100.max() - df_trade_pop.POP100.min()) > allowed_deviation:
+    if not resume:
+        part = as_partition(df)
+    else:
+        saved = load_checkpoint(checkpoint_path)
+        part = as_partition(df, num_districts=int(saved['assignment'].max()))
+        part.assignment[:] = saved['assignment']
+        part.recount()
+        run = saved['counters']['run']
+        run_dict.update({r: dev for r, dev in saved['history']})
+        row_of = {geoid: i for i, geoid in enumerate(part.geoids)}
+        recent_transfer = [np.array([row_of[geoid] for geoid in eligible], dtype=np.int64)
+                           for eligible in saved['extra']['recent_transfer']]
+        inst.event('resume', f"Resuming from transfer #{run}", transfer=run)
+    job = {'function': 'batch_balance_transfer', 'allowed_deviation': allowed_deviation}
+
+    #neighbors with 22-character GEOID20s were always skipped here (why?)
+    src, dst = part.edges()
+    if part.geoids is not None:
+        counted = np.char.str_len(part.geoids.astype(str)) != 22
+        src, dst = src[counted[dst]], dst[counted[dst]]
+
+    while part.population_deviation() > allowed_deviation:
     #small districts take
-        df_trade = pd.DataFrame(df)
-        df_trade_pop = district_pops(df)
-        #df_trade_pop = df_trade.groupby('dist_id').sum()[['POP100']].reset_index()
-        print(df_trade_pop)
-
-        smallest = {k:v for k,v in df_trade_pop.items() if v == min(df_trade_pop.values())}
-        #smallest = df_trade_pop[df_trade_pop.POP100 == min(df_trade_pop.POP100)]
-
-        df_rec = df[df.dist_id == min(smallest.keys())]
-        #df_rec = df[df.dist_id == smallest.dist_id.item()]
-
-        dist_nabes = []
-        nabe_other_dist = []
-        for prec in df_rec['GEOID20']:
-            nabes = neighbor_dict[prec]
-            for n in nabes:
-                if len(n) != 22: #why is this here?
-                    dist = df[df.GEOID20 == n].dist_id.item()
-                    if dist != min(smallest.keys()):
-                        dist_nabes.append(dist)
-                    
-                    nabe_other_dist.append(n)
-
-
-        dist_set = set(dist_nabes)
-
-        neighbor_pop_dict = {}
-        for i in dist_set:
-            pop = df_trade_pop[i]
-            #pop = df_trade_pop[df_trade_pop.dist_id == i]["POP100"].item()
-            #pop = df_district_pop[df_district_pop.dist_id == i]["POP100"].item()
-            neighbor_pop_dict[i] = pop
-
-        max = 0
+        dist_pops = part.district_pops()
+        inst.event('district_pops', f"{dist_pops}", district_pops=dist_pops)
+        #ties go to the lowest dist_id
+        smallest = int(np.argmin(part.dist_pop[1:])) + 1
+
+        #the largest district bordering the smallest one (if any is larger)
+        bordering = np.flatnonzero(district_adjacency(part, src, dst)[smallest])
+        bordering = bordering[(bordering != 0) & (bordering != smallest)]
         comp_district = None
-
-        for k,v in neighbor_pop_dict.items():
-            diff = abs(min(smallest.values()) - v)
-            #diff = abs(smallest.POP100.item() - v)
-            if diff > max:
-                comp_district = k
-                max = diff
-
-
-        eligible = [
-            nabe for nabe in nabe_other_dist if df[
-                df.GEOID20 == nabe
-            ].dist_id.item() == comp_district]
+        if len(bordering) > 0:
+            largest = bordering[np.argmax(part.dist_pop[bordering])]
+            if part.dist_pop[largest] > part.dist_pop[smallest]:
+                comp_district = largest
+
+        #every precinct of comp_district across an edge from smallest, once
+        #per edge, in row order of the smallest district's precincts
+        if comp_district is None:
+            eligible = dst[:0]
+        else:
+            on_border = (part.assignment[src] == smallest) & (part.assignment[dst] == comp_district)
+            eligible = dst[on_border]
 
         recent_transfer.append(eligible)
-        
-        df.loc[df['GEOID20'].isin(eligible), 'dist_id'] = min(smallest.keys())
-        print(population_deviation(df_trade))
-        #print(df_trade_pop.POP100.max() - df_trade_pop.POP100.min())
+
+        transferred = np.unique(eligible)
+        part.assign_many(transferred, np.full(len(transferred), smallest))
+        inst.count('precincts_moved', len(eligible))
+        inst.event('deviation', f"{part.population_deviation()}")
 
         if len(recent_transfer) > 4:
             recent_transfer.pop(0)
-            if (recent_transfer[0] == recent_transfer[2]) and recent_transfer[1] == recent_transfer[3]:
+            if (np.array_equal(recent_transfer[0], recent_transfer[2])
+                and np.array_equal(recent_transfer[1], recent_transfer[3])):
                 break 
             
-        idx = {name: i for i, name in enumerate(list(df), start=1)}
-        recapture_orphan_precincts(df, idx)
+        recapture_orphan_precincts(part)
         run+=1
-        run_dict[run] = (population_deviation(df_trade))
-        print(run, run_dict)
-        #run_dict[run] = df_trade_pop.POP100.max() - df_trade_pop.POP100.min()
-
-def single_balance_transfer(df, neighbor_dict=None, run=run, run_dict=run_dict, allowed_deviation=70000):
+        run_dict[run] = part.population_deviation()
+        inst.count('transfers')
+        inst.record('deviation', run_dict[run])
+        inst.event('transfer', f"{run} {run_dict}", transfer=run, deviation=run_dict[run])
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, part.assignment, job, 
+                            counters={'run': run}, history=list(run_dict.items()),
+                            extra={'recent_transfer': [part.geoids[eligible].tolist()
+                                                       for eligible in recent_transfer]})
+        if stop_after is not None and run >= stop_after:
+            break
+    sync_partition(df, part)
+
+@timed
+def single_balance_transfer(df, neighbor_dict=None, run=run, run_dict=run_dict, allowed_deviation=70000,
+                            checkpoint_path=None, resume=False):
     '''
     Identifies the border between the smallest population and its largest
     neighbor and trade all precincts on that border from the larger district
     to the smaller district. This is a heavy-handed approach, but
     it does a lot of balancing before a slower, more careful approach is needed.
+    (fm_refine.fm_pop_swap does the careful, one-precinct-at-a-time part
+    without relying on second choices to break out of trading loops.)
 
     Inputs:
         -df (geopandas GeoDataFrame): state data by precinct/VTD. Every precinct 
@@ -130,22 +165,39 @@ def single_balance_transfer(df, neighbor_dict=None, run=run, run_dict=run_dict,
         -allowed_deviation (int): Largest allowable difference between the 
         population of the most populous district and the population of the 
         least populous district.
+        -checkpoint_path (str): if given, saves a checkpoint (see 
+        checkpoint.py) to this file after every transfer
+        -resume (boolean): if True, picks up from the checkpoint at 
+        checkpoint_path instead of starting over. See resume_balance_transfer.
     
     Returns: none, modifies df in-place.
     '''
+    inst = get_instrument()
     neighbor_dict = {
         id: n for (id, n) in zip(df.GEOID20, df.neighbors)
     }
 
-    df_trade = pd.DataFrame(df)
-    df_trade_pop = df_trade.groupby('dist_id').sum()[['POP100']].reset_index()
     recent_transfer = []
-
     second_choice = False
+    transfers = 0
+    deviations = []
+    if resume:
+        saved = load_checkpoint(checkpoint_path)
+        restore_df_assignment(df, saved['assignment'])
+        transfers = saved['counters']['transfers']
+        deviations = saved['history']
+        recent_transfer = saved['extra']['recent_transfer']
+        second_choice = saved['extra']['second_choice']
+        inst.event('resume', f"Resuming from transfer #{transfers}", transfer=transfers)
+    job = {'function': 'single_balance_transfer', 'allowed_deviation': allowed_deviation}
+
+    df_trade = pd.DataFrame(df)
+    df_trade_pop = df_trade.groupby('dist_id')[['POP100']].sum().reset_index()
+
     while (df_trade_pop.POP100.max() - df_trade_pop.POP100.min()) > allowed_deviation:
     #small districts take
         df_trade = pd.DataFrame(df)
-        df_trade_pop = df_trade.groupby('dist_id').sum()[['POP100']].reset_index()
+        df_trade_pop = df_trade.groupby('dist_id')[['POP100']].sum().reset_index()
 
         smallest = df_trade_pop[df_trade_pop.POP100 == min(df_trade_pop.POP100)]
 
@@ -178,7 +230,7 @@ def single_balance_transfer(df, neighbor_dict=None, run=run, run_dict=run_dict,
         if not second_choice:
             comp_district = df_neighbor_pop.loc[0, 'index']
         else:
-            print(df_neighbor_pop)
+            inst.event('second_choice', f"{df_neighbor_pop}")
             comp_district = df_neighbor_pop.loc[1, 'index']
 
 
@@ -190,15 +242,20 @@ def single_balance_transfer(df, neighbor_dict=None, run=run, run_dict=run_dict,
         max_pop = 0
         transfer = None
         for e in eligible:
-            if df.loc[df.GEOID20 == e, 'POP100'].item() > max_pop:
-                max_pop = df.loc[3, "POP100"].item()
+            pop = df.loc[df.GEOID20 == e, 'POP100'].item()
+            if pop > max_pop:
+                max_pop = pop
                 transfer = e
 
         recent_transfer.append(transfer)
 
 
         df.loc[df['GEOID20'] == transfer, 'dist_id'] = smallest.dist_id.item()
-        print(df_trade_pop.POP100.max() - df_trade_pop.POP100.min())
+        deviation = df_trade_pop.POP100.max() - df_trade_pop.POP100.min()
+        inst.count('transfers')
+        inst.count('precincts_moved')
+        inst.record('deviation', deviation)
+        inst.event('transfer', f"{deviation}", deviation=deviation)
 
         # second choice mode is a way to inject some noise to prevent
         # trading precincts back and forth indefinitely
@@ -222,6 +279,14 @@ def single_balance_transfer(df, neighbor_dict=None, run=run, run_dict=run_dict,
                     second_choice = True
                 else:
                     second_choice = False
+
+        transfers += 1
+        deviations.append(int(df_trade_pop.POP100.max() - df_trade_pop.POP100.min()))
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, df_assignment(df), job,
+                            counters={'transfers': transfers}, history=deviations,
+                            extra={'recent_transfer': recent_transfer, 
+                                   'second_choice': second_choice})
     
     idx = {name: i for i, name in enumerate(list(df), start=1)}
     recapture_orphan_precincts(df, idx)
@@ -241,4 +306,24 @@ def balance_ethan_style(df, run=0, run_dict={}, allowed_deviation=70000):
 
     batch_balance_transfer(df)
     print("Switching to single-precinct approach.")
-    single_balance_transfer(df)
\ No newline at end of file
+    single_balance_transfer(df)
+
+
+def resume_balance_transfer(df, checkpoint_path):
+    '''
+    Picks a batch_balance_transfer or single_balance_transfer run back up
+    from its last checkpoint, with the same allowed_deviation it was started
+    with.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): the same state data by precinct/VTD the
+        run was started on
+        -checkpoint_path (str): checkpoint file the run was saving to
+
+    Returns: none, modifies df in-place.
+    '''
+    job = load_checkpoint(checkpoint_path)['job']
+    balancers = {'batch_balance_transfer': batch_balance_transfer,
+                 'single_balance_transfer': single_balance_transfer}
+    balancers[job['function']](df, allowed_deviation=job['allowed_deviation'],
+                               checkpoint_path=checkpoint_path, resume=True)
@@ -0,0 +1,279 @@
+'''
+Fiduccia-Mattheyses style refinement for population balance.
+
+balance_boundary (priority_swap.py) only ever makes moves that improve
+balance, so it stops as soon as no single move helps, even when a short
+chain of moves (say, one district handing a precinct through a balanced
+neighbor to an underpopulated district on the other side) would. The old
+single_balance_transfer loop gets around this with "second choice" noise,
+which makes runs hard to repeat.
+
+fm_pass works like a Fiduccia-Mattheyses pass instead:
+    - every boundary move is kept in GainBuckets, keyed by exactly how much
+      it improves balance (priority_swap.move_gain, which can be negative),
+      so the move taken is always one with the highest gain
+    - the best move is made even if its gain is negative, and the precinct
+      is then locked for the rest of the pass, so nothing can be traded back
+      and forth
+    - after a move, the moves of the moved precinct's neighbors are updated
+      from their own edges, and only moves into or out of the two districts
+      involved are re-scored (nothing else's gain changed), so a move costs
+      about the size of those two districts' borders, not of the state
+    - at the end of the pass, every move after the best point reached (the
+      lowest population deviation) is undone
+No pass can leave the map less balanced than it started, every pass ends,
+and there is no randomness, so the same map always balances the same way.
+'''
+import heapq
+import numpy as np
+from partition import as_partition, sync_partition
+from contiguity import would_disconnect
+from priority_swap import move_gain, boundary_moves
+from instrument import get_instrument, timed
+
+
+class GainBuckets:
+    '''
+    Bucket priority queue of moves, as in Fiduccia-Mattheyses: one bucket
+    for each gain, holding every move with exactly that gain, so the move
+    taken is always one with the highest gain. Within a bucket, the move
+    inserted last comes out first.
+
+    Population-weighted gains spread over far too many values for the
+    textbook array of buckets, so the gains that have a bucket are kept in a
+    heap instead. Inserting or removing a move, and taking one from the top
+    bucket, are O(1); opening a bucket for a new gain, or moving on from an
+    emptied top bucket, is O(log(number of gains)).
+    '''
+    def __init__(self):
+        self.buckets = {}
+        self.gain_of = {}
+        #negated gains of the buckets, so the highest is on top; emptied
+        #buckets are cleared out when they reach the top
+        self.gains = []
+
+    def __len__(self):
+        return len(self.gain_of)
+
+    def insert(self, move, gain):
+        '''
+        Adds a move, or moves it to a new bucket if its gain has changed.
+
+        Inputs:
+            -move (hashable): the move
+            -gain (int): its gain
+
+        Returns: None
+        '''
+        self.remove(move)
+        bucket = self.buckets.get(gain)
+        if bucket is None:
+            bucket = self.buckets[gain] = {}
+            heapq.heappush(self.gains, -gain)
+        bucket[move] = None
+        self.gain_of[move] = gain
+
+    def remove(self, move):
+        '''
+        Takes a move out, if it's in.
+        '''
+        gain = self.gain_of.pop(move, None)
+        if gain is not None:
+            del self.buckets[gain][move]
+
+    def best_gain(self):
+        '''
+        Highest gain of any move in the queue, found by looking at every move
+        (for checking pop_best).
+
+        Returns (int): the gain, or None if there are no moves
+        '''
+        return max(self.gain_of.values(), default=None)
+
+    def pop_best(self):
+        '''
+        Takes out a move with the highest gain.
+
+        Returns (tuple): the move and its gain, or None if there are no moves
+        left
+        '''
+        while self.gains and not self.buckets[-self.gains[0]]:
+            del self.buckets[-heapq.heappop(self.gains)]
+        if not self.gains:
+            return None
+        gain = -self.gains[0]
+        move, _ = self.buckets[gain].popitem()
+        del self.gain_of[move]
+        return move, gain
+
+
+def fm_pass(part, allowed_deviation=70000, stall_moves=100, check=False):
+    '''
+    Runs one Fiduccia-Mattheyses pass (see module docstring): makes the best
+    unlocked boundary move over and over, whether or not it helps, then
+    rolls back to the point where the population deviation was lowest.
+    Moves that would split the donor district are skipped (and tried again
+    once either of their districts changes), so every district stays
+    contiguous.
+
+    Inputs:
+        -part (Partition): map with every precinct assigned
+        -allowed_deviation (int): Largest allowable difference between the
+        population of the most populous district and the population of the
+        least populous district. The pass stops as soon as it's reached.
+        -stall_moves (int): stop after this many moves in a row without a new
+        best point. None means keep going until every boundary precinct has
+        moved or been locked.
+        -check (boolean): if True, checks that every move taken has the
+        highest gain in the queue (slow; for testing)
+
+    Returns (int): number of moves kept
+    '''
+    locked = np.zeros(len(part), dtype=bool)
+    buckets = GainBuckets()
+    #every move of an unlocked precinct, by precinct and by the districts it
+    #is into and out of; a move is in the buckets unless it was taken and
+    #found to split its district, until one of its districts changes
+    precinct_moves = {}
+    dist_moves = [set() for _ in range(part.num_districts + 1)]
+
+    def gain(move):
+        precinct, from_dist, to_dist = move
+        return move_gain(int(part.pop[precinct]), int(part.dist_pop[from_dist]),
+                         int(part.dist_pop[to_dist]))
+
+    def track(move):
+        precinct_moves.setdefault(move[0], set()).add(move)
+        dist_moves[move[1]].add(move)
+        dist_moves[move[2]].add(move)
+        buckets.insert(move, gain(move))
+
+    def untrack(move):
+        precinct_moves[move[0]].discard(move)
+        dist_moves[move[1]].discard(move)
+        dist_moves[move[2]].discard(move)
+        buckets.remove(move)
+
+    def update_precinct(precinct):
+        #its moves are into whichever districts its neighbors are in now
+        from_dist = int(part.assignment[precinct])
+        to_dists = set(part.assignment[part.neighbors(precinct)].tolist())
+        to_dists.discard(from_dist)
+        current = precinct_moves.get(precinct, set())
+        for move in [move for move in current if move[1] != from_dist or move[2] not in to_dists]:
+            untrack(move)
+        for to_dist in to_dists:
+            if (precinct, from_dist, to_dist) not in current:
+                track((precinct, from_dist, to_dist))
+
+    for precinct, to_dist in zip(*(moves.tolist() for moves in boundary_moves(part))):
+        track((precinct, int(part.assignment[precinct]), to_dist))
+
+    history = []
+    total_gain = 0
+    #lowest deviation first, then lowest sum of squared deviations
+    best = (part.population_deviation(), 0)
+    best_length = 0
+    disconnecting = 0
+    while best[0] > allowed_deviation and len(history) - best_length < (stall_moves or len(part)):
+        expected = buckets.best_gain() if check else None
+        popped = buckets.pop_best()
+        if popped is None:
+            break
+        (precinct, from_dist, to_dist), move_gained = popped
+        assert not check or move_gained == expected, "took a move without the highest gain"
+        if would_disconnect(part, precinct):
+            disconnecting += 1
+            continue
+        part.assign(precinct, to_dist)
+        locked[precinct] = True
+        history.append((precinct, from_dist, to_dist))
+        total_gain += move_gained
+        score = (part.population_deviation(), -total_gain)
+        if score < best:
+            best, best_length = score, len(history)
+
+        for move in list(precinct_moves.pop(precinct, ())):
+            dist_moves[move[1]].discard(move)
+            dist_moves[move[2]].discard(move)
+            buckets.remove(move)
+        for nabe in part.neighbors(precinct).tolist():
+            if not locked[nabe]:
+                update_precinct(nabe)
+        for move in dist_moves[from_dist] | dist_moves[to_dist]:
+            buckets.insert(move, gain(move))
+
+    for precinct, from_dist, _ in reversed(history[best_length:]):
+        part.assign(precinct, from_dist)
+
+    inst = get_instrument()
+    inst.count('precincts_moved', best_length)
+    inst.count('moves_rolled_back', len(history) - best_length)
+    inst.count('moves_skipped_contiguity', disconnecting)
+    return best_length
+
+
+def fm_balance(part, allowed_deviation=70000, stop_after=20, stall_moves=100):
+    '''
+    Runs fm_pass until districts are within allowed_deviation, until a pass
+    keeps no moves, or until stop_after passes.
+
+    Inputs:
+        -part (Partition): map with every precinct assigned
+        -allowed_deviation (int): as for fm_pass
+        -stop_after (int): most passes to run
+        -stall_moves (int): as for fm_pass
+
+    Returns (int): number of moves kept
+    '''
+    moved = 0
+    for _ in range(stop_after):
+        if part.population_deviation() <= allowed_deviation:
+            break
+        kept = fm_pass(part, allowed_deviation, stall_moves=stall_moves)
+        moved += kept
+        if kept == 0:
+            break
+    return moved
+
+
+@timed
+def fm_pop_swap(df, allowed_deviation=70000, stop_after=20):
+    '''
+    Balances district populations by moving border precincts in
+    Fiduccia-Mattheyses passes (see fm_pass) until populations of districts
+    are within allowable deviation range. Takes the same inputs as
+    priority_pop_swap, and gets further than it when no single move improves
+    balance. Unlike single_balance_transfer, it needs no random second
+    choices to get out of trading loops, so runs are repeatable.
+
+    Inputs:
+        -df (geopandas GeoDataFrame or Partition): state-level precinct/VTD
+        data. Should have dist_ids assigned to every precinct.
+        -allowed_deviation (int): Largest allowable difference between the
+        population of the most populous district and the population of the
+        least populous district.
+        -stop_after (int): manual number of passes to stop after if procedure
+        hasn't yet terminated.
+
+    Returns: None, modifies df in place
+    '''
+    inst = get_instrument()
+    part = as_partition(df)
+    for count in range(1, stop_after + 1):
+        if part.population_deviation() <= allowed_deviation:
+            break
+        inst.event('fm_pass', f"Now doing balancing pass #{count}...", cycle=count)
+        inst.count('fm_passes')
+        moved = fm_pass(part, allowed_deviation)
+        deviation = part.population_deviation()
+        inst.record('deviation', deviation)
+        inst.event('deviation', f"Kept {moved} moves. The most and least populous district differ by: {deviation}",
+                   cycle=count, moved=moved, deviation=deviation)
+        if moved == 0:
+            inst.event('stop', "No sequence of moves improves population balance. Stopping",
+                       reason='no_improving_move')
+            break
+    sync_partition(df, part)
+    if part.population_deviation() <= allowed_deviation:
+        inst.event('balanced', "You've reached your population balance target. Hooray!")
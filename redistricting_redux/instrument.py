@@ -0,0 +1,182 @@
+'''
+Instrumentation for map drawing and balancing: named timers, counters, and
+progress events, in place of print calls in the hot loops.
+
+Code being measured asks for the current Instrument with get_instrument()
+and reports to it:
+    inst.event('swap_cycle', "Now doing swap cycle #3...", cycle=3)
+    inst.count('precincts_moved', 12)
+    inst.record('deviation', 81234)
+What happens to events depends on the Instrument's mode:
+    'print'     print the event's message, if it has one (the default, so the
+                interactive app reads the same as before)
+    'jsonl'     write every event as one line of JSON to a stream
+    'callback'  call a function with every event's name and fields
+    'silent'    do nothing; counters, timers and records are still kept
+Use instrumented() to swap in a different Instrument for a block of code,
+e.g. to run the balancing silently and read the counters afterwards.
+'''
+import sys
+import json
+import time
+import functools
+import contextlib
+from collections import defaultdict
+
+MODES = ('print', 'jsonl', 'callback', 'silent')
+
+
+class Instrument:
+    '''
+    Collects counters, timings and per-round records, and passes progress
+    events on according to its mode.
+
+    Inputs:
+        -mode (str): one of MODES
+        -stream (file-like): where 'jsonl' mode writes. Defaults to stdout
+        -callback (function): for 'callback' mode; called as
+        callback(name, fields) for every event
+
+    Attributes:
+        -counters (dict): name -> running total
+        -timings (dict): name -> total seconds spent inside timer(name)
+        -records (dict): name -> list of values, in the order recorded
+    '''
+    def __init__(self, mode='print', stream=None, callback=None):
+        assert mode in MODES, f"mode must be one of {MODES}"
+        assert mode != 'callback' or callback is not None, "'callback' mode needs a callback"
+        self.mode = mode
+        self.stream = stream if stream is not None else sys.stdout
+        self.callback = callback
+        self.start = time.perf_counter()
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.records = defaultdict(list)
+
+    def event(self, name, message=None, **fields):
+        '''
+        Reports a progress event.
+
+        Inputs:
+            -name (str): what happened, e.g. 'swap_cycle'
+            -message (str): human-readable version, shown in 'print' mode
+            -fields: machine-readable details, for 'jsonl' and 'callback'
+            modes (and the message too, if given)
+
+        Returns: None
+        '''
+        if self.mode == 'silent':
+            return
+        if self.mode == 'print':
+            if message is not None:
+                print(message)
+            return
+        if message is not None:
+            fields['message'] = message
+        if self.mode == 'callback':
+            self.callback(name, fields)
+        else:
+            line = {'event': name, 'seconds': round(time.perf_counter() - self.start, 6)}
+            line.update(fields)
+            self.stream.write(json.dumps(line, default=to_json) + '\n')
+
+    def count(self, name, n=1):
+        '''
+        Adds n to a counter.
+        '''
+        self.counters[name] += n
+
+    def record(self, name, value):
+        '''
+        Appends a value to a record, e.g. the deviation after every round.
+        '''
+        self.records[name].append(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        '''
+        Times a block of code, adding its duration to timings[name]:
+            with inst.timer('dissolve'):
+                ...
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.timings[name] += seconds
+            self.event('timer', timer=name, seconds=seconds)
+
+    def summary(self):
+        '''
+        Returns (dict): counters, timings and records so far, as plain dicts
+        '''
+        return {'counters': dict(self.counters), 'timings': dict(self.timings),
+                'records': dict(self.records)}
+
+
+def to_json(value):
+    '''
+    Converts NumPy numbers and arrays (and anything else json can't handle)
+    for json.dumps.
+    '''
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+_current = Instrument('print')
+
+
+def get_instrument():
+    '''
+    Returns (Instrument): the instrument code should currently report to
+    '''
+    return _current
+
+
+def set_instrument(instrument):
+    '''
+    Makes an Instrument the current one.
+
+    Inputs:
+        -instrument (Instrument)
+
+    Returns (Instrument): the one it replaced
+    '''
+    global _current
+    previous, _current = _current, instrument
+    return previous
+
+
+@contextlib.contextmanager
+def instrumented(mode='silent', stream=None, callback=None):
+    '''
+    Reports to a new Instrument for the length of a with block, then puts the
+    old one back:
+        with instrumented('silent') as inst:
+            priority_pop_swap(df)
+        print(inst.counters['precincts_moved'])
+
+    Inputs: as for Instrument
+
+    Yields (Instrument)
+    '''
+    instrument = Instrument(mode, stream, callback)
+    previous = set_instrument(instrument)
+    try:
+        yield instrument
+    finally:
+        set_instrument(previous)
+
+
+def timed(func):
+    '''
+    Decorator that times every call of a function with the current
+    instrument, under the function's name.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with get_instrument().timer(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
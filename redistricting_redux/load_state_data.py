@@ -2,25 +2,52 @@
 All functions in this file by: Matt Jackson
 make_neighbors_dict debugged and updated by: Sarik Goyal
 '''
+import os
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+import shapely
 import math
+from concurrent.futures import ProcessPoolExecutor
 from collections import OrderedDict
 from ast import literal_eval
+from adjacency import (pairs_to_csr, neighbors_to_csr, csr_to_neighbors, save_adjacency,
+                       load_adjacency, reverse_edges)
+from state_cache import (cache_is_current, write_state_cache, read_cached_frame,
+                         read_cached_columns, read_cached_adjacency, read_cached_geometry)
 
+#projected CRS shared boundary lengths are measured in (CONUS Albers, meters)
+LENGTH_CRS = 'EPSG:5070'
 
-def load_state(state_input, init_neighbors=False, affix_neighbors=True):
+
+def load_state(state_input, init_neighbors=False, affix_neighbors=True, geometry=True,
+               columns=None):
     '''
     Helper function that actually imports the state after selecting it.
+    Reads the state's bundle cache (see state_cache.py) when it is up to
+    date, and otherwise reads the shapefile and writes the cache for next
+    time.
 
     Inputs:
         -state_input (str): 2-letter state postal code abbreviation
-    Returns (geopandas GeoDataFrame)
+        -geometry (boolean): if False, leaves out the precinct polygons and
+        returns a plain pandas DataFrame. Drawing, balancing and the vote
+        statistics never need them; dissolve_map and the map plotting
+        functions load them on first use (see state_geometry).
+        -columns (list of str): attribute columns to keep. Defaults to all.
+        GEOID20 is always kept.
+    Returns (geopandas GeoDataFrame, or pandas DataFrame if geometry is
+    False), with the state's postal code in .attrs['state_postal']
     '''
-
-    fp = f"redistricting_redux/merged_shps/{state_input}_VTD_merged.shp"
-    state_data = gpd.read_file(fp)
+    if columns is not None:
+        columns = ['GEOID20'] + [col for col in columns if col != 'GEOID20']
+    adjacency_fp = f'redistricting_redux/merged_shps/{state_input}_2020_adjacency.npz'
+    cached = not init_neighbors and cache_is_current(state_input)
+    if cached:
+        state_data = read_cached_frame(state_input, columns, geometry)
+    else:
+        fp = f"redistricting_redux/merged_shps/{state_input}_VTD_merged.shp"
+        state_data = gpd.read_file(fp)
     if "Tot_2020_t" in state_data.columns:
         state_data.rename(columns={"Tot_2020_t","POP100"})
         print("Renamed population column to POP100")
@@ -28,44 +55,351 @@ def load_state(state_input, init_neighbors=False, affix_neighbors=True):
     if init_neighbors:
         set_precinct_neighbors(state_data, state_input)
         print("Precinct neighbors calculated")
+    if not cached:
+        if affix_neighbors and not os.path.exists(adjacency_fp):
+            convert_neighbors_csv(state_data, state_input)
+        if os.path.exists(adjacency_fp):
+            indptr, indices = load_adjacency(adjacency_fp, geoids=state_data['GEOID20'])
+            write_state_cache(state_data.drop(columns=['neighbors', 'neighbor_idx'],
+                                              errors='ignore'),
+                              state_input, indptr, indices)
+        if columns is not None:
+            state_data = state_data[columns + [col for col in state_data.columns
+                                               if col in ('neighbors', 'neighbor_idx')
+                                               or (geometry and col == state_data.geometry.name)]]
+        if not geometry:
+            state_data = pd.DataFrame(state_data.drop(columns=state_data.geometry.name))
     if affix_neighbors:
-        neighbor_fp = f'redistricting_redux/merged_shps/{state_input}_2020_neighbors.csv'
-        affix_neighbors_list(state_data, neighbor_fp)
+        if cached:
+            indptr, indices = read_cached_adjacency(state_input, mmap_mode=None)
+            affix_csr(state_data, indptr, indices)
+        else:
+            affix_adjacency(state_data, adjacency_fp)
         print("Neighbors list initialized")
     state_data['dist_id'] = None
+    state_data.attrs['state_postal'] = state_input
 
     return state_data   
 
 
-def set_precinct_neighbors(df, state_postal):
+def state_geometry(df):
+    '''
+    Gets the precinct polygons of a state's data. If the state was loaded
+    with geometry=False, they are read from the state's bundle cache the
+    first time they are asked for and kept in a 'geometry' column after that.
+
+    Inputs:
+        -df (pandas DataFrame or geopandas GeoDataFrame): state data by
+        precinct/VTD, as from load_state
+
+    Returns (geopandas GeoSeries): the polygons, by row
+    '''
+    if isinstance(df, gpd.GeoDataFrame):
+        return df.geometry
+    if 'geometry' not in df.columns:
+        state_postal = df.attrs.get('state_postal')
+        assert state_postal is not None, "This dataframe has no geometry and no state to load it from"
+        if not cache_is_current(state_postal):
+            load_state(state_postal, affix_neighbors=False)
+        geoms = read_cached_geometry(state_postal, df.index)
+        assert len(geoms) == len(df), "Cached geometry doesn't match the rows of this dataframe"
+        df['geometry'] = geoms
+    return gpd.GeoSeries(df['geometry'])
+
+
+def load_state_arrays(state_input, columns=None):
+    '''
+    Opens a state's attribute columns and adjacency as memory-mapped arrays
+    from its bundle cache (see state_cache.py), without building a
+    GeoDataFrame or reading any geometry. For code that only needs numbers,
+    such as map drawing on a Partition. Loads the state the slow way once
+    first if its cache is missing or out of date.
+
+    Inputs:
+        -state_input (str): 2-letter state postal code abbreviation
+        -columns (list of str): which attribute columns. Defaults to all
+
+    Returns (dict): column name -> read-only NumPy array, plus 'indptr' and
+    'indices' (the CSR adjacency)
+    '''
+    if not cache_is_current(state_input):
+        load_state(state_input)
+    arrays = read_cached_columns(state_input, columns)
+    arrays['indptr'], arrays['indices'] = read_cached_adjacency(state_input)
+    return arrays
+
+
+def set_precinct_neighbors(df, state_postal, method='strtree', workers=1):
     '''
     Creates a list of neighbors (adjacency list) for each precinct/VTD whose 
     geometry is in the GeoDataFrame.
-    Takes about 80-90 seconds for the Georgia 2018 precinct map, or about .03
-    seconds per precinct.
+    With method='brute', takes about 80-90 seconds for the Georgia 2018 
+    precinct map, or about .03 seconds per precinct. The default spatial
+    index method gives the same neighbors in a few seconds.
 
     Inputs:
         -df (GeoPandas GeoDataFrame): state data by precinct/VTD
         -state_postal (2-character string): postal code for a state supported
         by the program, e.g. "GA" for Georgia
+        -method (str): 'strtree' (spatial index) or 'brute' (original 
+        row-by-row scan, kept for benchmarking)
+        -workers (int): for 'strtree', number of worker processes to split
+        the state's spatial tiles between (see find_neighbor_pairs_tiled).
+        The neighbors are the same for any number of workers.
 
     Returns: None, modifies df in-place
     '''
-    #Inspired by:
-    #https://gis.stackexchange.com/questions/281652/finding-all-neighbors-using-geopandas
-    df['neighbors'] = None
+    df['neighbors'] = compute_precinct_neighbors(df, method=method, workers=workers)
     
-    for index, row in df.iterrows():
-        neighbors = np.array(df[df.geometry.touches(row['geometry'])].GEOID20)
-        overlap = np.array(df[df.geometry.overlaps(row['geometry'])].GEOID20)
-        if len(overlap) > 0:
-            neighbors = np.union1d(neighbors, overlap)
-        df.at[index, 'neighbors'] = neighbors
-        if index % 100 == 0:
-            print(f"Neighbors for precinct {index} calculated")
-    
-    print("Saving neighbors list to csv so you don't have to do this again...")
-    df['neighbors'].to_csv(f'redistricting_redux/merged_shps/{state_postal}_2020_neighbors.csv')
+    print("Saving neighbors list so you don't have to do this again...")
+    indptr, indices = neighbors_to_csr(df['GEOID20'], df['neighbors'])
+    affix_neighbor_indices(df, indptr, indices)
+    edge_length, exterior_perimeter = compute_edge_lengths(df.geometry, indptr, indices)
+    save_adjacency(f'redistricting_redux/merged_shps/{state_postal}_2020_adjacency.npz',
+                   df['GEOID20'], indptr, indices, edge_length, exterior_perimeter,
+                   compute_precinct_areas(df.geometry))
+
+
+def compute_precinct_neighbors(df, method='strtree', workers=1):
+    '''
+    Calculates the neighbors of every precinct/VTD without saving them. Two
+    precincts are neighbors if their geometries touch or overlap.
+
+    Inputs:
+        -df (GeoPandas GeoDataFrame): state data by precinct/VTD
+        -method (str): 'strtree' or 'brute' (see set_precinct_neighbors)
+        -workers (int): worker processes for 'strtree' (see
+        set_precinct_neighbors)
+
+    Returns (pandas Series): NumPy array of neighboring GEOID20s for each row
+    '''
+    if method == 'brute':
+        #Inspired by:
+        #https://gis.stackexchange.com/questions/281652/finding-all-neighbors-using-geopandas
+        neighbors_col = pd.Series(None, index=df.index, dtype=object)
+        for index, row in df.iterrows():
+            neighbors = np.array(df[df.geometry.touches(row['geometry'])].GEOID20)
+            overlap = np.array(df[df.geometry.overlaps(row['geometry'])].GEOID20)
+            if len(overlap) > 0:
+                neighbors = np.union1d(neighbors, overlap)
+            neighbors_col.at[index] = neighbors
+            if index % 100 == 0:
+                print(f"Neighbors for precinct {index} calculated")
+        return neighbors_col
+
+    if workers > 1:
+        left, right = find_neighbor_pairs_tiled(df.geometry, workers)
+    else:
+        left, right = find_neighbor_pairs(df.geometry)
+    indptr, indices = pairs_to_csr(len(df), left, right)
+    return pd.Series(csr_to_neighbors(df['GEOID20'].to_numpy(), indptr, indices),
+                     index=df.index, dtype=object)
+
+
+def find_neighbor_pairs(geoms):
+    '''
+    Finds every pair of geometries that touch or overlap, using a bulk query
+    of an STRtree spatial index so that only pairs whose bounding boxes meet
+    ever get tested. Same rule as the brute-force scan, but roughly
+    O(n log n) instead of O(n^2).
+
+    Inputs:
+        -geoms (GeoPandas GeoSeries): precinct/VTD geometries
+
+    Returns (tuple of NumPy int arrays): (left, right) row positions of each
+    neighboring pair, sorted by left and then right. Both directions of every
+    pair are included, and no precinct is its own neighbor.
+    '''
+    sindex = geoms.sindex
+    #geopandas 0.12 only accepts an array of geometries through query_bulk;
+    #newer versions fold that into query
+    query = getattr(sindex, 'query_bulk', sindex.query)
+    touches = query(geoms.values, predicate='touches')
+    overlaps = query(geoms.values, predicate='overlaps')
+    left, right = np.concatenate([touches, overlaps], axis=1)
+
+    return unique_pairs(len(geoms), left, right)
+
+
+def unique_pairs(n, left, right):
+    '''
+    Drops self-pairs and repeated pairs (e.g. pairs that both touch and
+    overlap) from lists of neighboring pairs, and sorts them.
+
+    Inputs:
+        -n (int): number of precincts/VTDs in the state
+        -left, right (NumPy int arrays): row positions of each pair
+
+    Returns (tuple of NumPy int arrays): (left, right), sorted by left and
+    then right
+    '''
+    not_self = left != right
+    keys = np.unique(left[not_self].astype(np.int64) * n + right[not_self])
+    return keys // n, keys % n
+
+
+def find_neighbor_pairs_tiled(geoms, workers, tiles_per_worker=4):
+    '''
+    Same as find_neighbor_pairs (and returns exactly the same arrays), but
+    splits the state into spatial tiles and queries them in a pool of worker
+    processes.
+
+    Every precinct belongs to the one tile its bounding box center falls in,
+    and each tile finds the neighbors of its own precincts. To see all of
+    them, a tile's spatial index also holds every precinct whose bounding box
+    reaches into the tile's extent, widened by the bounding boxes of its own
+    precincts (the overlap margin). Since each pair is found from the tile
+    of its left precinct, merging the tiles and dropping repeats as
+    find_neighbor_pairs does gives the same result.
+
+    Inputs:
+        -geoms (GeoPandas GeoSeries): precinct/VTD geometries
+        -workers (int): number of worker processes
+        -tiles_per_worker (int): tiles per worker, so that tiles with slow,
+        detailed precincts don't hold up the rest
+
+    Returns (tuple of NumPy int arrays): (left, right), as from
+    find_neighbor_pairs
+    '''
+    geom_array = geoms.to_numpy()
+    bounds = shapely.bounds(geom_array)
+    #empty geometries (NaN bounds) have no neighbors, so they are left out
+    rows = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+    bounds = bounds[rows]
+    center_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    center_y = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    #tiles with about the same number of precincts each: columns split at
+    #quantiles of x, then each column split at quantiles of its y
+    num_cols = max(1, int(np.sqrt(workers * tiles_per_worker)))
+    num_rows = max(1, (workers * tiles_per_worker) // num_cols)
+    col_of = np.searchsorted(np.quantile(center_x, np.linspace(0, 1, num_cols + 1)[1:-1]),
+                             center_x, side='right')
+    tile_of = np.empty(len(rows), dtype=np.int64)
+    for col in range(num_cols):
+        in_col = col_of == col
+        row_edges = np.quantile(center_y[in_col], np.linspace(0, 1, num_rows + 1)[1:-1]) \
+            if in_col.any() else []
+        tile_of[in_col] = col * num_rows + np.searchsorted(row_edges, center_y[in_col],
+                                                           side='right')
+
+    tasks = []
+    for tile in np.unique(tile_of):
+        own = np.flatnonzero(tile_of == tile)
+        minx, miny = bounds[own, 0].min(), bounds[own, 1].min()
+        maxx, maxy = bounds[own, 2].max(), bounds[own, 3].max()
+        reach = np.flatnonzero((bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) &
+                               (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny))
+        tasks.append((geom_array[rows[own]], rows[own], geom_array[rows[reach]], rows[reach]))
+
+    with ProcessPoolExecutor(workers) as pool:
+        found = list(pool.map(tile_neighbor_pairs, tasks))
+    left = np.concatenate([pair[0] for pair in found])
+    right = np.concatenate([pair[1] for pair in found])
+    return unique_pairs(len(geom_array), left, right)
+
+
+def tile_neighbor_pairs(task):
+    '''
+    Finds the neighboring pairs of one tile, for find_neighbor_pairs_tiled.
+    Runs in a worker process.
+
+    Inputs:
+        -task (tuple): (own geometries, their row positions, geometries in
+        the tile's spatial index, their row positions)
+
+    Returns (tuple of NumPy int arrays): (left, right) row positions of
+    each pair found, possibly with repeats and self-pairs
+    '''
+    own_geoms, own_rows, tree_geoms, tree_rows = task
+    tree = shapely.STRtree(tree_geoms)
+    touches = tree.query(own_geoms, predicate='touches')
+    overlaps = tree.query(own_geoms, predicate='overlaps')
+    left, right = np.concatenate([touches, overlaps], axis=1)
+    return own_rows[left], tree_rows[right]
+
+
+def compute_edge_lengths(geoms, indptr, indices, crs=LENGTH_CRS):
+    '''
+    Measures how much boundary each pair of neighboring precincts shares,
+    and how much of each precinct's boundary is shared with no neighbor
+    (the state line), in a projected CRS so lengths come out in meters.
+    Neighbors that only touch at a corner share a length of 0.
+
+    Inputs:
+        -geoms (GeoPandas GeoSeries): precinct/VTD geometries. If they have
+        no CRS, they are assumed to be projected already.
+        -indptr, indices (NumPy int arrays): CSR adjacency, with both
+        directions of every pair included
+        -crs: CRS to measure in (default: CONUS Albers, EPSG:5070)
+
+    Returns (tuple of NumPy float64 arrays): edge_length, lined up with
+    indices, and exterior_perimeter, by row
+    '''
+    if geoms.crs is not None:
+        geoms = geoms.to_crs(crs)
+    outlines = shapely.boundary(geoms.to_numpy())
+    src = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    dst = np.asarray(indices)
+
+    #measure each pair once (where its reverse entry exists), then copy the
+    #length over to the reverse entry
+    reverse = reverse_edges(indptr, indices)
+    copied = (src > dst) & (reverse >= 0)
+    edge_length = np.zeros(len(dst), dtype=np.float64)
+    measure = np.flatnonzero(~copied)
+    edge_length[measure] = shapely.length(shapely.intersection(outlines[src[measure]],
+                                                               outlines[dst[measure]]))
+    edge_length[copied] = edge_length[reverse[copied]]
+
+    shared = np.bincount(src, weights=edge_length, minlength=len(indptr) - 1)
+    #overlapping neighbors can share more than a precinct's own perimeter
+    exterior_perimeter = np.maximum(shapely.length(outlines) - shared, 0)
+    return edge_length, exterior_perimeter
+
+
+def compute_precinct_areas(geoms, crs=LENGTH_CRS):
+    '''
+    Measures the area of every precinct, in the same projected CRS as
+    compute_edge_lengths (square meters).
+
+    Inputs:
+        -geoms (GeoPandas GeoSeries): precinct/VTD geometries. If they have
+        no CRS, they are assumed to be projected already.
+        -crs: CRS to measure in (default: CONUS Albers, EPSG:5070)
+
+    Returns (NumPy float64 array): area of each precinct, by row
+    '''
+    if geoms.crs is not None:
+        geoms = geoms.to_crs(crs)
+    return shapely.area(geoms.to_numpy())
+
+
+def add_edge_lengths(df, state_postal):
+    '''
+    Adds shared boundary lengths (see compute_edge_lengths) and precinct
+    areas to a state's existing {state}_2020_adjacency.npz file, e.g. one
+    converted from the neighbors csv before lengths were saved.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD, in the
+        adjacency file's row order (polygons are loaded if the state was
+        loaded without them)
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+
+    Returns (tuple of NumPy float arrays): edge_length, exterior_perimeter,
+    area
+    '''
+    adjacency_fp = f'redistricting_redux/merged_shps/{state_postal}_2020_adjacency.npz'
+    indptr, indices = load_adjacency(adjacency_fp, geoids=df['GEOID20'])
+    print("Measuring shared precinct boundaries (only needed once)...")
+    geoms = state_geometry(df)
+    edge_length, exterior_perimeter = compute_edge_lengths(geoms, indptr, indices)
+    area = compute_precinct_areas(geoms)
+    save_adjacency(adjacency_fp, df['GEOID20'], indptr, indices, edge_length,
+                   exterior_perimeter, area)
+    return edge_length, exterior_perimeter, area
 
 
 def affix_neighbors_list(df, neighbor_filename):
@@ -86,6 +420,83 @@ def affix_neighbors_list(df, neighbor_filename):
                                             np.array(literal_eval(x.replace("\n", "").replace("' '", "', '")),
                                             dtype=object))
 
+def affix_adjacency(df, adjacency_filename):
+    '''
+    Affix an adjacency list of neighbors from the binary CSR adjacency file
+    (see adjacency.py). Much faster than affix_neighbors_list, since no text
+    parsing is involved.
+
+    Input:
+        -df(geopandas GeoDataFrame): precinct/VTD-level data for a state
+        -adjacency_filename (str): name of the .npz file with the adjacency
+
+    Returns: None, modifies df in-place
+    '''
+    indptr, indices = load_adjacency(adjacency_filename, geoids=df['GEOID20'])
+    affix_csr(df, indptr, indices)
+
+
+def affix_csr(df, indptr, indices):
+    '''
+    Affix both neighbor columns ('neighbors' as GEOID20s and 'neighbor_idx'
+    as row positions) from CSR adjacency arrays.
+
+    Input:
+        -df(geopandas GeoDataFrame): precinct/VTD-level data for a state
+        -indptr, indices (NumPy int arrays): CSR adjacency of the rows of df
+
+    Returns: None, modifies df in-place
+    '''
+    df['neighbors'] = pd.Series(csr_to_neighbors(df['GEOID20'].to_numpy(), indptr, indices),
+                                index=df.index, dtype=object)
+    affix_neighbor_indices(df, indptr, indices)
+
+
+def affix_neighbor_indices(df, indptr=None, indices=None):
+    '''
+    Affix a 'neighbor_idx' column holding each precinct's neighbors as an
+    int32 array of row positions, so that map-drawing code can look up
+    neighbors without matching GEOID20 strings.
+
+    Input:
+        -df(geopandas GeoDataFrame): precinct/VTD-level data for a state. 
+        Must have a RangeIndex (as it does when loaded by load_state)
+        -indptr, indices (NumPy int arrays): CSR adjacency. If not given,
+        built from the GEOID20 'neighbors' column
+
+    Returns: None, modifies df in-place
+    '''
+    if indptr is None:
+        indptr, indices = neighbors_to_csr(df['GEOID20'], df['neighbors'])
+    df['neighbor_idx'] = pd.Series(np.split(indices, indptr[1:-1]), 
+                                   index=df.index, dtype=object)
+
+
+def convert_neighbors_csv(df, state_postal):
+    '''
+    One-time conversion of a state's {state}_2020_neighbors.csv file into the
+    binary {state}_2020_adjacency.npz file that load_state reads. Called
+    automatically by load_state the first time a state is loaded.
+
+    Inputs:
+        -df(geopandas GeoDataFrame): precinct/VTD-level data for the state, 
+        in the same row order the neighbors csv was written in
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+
+    Returns: None, writes file
+    '''
+    neighbor_fp = f'redistricting_redux/merged_shps/{state_postal}_2020_neighbors.csv'
+    adjacency_fp = f'redistricting_redux/merged_shps/{state_postal}_2020_adjacency.npz'
+    print(f"Converting {neighbor_fp} to binary adjacency (only needed once)...")
+    df_nabes = pd.DataFrame(index=df.index)
+    affix_neighbors_list(df_nabes, neighbor_fp)
+    indptr, indices = neighbors_to_csr(df['GEOID20'], df_nabes['neighbors'])
+    edge_length, exterior_perimeter = compute_edge_lengths(df.geometry, indptr, indices)
+    save_adjacency(adjacency_fp, df['GEOID20'], indptr, indices, edge_length,
+                   exterior_perimeter, compute_precinct_areas(df.geometry))
+
+
 def make_neighbors_dict(df, neighbors_as_lists=True):
     '''
     Creates a dictionary where each precinct's GEOID is a key,
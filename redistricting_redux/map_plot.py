@@ -0,0 +1,367 @@
+'''
+Fast map plotting without dissolving precinct polygons into districts.
+
+The boundary each pair of neighboring precincts shares is computed once per
+state and cached next to the adjacency file. A plan is then drawn by
+coloring every precinct with its district's color (one collection for the
+whole state) and drawing only the shared boundaries whose two precincts are
+in different districts (the "cut edges"), which together outline the
+districts. Plotting another plan of the same state only recolors the
+precincts and swaps which boundaries are drawn.
+
+BatchMapRenderer builds on that to write many maps of one state (each step
+of a balancing run, or a gallery of ensemble plans): one figure is drawn
+over and over, and PNG encoding happens in background threads.
+
+Precinct polygons are read through load_state_data.state_geometry, so a
+state loaded with geometry=False gets its polygons on the first plot.
+'''
+import os
+import numpy as np
+import pandas as pd
+import shapely
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+from matplotlib.collections import PatchCollection, LineCollection
+from matplotlib.colors import Normalize
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
+from checkpoint import df_assignment
+from adjacency import neighbors_to_csr
+from load_state_data import state_geometry
+
+
+def shared_boundaries(geoms, indptr, indices):
+    '''
+    Finds the boundary line each pair of neighboring precincts shares.
+    Neighbors that only touch at a corner share no line and are left out.
+
+    Inputs:
+        -geoms (array-like of shapely Polygons): precinct polygons by row
+        position
+        -indptr, indices (NumPy int arrays): CSR adjacency
+
+    Returns (tuple of NumPy arrays): coords (vertices of every boundary
+    line, one after another), offsets (line k runs from coords[offsets[k]]
+    up to coords[offsets[k+1]]), and line_src, line_dst (the two precincts
+    on either side of each line)
+    '''
+    geoms = np.asarray(geoms)
+    src = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    dst = np.asarray(indices)
+    pairs = src < dst
+    src, dst = src[pairs], dst[pairs]
+
+    outlines = shapely.boundary(geoms)
+    shared = shapely.intersection(outlines[src], outlines[dst])
+    parts, pair = shapely.get_parts(shared, return_index=True)
+    #a GeometryCollection of lines and points may come back, so flatten twice
+    parts, inner = shapely.get_parts(parts, return_index=True)
+    pair = pair[inner]
+    is_line = shapely.get_type_id(parts) == shapely.GeometryType.LINESTRING
+    lines, pair = parts[is_line], pair[is_line]
+
+    coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+    offsets = np.searchsorted(line_idx, np.arange(len(lines) + 1)).astype(np.int64)
+    return coords, offsets, src[pair].astype(np.int32), dst[pair].astype(np.int32)
+
+
+def load_boundaries(df, state_postal=None):
+    '''
+    Reads a state's shared precinct boundaries from
+    {state}_2020_boundaries.npz, computing them with shared_boundaries and
+    saving the file the first time.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD, with
+        neighbors (see load_state_data.load_state). Polygons are read with
+        state_geometry if df has none.
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia. If None, the boundaries are
+        computed but not saved.
+
+    Returns (tuple of NumPy arrays): coords, offsets, line_src, line_dst, as
+    from shared_boundaries
+    '''
+    fp = f'redistricting_redux/merged_shps/{state_postal}_2020_boundaries.npz'
+    geoids = np.asarray(df['GEOID20'], dtype=str)
+    if state_postal is not None and os.path.exists(fp):
+        with np.load(fp) as saved:
+            if np.array_equal(saved['geoids'], geoids):
+                return (saved['coords'], saved['offsets'], saved['line_src'],
+                        saved['line_dst'])
+        print(f"{fp} doesn't match this state's data; recomputing")
+
+    if state_postal is not None:
+        print("Finding shared precinct boundaries (only needed once)...")
+    if 'neighbor_idx' in df.columns:
+        nabe_arrays = df['neighbor_idx'].to_numpy()
+        indptr = np.zeros(len(df) + 1, dtype=np.int64)
+        np.cumsum([len(nabes) for nabes in nabe_arrays], out=indptr[1:])
+        indices = np.concatenate(nabe_arrays)
+    else:
+        indptr, indices = neighbors_to_csr(df['GEOID20'], df['neighbors'])
+    coords, offsets, line_src, line_dst = shared_boundaries(state_geometry(df).to_numpy(),
+                                                            indptr, indices)
+    if state_postal is not None:
+        np.savez(fp, geoids=geoids, coords=coords, offsets=offsets, line_src=line_src,
+                 line_dst=line_dst)
+    return coords, offsets, line_src, line_dst
+
+
+def precinct_paths(geoms):
+    '''
+    Converts precinct polygons (including holes and multi-part precincts)
+    into matplotlib Paths.
+
+    Inputs:
+        -geoms (array-like of shapely Polygons or MultiPolygons)
+
+    Returns (tuple): list of Paths, one per polygon part, and a NumPy int
+    array giving the row position of the precinct each part belongs to
+    '''
+    parts, part_row = shapely.get_parts(np.asarray(geoms), return_index=True)
+    paths = []
+    for polygon in parts:
+        rings = [polygon.exterior, *polygon.interiors]
+        paths.append(Path.make_compound_path(*[Path(np.asarray(ring.coords)[:, :2])
+                                               for ring in rings]))
+    return paths, part_row
+
+
+class CutEdgeMap:
+    '''
+    A matplotlib figure of a state's precincts that can show any plan of
+    that state: precincts are filled with their district's vote margin
+    (same colors as plot_dissolved_map) and district lines are drawn along
+    cut edges. Build it once per state, then call show_plan for each plan.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD, with
+        polygons
+        -boundaries (tuple): shared precinct boundaries, from load_boundaries
+        -dcol, rcol (str): names of the Democratic and Republican vote columns
+        -dpi (int): resolution of the figure
+    '''
+    def __init__(self, df, boundaries, dcol="G20PREDBID", rcol="G20PRERTRU", dpi=300):
+        geoseries = state_geometry(df)
+        geoms = geoseries.to_numpy()
+        self.dem = df[dcol].to_numpy(dtype=np.float64)
+        self.rep = df[rcol].to_numpy(dtype=np.float64)
+
+        coords, offsets, self.line_src, self.line_dst = boundaries
+        self.lines = np.split(coords, offsets[1:-1])
+
+        #district label positions are area-weighted means of precinct centroids,
+        #which is where the centroid of the dissolved district would be
+        self.area = shapely.area(geoms)
+        centers = shapely.get_coordinates(shapely.centroid(geoms))
+        self.center_x, self.center_y = centers[:, 0], centers[:, 1]
+
+        #drawn off-screen with Agg, so it never opens a window and can be
+        #read back as pixels (see BatchMapRenderer)
+        self.fig = Figure(dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.subplots()
+        paths, self.part_row = precinct_paths(geoms)
+        self.fills = PatchCollection([PathPatch(path) for path in paths], linewidths=0,
+                                     cmap='seismic_r', norm=Normalize(vmin=-.6, vmax=.6))
+        self.ax.add_collection(self.fills)
+        self.outlines = LineCollection([], colors="gray", linewidths=0.15)
+        self.ax.add_collection(self.outlines)
+        self.labels = []
+
+        self.ax.autoscale_view()
+        if geoseries.crs is not None and geoseries.crs.is_geographic:
+            #same aspect correction geopandas uses for latitude/longitude
+            self.ax.set_aspect(1 / np.cos(np.radians(self.center_y.mean())))
+        else:
+            self.ax.set_aspect('equal')
+
+    def show_plan(self, assignment):
+        '''
+        Redraws the figure for a plan: recolors the precincts, swaps in the
+        plan's cut edges, and relabels the districts with their point_swing.
+
+        Inputs:
+            -assignment (NumPy int array): dist_id of each precinct by row
+            position (0 = unassigned, left blank)
+
+        Returns: None
+        '''
+        bins = int(assignment.max()) + 1
+        dem = np.bincount(assignment, weights=self.dem, minlength=bins)
+        rep = np.bincount(assignment, weights=self.rep, minlength=bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            margin = (dem - rep) / (dem + rep)
+        margin[0] = np.nan
+        self.fills.set_array(margin[assignment[self.part_row]])
+
+        cut = assignment[self.line_src] != assignment[self.line_dst]
+        self.outlines.set_segments([self.lines[k] for k in np.flatnonzero(cut)])
+
+        for label in self.labels:
+            label.remove()
+        area = np.bincount(assignment, weights=self.area, minlength=bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x = np.bincount(assignment, weights=self.area * self.center_x, minlength=bins) / area
+            y = np.bincount(assignment, weights=self.area * self.center_y, minlength=bins) / area
+        self.labels = [self.ax.annotate(text=round(margin[id] * 100, 2), xy=(x[id], y[id]),
+                                        horizontalalignment='center', fontsize=4)
+                       for id in range(1, bins) if area[id] > 0]
+
+    def save(self, filepath):
+        '''
+        Saves the figure as it currently stands.
+        '''
+        self.fig.savefig(filepath)
+
+    def pixels(self):
+        '''
+        Draws the figure as it currently stands.
+
+        Returns (NumPy uint8 array): RGBA image, (height, width, 4)
+        '''
+        self.fig.canvas.draw()
+        return np.array(self.fig.canvas.buffer_rgba())
+
+
+def plot_cut_edge_map(df, state_postal, partition=None, dcol="G20PREDBID",
+                      rcol="G20PRERTRU"):
+    '''
+    Plots a map of districts the way plot_dissolved_map does, but straight
+    from the precinct-level data, without dissolving polygons. Much faster
+    for large states, especially after the first map of a state (the shared
+    precinct boundaries are cached to file).
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD, with
+        polygons and neighbors
+        -state_postal (str of length 2)
+        -partition (Partition): if given, the district assignment to plot,
+        in place of df's own dist_id column
+        -dcol, rcol (str): names of the Democratic and Republican vote columns
+
+    Returns (str): filepath the map was saved to
+    '''
+    assignment = partition.assignment if partition is not None else df_assignment(df)
+    canvas = CutEdgeMap(df, load_boundaries(df, state_postal), dcol, rcol)
+    canvas.show_plan(assignment)
+
+    timestamp = datetime.now().strftime("%m%d-%H%M%S")
+    filepath = f'redistricting_redux/maps/{state_postal}_map_' + timestamp
+    canvas.save(filepath)
+
+    return filepath
+
+
+class BatchMapRenderer:
+    '''
+    Writes maps of many plans of one state. The figure and its precinct
+    shapes are set up once; each plan only recolors it (see CutEdgeMap),
+    draws it to pixels, and hands the pixels to a background thread to be
+    encoded and written as a PNG. Use as a context manager, or call close()
+    when done so every file is finished.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD, with
+        polygons and neighbors
+        -state_postal (str of length 2): used to cache the shared precinct
+        boundaries (see load_boundaries). None skips the cache.
+        -dpi (int): resolution of the maps. The default is lower than
+        plot_dissolved_map's 300, since these are for flipping through.
+        -workers (int): number of background threads writing files
+        -dcol, rcol (str): names of the Democratic and Republican vote columns
+    '''
+    def __init__(self, df, state_postal=None, dpi=150, workers=2, dcol="G20PREDBID",
+                 rcol="G20PRERTRU"):
+        self.canvas = CutEdgeMap(df, load_boundaries(df, state_postal), dcol, rcol, dpi)
+        self.pool = ThreadPoolExecutor(workers)
+        #cap on images waiting to be written, so a fast renderer can't pile
+        #up unwritten images in memory
+        self.max_pending = 2 * workers
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def render(self, assignment, filepath, title=None):
+        '''
+        Draws one plan and queues it to be written.
+
+        Inputs:
+            -assignment (NumPy int array): dist_id of each precinct by row
+            position
+            -filepath (str): where to write the PNG
+            -title (str): title to put over the map, if any
+
+        Returns (str): filepath
+        '''
+        self.canvas.show_plan(assignment)
+        self.canvas.ax.set_title(title or '')
+        image = self.canvas.pixels()
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(imsave, filepath, image))
+        return filepath
+
+    def close(self):
+        '''
+        Waits for every queued map to be written.
+        '''
+        while self.pending:
+            self.pending.popleft().result()
+        self.pool.shutdown()
+
+
+def step_renderer(df):
+    '''
+    Sets up the BatchMapRenderer for the plot_each_step option of the
+    balancing functions, caching shared boundaries under the state load_state
+    recorded in df.attrs.
+
+    Inputs:
+        -df (geopandas GeoDataFrame or pandas DataFrame): state data by
+        precinct/VTD, as from load_state (polygons are read with
+        state_geometry if it was loaded with geometry=False)
+
+    Returns (BatchMapRenderer). Raises a TypeError for anything that isn't a
+    DataFrame (e.g. a Partition, which has no polygons to draw).
+    '''
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError(f"plot_each_step needs the state's DataFrame (as from load_state), not a {type(df).__name__}")
+    return BatchMapRenderer(df, df.attrs.get('state_postal'))
+
+
+def render_gallery(df, plans, directory, state_postal=None, dpi=150, workers=2):
+    '''
+    Writes a map of every plan in an ensemble (or any other sequence of
+    plans) to a directory, one PNG per plan.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): state data by precinct/VTD, with
+        polygons and neighbors
+        -plans (iterable of tuples): plan_index and assignment of each plan,
+        e.g. from ensemble_io.iter_plans (anything after the assignment is
+        ignored)
+        -directory (str): where to write the maps (created if needed)
+        -state_postal, dpi, workers: as in BatchMapRenderer
+
+    Returns (list of str): filepaths of the maps
+    '''
+    os.makedirs(directory, exist_ok=True)
+    prefix = f"{state_postal}_" if state_postal is not None else ''
+    filepaths = []
+    with BatchMapRenderer(df, state_postal, dpi, workers) as renderer:
+        for plan_index, assignment, *_ in plans:
+            filepath = os.path.join(directory, f"{prefix}plan_{plan_index:05d}.png")
+            filepaths.append(renderer.render(np.asarray(assignment), filepath,
+                                             title=f"Plan {plan_index}"))
+    return filepaths
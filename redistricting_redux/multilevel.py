@@ -0,0 +1,290 @@
+'''
+Multilevel drawing of a balanced starting map, in the style of METIS, for
+large states where dart throwing plus pop swapping is slow to balance.
+
+1. Coarsen: precincts are paired up with a neighbor by heavy-edge matching
+   (the neighbor they share the most edges with, preferring the less
+   populous one, and never making a merged vertex too populous), and each
+   pair becomes one vertex of a smaller graph. This repeats until the graph
+   is a few dozen vertices per district.
+2. Partition the coarsest graph into num_districts contiguous, roughly
+   balanced parts with recom.recursive_tree_partition.
+3. Uncoarsen: the plan is projected back one level at a time, and at each
+   level refined along district borders: first balanced with
+   priority_swap.balance_boundary, then cut edges are trimmed with moves
+   that don't push the deviation past what it was. If the finished map is
+   still out of balance, fm_refine.fm_balance gets a last try at it.
+
+Every level is a Partition whose "precincts" are merged groups of real
+precincts, so the same balancing and contiguity code works at every level,
+and every district stays contiguous throughout.
+'''
+import random
+import numpy as np
+from scipy import sparse
+from partition import Partition, as_partition, sync_partition
+from contiguity import would_disconnect
+from priority_swap import balance_boundary, boundary_moves
+from recom import recursive_tree_partition
+from fm_refine import fm_balance
+from instrument import get_instrument, timed
+
+
+def heavy_edge_matching(part, edge_weight, max_pop, rng):
+    '''
+    Pairs up neighboring vertices for coarsening. Vertices are visited in
+    random order; each unmatched vertex is matched with the unmatched
+    neighbor it has the heaviest edge to (ties going to the less populous
+    neighbor), unless their combined population would be over max_pop.
+
+    Inputs:
+        -part (Partition): graph of the current level
+        -edge_weight (NumPy int array): weight of each edge, lined up with
+        part.indices
+        -max_pop (int): largest population a merged vertex may have
+        -rng (numpy Generator): random number generator
+
+    Returns (tuple): coarse vertex of each vertex (NumPy int array) and the
+    number of coarse vertices
+    '''
+    n = len(part)
+    match = np.full(n, -1)
+    for vertex in rng.permutation(n).tolist():
+        if match[vertex] >= 0:
+            continue
+        start, end = part.indptr[vertex], part.indptr[vertex + 1]
+        nabes = part.indices[start:end]
+        eligible = (match[nabes] < 0) & (part.pop[nabes] + part.pop[vertex] <= max_pop)
+        if not eligible.any():
+            match[vertex] = vertex
+            continue
+        nabes, weights = nabes[eligible], edge_weight[start:end][eligible]
+        best = np.lexsort((part.pop[nabes], -weights))[0]
+        match[vertex] = nabes[best]
+        match[nabes[best]] = vertex
+
+    #number the pairs (and unmatched vertices) in order of their lower vertex
+    leader = np.minimum(np.arange(n), match)
+    _, coarse_of = np.unique(leader, return_inverse=True)
+    return coarse_of, int(coarse_of.max()) + 1
+
+
+def coarsen(part, edge_weight, coarse_of, num_coarse):
+    '''
+    Builds the coarse graph of a matching: coarse vertices add up the
+    population and votes of their members, and coarse edge weights add up
+    the weights of the edges between their members.
+
+    Inputs:
+        -part (Partition): graph of the current level
+        -edge_weight (NumPy int array): weight of each edge, lined up with
+        part.indices
+        -coarse_of (NumPy int array): coarse vertex of each vertex, from
+        heavy_edge_matching
+        -num_coarse (int): number of coarse vertices
+
+    Returns (tuple): the coarse graph (Partition, with nothing assigned) and
+    its edge weights
+    '''
+    n = len(part)
+    members = sparse.csr_matrix((np.ones(n, dtype=np.int64), (np.arange(n), coarse_of)),
+                                shape=(n, num_coarse))
+    weights = sparse.csr_matrix((edge_weight, part.indices, part.indptr), shape=(n, n))
+    coarse = (members.T @ weights @ members).tocsr()
+    coarse.setdiag(0)
+    coarse.eliminate_zeros()
+    coarse.sort_indices()
+
+    coarse_part = Partition(coarse.indptr.astype(np.int32), coarse.indices.astype(np.int32),
+                            np.bincount(coarse_of, weights=part.pop, minlength=num_coarse),
+                            part.num_districts,
+                            dem=np.bincount(coarse_of, weights=part.dem, minlength=num_coarse),
+                            rep=np.bincount(coarse_of, weights=part.rep, minlength=num_coarse))
+    return coarse_part, coarse.data.astype(np.int64)
+
+
+def cut_gains(part, edge_weight, precincts, to_dists):
+    '''
+    How much moving each precinct to another district would cut the total
+    weight of cut edges.
+
+    Inputs:
+        -part (Partition): map with every precinct assigned
+        -edge_weight (NumPy int array): weight of each edge, lined up with
+        part.indices
+        -precincts, to_dists (NumPy int arrays): the moves, as from
+        priority_swap.boundary_moves
+
+    Returns (NumPy int array): weight of edges into the new district minus
+    weight of edges into the precinct's own district, for each move
+    '''
+    bins = part.num_districts + 1
+    src, dst = part.edges()
+    to_side = part.assignment[dst]
+    keys = src.astype(np.int64) * bins + to_side
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    key_weight = np.bincount(inverse, weights=edge_weight)
+
+    def weight_to(vertices, dists):
+        wanted = vertices.astype(np.int64) * bins + dists
+        found = np.minimum(np.searchsorted(unique_keys, wanted), len(unique_keys) - 1)
+        return np.where(unique_keys[found] == wanted, key_weight[found], 0)
+
+    return (weight_to(precincts, to_dists)
+            - weight_to(precincts, part.assignment[precincts])).astype(np.int64)
+
+
+def move_cut_gain(part, edge_weight, precinct, to_dist):
+    '''
+    cut_gains for a single move, looking only at the precinct's own edges.
+
+    Returns (int)
+    '''
+    start, end = part.indptr[precinct], part.indptr[precinct + 1]
+    nabe_dists = part.assignment[part.indices[start:end]]
+    weights = edge_weight[start:end]
+    return int(weights[nabe_dists == to_dist].sum()
+               - weights[nabe_dists == part.assignment[precinct]].sum())
+
+
+def refine_cut(part, edge_weight, allowed_deviation):
+    '''
+    Trims cut edges with boundary moves that cut more edge weight than they
+    add, taken best first, as long as the population deviation stays within
+    allowed_deviation (or within what it already is, if that is larger) and
+    the donor district stays contiguous. Repeats until a pass makes no moves.
+
+    Inputs:
+        -part (Partition): map with every precinct assigned
+        -edge_weight (NumPy int array): weight of each edge, lined up with
+        part.indices
+        -allowed_deviation (int): Largest allowable difference between the
+        population of the most populous district and the population of the
+        least populous district.
+
+    Returns (int): number of precincts moved
+    '''
+    moved = 0
+    while True:
+        limit = max(allowed_deviation, part.population_deviation())
+        precincts, to_dists = boundary_moves(part)
+        gains = cut_gains(part, edge_weight, precincts, to_dists)
+        order = np.argsort(-gains, kind='stable')
+        order = order[gains[order] > 0]
+        moved_this_pass = 0
+        for precinct, to_dist in zip(precincts[order].tolist(), to_dists[order].tolist()):
+            from_dist = part.assignment[precinct]
+            if from_dist == to_dist:
+                continue
+            #gains go stale as neighbors move, so check again
+            if move_cut_gain(part, edge_weight, precinct, to_dist) <= 0:
+                continue
+            pops = part.dist_pop[1:].copy()
+            pops[from_dist - 1] -= part.pop[precinct]
+            pops[to_dist - 1] += part.pop[precinct]
+            if pops.max() - pops.min() > limit or would_disconnect(part, precinct):
+                continue
+            part.assign(precinct, to_dist)
+            moved_this_pass += 1
+        moved += moved_this_pass
+        if moved_this_pass == 0:
+            return moved
+
+
+def balance_and_refine(part, edge_weight, allowed_deviation, stop_after=20):
+    '''
+    Refinement for one level: balance_boundary until balanced (or stuck),
+    then refine_cut.
+
+    Returns (int): number of precincts moved
+    '''
+    moved = 0
+    for _ in range(stop_after):
+        if part.population_deviation() <= allowed_deviation:
+            break
+        moved_now = balance_boundary(part, allowed_deviation)
+        moved += moved_now
+        if moved_now == 0:
+            break
+    return moved + refine_cut(part, edge_weight, allowed_deviation)
+
+
+@timed
+def draw_multilevel_map(df, num_districts, allowed_deviation=70000, seed=2023,
+                        coarsest_per_district=20, max_vertex_share=0.1):
+    '''
+    Draws a contiguous map whose district populations are within
+    allowed_deviation, by coarsening the precinct graph, partitioning the
+    coarsest graph, and refining the plan as it is projected back down (see
+    module docstring).
+
+    Inputs:
+        -df (geopandas GeoDataFrame or Partition): state data by precinct/VTD
+        -num_districts (int): Number of districts to draw
+        -allowed_deviation (int): Largest allowable difference between the
+        population of the most populous district and the population of the
+        least populous district.
+        -seed (int or random.Random): Seed for random number generation, for
+        replicability, or a generator to draw from
+        -coarsest_per_district (int): coarsening stops at about this many
+        vertices per district
+        -max_vertex_share (float): largest share of a district's target
+        population one coarse vertex may hold
+
+    Returns: None, modifies df in-place. Raises a ValueError if the refined
+    map still isn't within allowed_deviation.
+    '''
+    inst = get_instrument()
+    rng = seed if isinstance(seed, random.Random) else random.Random(seed)
+    np_rng = np.random.default_rng(rng.getrandbits(64))
+    part = as_partition(df, num_districts)
+    target = part.target_pop
+
+    #coarsen
+    levels = [(part, np.ones(len(part.indices), dtype=np.int64), None)]
+    while len(levels[-1][0]) > coarsest_per_district * num_districts:
+        fine, edge_weight, _ = levels[-1]
+        coarse_of, num_coarse = heavy_edge_matching(fine, edge_weight,
+                                                    max_vertex_share * target, np_rng)
+        if num_coarse > 0.95 * len(fine):
+            break
+        coarse, coarse_weight = coarsen(fine, edge_weight, coarse_of, num_coarse)
+        levels.append((coarse, coarse_weight, coarse_of))
+        inst.count('coarsen_levels')
+        inst.event('coarsen', f"Coarsened {len(fine)} vertices to {num_coarse}",
+                   vertices=num_coarse)
+
+    #partition the coarsest graph, loosening the tolerance if coarse vertices
+    #are too lumpy to split within it
+    coarsest, coarsest_weight, _ = levels[-1]
+    tolerance = max(allowed_deviation, int(2 * coarsest.pop.max()))
+    while True:
+        try:
+            recursive_tree_partition(coarsest, num_districts, tolerance, seed=rng)
+            break
+        except ValueError:
+            if tolerance >= target:
+                raise
+            tolerance *= 2
+    inst.event('coarse_plan', f"Split {len(coarsest)} coarse vertices into {num_districts} districts",
+               deviation=coarsest.population_deviation())
+
+    #uncoarsen, refining at every level
+    for level in range(len(levels) - 1, 0, -1):
+        coarse = levels[level][0]
+        balance_and_refine(coarse, levels[level][1], allowed_deviation)
+        fine, _, _ = levels[level - 1]
+        fine.assignment[:] = coarse.assignment[levels[level][2]]
+        fine.recount()
+    moved = balance_and_refine(part, levels[0][1], allowed_deviation)
+    if part.population_deviation() > allowed_deviation:
+        moved += fm_balance(part, allowed_deviation)
+    inst.count('precincts_moved', moved)
+
+    deviation = part.population_deviation()
+    inst.record('deviation', deviation)
+    inst.event('multilevel_done', f"Multilevel map drawn. The most and least populous district differ by: {deviation}",
+               deviation=deviation)
+    sync_partition(df, part)
+    if deviation > allowed_deviation:
+        raise ValueError(f"Couldn't balance the map within allowed_deviation={allowed_deviation} (got {deviation})")
@@ -0,0 +1,279 @@
+'''
+Array-backed district assignments for map drawing.
+
+A Partition keeps the district assignment of every precinct/VTD in an int
+array, along with running population and vote totals for each district, so
+that moving a precinct between districts is O(1) rather than a .loc write
+into the GeoDataFrame followed by a full-frame population_sum.
+District numbering matches the 'dist_id' column: districts are 1 through
+num_districts, and 0 means the precinct hasn't been drawn into a district
+yet (None in 'dist_id').
+'''
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from adjacency import neighbors_to_csr
+
+
+class Partition:
+    '''
+    District assignment of every precinct in a state, plus per-district
+    totals that are kept up to date as precincts move.
+
+    Attributes:
+        -assignment (NumPy int32 array): dist_id of each precinct, by row
+        position (0 = not yet assigned)
+        -num_districts (int)
+        -indptr, indices (NumPy int32 arrays): CSR adjacency of precincts
+        -pop, dem, rep (NumPy arrays): population and Democratic/Republican
+        votes of each precinct
+        -geoids (NumPy array of str): GEOID20 of each precinct
+        -dist_pop, dist_dem, dist_rep (NumPy arrays): totals for each
+        district, indexed by dist_id (index 0 holds unassigned precincts)
+        -dist_size (NumPy int array): number of precincts in each district,
+        indexed by dist_id
+    '''
+    def __init__(self, indptr, indices, pop, num_districts, dem=None, rep=None,
+                 assignment=None, geoids=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.pop = np.asarray(pop, dtype=np.int64)
+        n = len(self.pop)
+        self.dem = np.zeros(n) if dem is None else np.asarray(dem, dtype=np.float64)
+        self.rep = np.zeros(n) if rep is None else np.asarray(rep, dtype=np.float64)
+        self.geoids = geoids
+        self.num_districts = num_districts
+        if assignment is None:
+            assignment = np.zeros(n, dtype=np.int32)
+        self.assignment = np.asarray(assignment, dtype=np.int32)
+        self.recount()
+
+    @classmethod
+    def from_df(cls, df, num_districts=None, popcol="POP100", dcol="G20PREDBID",
+                rcol="G20PRERTRU"):
+        '''
+        Builds a Partition out of a state GeoDataFrame, using whatever
+        dist_ids it already has.
+
+        Inputs:
+            -df (geopandas GeoDataFrame): state data by precinct/VTD, with
+            neighbors instantiated (see load_state_data.load_state)
+            -num_districts (int): number of districts. If None, uses the
+            largest dist_id in the df
+            -popcol, dcol, rcol (str): names of the population, Democratic
+            vote and Republican vote columns
+
+        Returns (Partition)
+        '''
+        if 'neighbor_idx' in df.columns:
+            nabe_arrays = df['neighbor_idx'].to_numpy()
+            indptr = np.zeros(len(df) + 1, dtype=np.int32)
+            np.cumsum([len(nabes) for nabes in nabe_arrays], out=indptr[1:])
+            indices = (np.concatenate(nabe_arrays).astype(np.int32) if len(df) > 0
+                       else np.zeros(0, dtype=np.int32))
+        else:
+            indptr, indices = neighbors_to_csr(df['GEOID20'], df['neighbors'])
+
+        if 'dist_id' in df.columns:
+            dist_ids = df['dist_id'].to_numpy()
+            assignment = np.where(pd.isna(dist_ids), 0, dist_ids).astype(np.int32)
+        else:
+            assignment = None
+        if num_districts is None:
+            num_districts = int(assignment.max()) if assignment is not None else 0
+
+        return cls(indptr, indices, df[popcol].to_numpy(), num_districts,
+                   dem=df[dcol].to_numpy() if dcol in df.columns else None,
+                   rep=df[rcol].to_numpy() if rcol in df.columns else None,
+                   assignment=assignment, geoids=df['GEOID20'].to_numpy())
+
+    def __len__(self):
+        return len(self.assignment)
+
+    def recount(self):
+        '''
+        Recomputes every district total from scratch. Only needed after
+        writing to self.assignment directly instead of through assign().
+        '''
+        bins = self.num_districts + 1
+        self.dist_pop = np.bincount(self.assignment, weights=self.pop, minlength=bins).astype(np.int64)
+        self.dist_dem = np.bincount(self.assignment, weights=self.dem, minlength=bins)
+        self.dist_rep = np.bincount(self.assignment, weights=self.rep, minlength=bins)
+        self.dist_size = np.bincount(self.assignment, minlength=bins)
+
+    def copy(self):
+        '''
+        Copies the assignment and district totals. The adjacency and
+        precinct data are shared, since they never change.
+        '''
+        return Partition(self.indptr, self.indices, self.pop, self.num_districts,
+                         dem=self.dem, rep=self.rep, assignment=self.assignment.copy(),
+                         geoids=self.geoids)
+
+    def clear(self):
+        '''
+        Clears off every district assignment.
+        '''
+        self.assignment[:] = 0
+        self.recount()
+
+    def assign(self, precinct, id):
+        '''
+        Draws a precinct into a district, updating district totals in O(1).
+
+        Inputs:
+            -precinct (int): row position of the precinct
+            -id (int): dist_id of the district to draw it into
+
+        Returns: None, modifies partition in-place
+        '''
+        old = self.assignment[precinct]
+        if old == id:
+            return
+        self.assignment[precinct] = id
+        self.dist_pop[old] -= self.pop[precinct]
+        self.dist_pop[id] += self.pop[precinct]
+        self.dist_dem[old] -= self.dem[precinct]
+        self.dist_dem[id] += self.dem[precinct]
+        self.dist_rep[old] -= self.rep[precinct]
+        self.dist_rep[id] += self.rep[precinct]
+        self.dist_size[old] -= 1
+        self.dist_size[id] += 1
+
+    def assign_many(self, precincts, ids):
+        '''
+        Draws several precincts into districts at once, updating district
+        totals with one bincount per total instead of one assign() each.
+
+        Inputs:
+            -precincts (NumPy int array): row positions of the precincts, no
+            precinct listed twice
+            -ids (NumPy int array): dist_id to draw each precinct into
+
+        Returns: None, modifies partition in-place
+        '''
+        bins = self.num_districts + 1
+        old = self.assignment[precincts]
+        for totals, values in ((self.dist_pop, self.pop), (self.dist_dem, self.dem),
+                               (self.dist_rep, self.rep)):
+            moved = values[precincts]
+            totals -= np.bincount(old, weights=moved, minlength=bins).astype(totals.dtype)
+            totals += np.bincount(ids, weights=moved, minlength=bins).astype(totals.dtype)
+        self.dist_size -= np.bincount(old, minlength=bins)
+        self.dist_size += np.bincount(ids, minlength=bins)
+        self.assignment[precincts] = ids
+
+    def neighbors(self, precinct):
+        '''
+        Returns (NumPy int32 array): row positions of a precinct's neighbors
+        '''
+        return self.indices[self.indptr[precinct]:self.indptr[precinct + 1]]
+
+    def edges(self):
+        '''
+        Every (precinct, neighbor) pair in the adjacency, as two arrays
+        aligned with self.indices. Computed once and cached.
+
+        Returns (tuple of NumPy int arrays): src, dst row positions
+        '''
+        if getattr(self, '_edge_src', None) is None:
+            self._edge_src = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int32),
+                                       np.diff(self.indptr))
+        return self._edge_src, self.indices
+
+    def adjacency_matrix(self):
+        '''
+        The adjacency as an n x n scipy.sparse CSR matrix of ones, sharing
+        indptr and indices with the partition. Built once and cached.
+
+        Returns (scipy.sparse.csr_matrix)
+        '''
+        if getattr(self, '_adjacency_matrix', None) is None:
+            n = len(self.indptr) - 1
+            self._adjacency_matrix = sparse.csr_matrix(
+                (np.ones(len(self.indices), dtype=np.int32), self.indices, self.indptr),
+                shape=(n, n))
+        return self._adjacency_matrix
+
+    def members(self, id):
+        '''
+        Returns (NumPy int array): row positions of the precincts in a district
+        '''
+        return np.flatnonzero(self.assignment == id)
+
+    @property
+    def target_pop(self):
+        '''
+        Population every district would have in a perfectly balanced map.
+        '''
+        return int(self.pop.sum()) // self.num_districts
+
+    def district_pops(self):
+        '''
+        Returns (dict): dictionary with dist_ids as keys and population totals
+        as values
+        '''
+        return {id: int(self.dist_pop[id]) for id in range(1, self.num_districts + 1)}
+
+    def population_deviation(self):
+        '''
+        Returns (int): difference in population between the most and least
+        populous districts
+        '''
+        dist_pops = self.dist_pop[1:]
+        return int(dist_pops.max() - dist_pops.min())
+
+    def dist_ids(self):
+        '''
+        Converts the assignment to the format of the 'dist_id' column.
+
+        Returns (NumPy object array): dist_id of each precinct, with None for
+        unassigned precincts
+        '''
+        dist_ids = self.assignment.astype(object)
+        dist_ids[self.assignment == 0] = None
+        return dist_ids
+
+    def write_to_df(self, df):
+        '''
+        Writes the assignment into the 'dist_id' column of a state
+        GeoDataFrame (e.g. before dissolving or plotting).
+
+        Inputs:
+            -df (geopandas GeoDataFrame): the state data this partition was
+            built from
+
+        Returns: None, modifies df in-place
+        '''
+        df['dist_id'] = self.dist_ids()
+
+
+def as_partition(df, num_districts=None):
+    '''
+    Lets map-drawing functions accept either a GeoDataFrame or a Partition.
+    A Partition is returned as-is; a GeoDataFrame is converted.
+
+    Inputs:
+        -df (geopandas GeoDataFrame or Partition)
+        -num_districts (int): number of districts, if converting
+
+    Returns (Partition)
+    '''
+    if isinstance(df, Partition):
+        return df
+    return Partition.from_df(df, num_districts)
+
+
+def sync_partition(df, part):
+    '''
+    Counterpart to as_partition: if the caller passed a GeoDataFrame, write
+    the Partition's assignment back into its 'dist_id' column.
+
+    Inputs:
+        -df (geopandas GeoDataFrame or Partition): what the caller passed in
+        -part (Partition): what as_partition returned
+
+    Returns: None, modifies df in-place
+    '''
+    if df is not part:
+        part.write_to_df(df)
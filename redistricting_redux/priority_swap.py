@@ -0,0 +1,183 @@
+'''
+Population balancing that only ever looks at precincts on district borders.
+
+priority_pop_swap is a faster alternative to repeated_pop_swap. Instead of
+checking every precinct in the state each cycle, it keeps every possible
+boundary move (a border precinct switching to a neighboring district) in a
+priority queue, keyed by how much the move improves population balance, and
+makes the best move until districts are within the allowed deviation.
+'''
+import heapq
+import numpy as np
+from datetime import datetime
+from partition import as_partition, sync_partition
+from contiguity import would_disconnect
+from draw_random_maps import population_deviation
+from map_plot import step_renderer
+from instrument import get_instrument, timed
+
+
+def move_gain(pop, from_pop, to_pop):
+    '''
+    How much moving a precinct between two districts reduces the sum of
+    squared deviations of district populations from the target. Positive
+    exactly when the donor district outweighs the acceptor by more than the
+    precinct's population.
+
+    Inputs:
+        -pop (int): population of the precinct
+        -from_pop (int): population of the district it's in now
+        -to_pop (int): population of the district it would move to
+
+    Returns (int): the improvement (negative means the move makes it worse)
+    '''
+    return 2 * pop * (from_pop - to_pop - pop)
+
+
+def boundary_moves(part, districts=None):
+    '''
+    Finds every move of a border precinct into a neighboring district.
+
+    Inputs:
+        -part (Partition): map with every precinct assigned
+        -districts (collection of ints): if given, only moves out of or into
+        these districts
+
+    Returns (tuple of NumPy int arrays): precincts and the districts they
+    could move to, with no duplicate pairs
+    '''
+    src, dst = part.edges()
+    from_dists = part.assignment[src]
+    to_dists = part.assignment[dst]
+    is_move = from_dists != to_dists
+    if districts is not None:
+        districts = np.fromiter(districts, dtype=np.int32)
+        is_move &= np.isin(from_dists, districts) | np.isin(to_dists, districts)
+    keys = np.unique(src[is_move].astype(np.int64) * (part.num_districts + 1) + to_dists[is_move])
+    return keys // (part.num_districts + 1), keys % (part.num_districts + 1)
+
+
+def balance_boundary(part, allowed_deviation=70000):
+    '''
+    Makes the best available boundary move, over and over, until districts
+    are within allowed_deviation or no move improves balance. Moves are kept
+    in a heap; after a move, only moves touching the two districts involved
+    are re-scored and pushed, and older heap entries for them are recognized
+    as stale by a per-district version counter and skipped. Finding those
+    moves is still one NumPy pass over the whole edge list (boundary_moves),
+    so each move costs O(edges) in NumPy plus the re-scored moves in Python
+    (fm_refine.fm_pass keeps its moves up to date locally instead). Moves
+    that would split the donor district are skipped too, so every district
+    stays contiguous.
+
+    Inputs:
+        -part (Partition): map with every precinct assigned
+        -allowed_deviation (int): Largest allowable difference between the 
+        population of the most populous district and the population of the 
+        least populous district.
+
+    Returns (int): number of precincts moved
+    '''
+    version = [0] * (part.num_districts + 1)
+    heap = []
+
+    def push_moves(districts=None):
+        precincts, to_dists = boundary_moves(part, districts)
+        from_dists = part.assignment[precincts]
+        gains = move_gain(part.pop[precincts], part.dist_pop[from_dists], part.dist_pop[to_dists])
+        improving = gains > 0
+        for gain, precinct, from_dist, to_dist in zip(gains[improving].tolist(), 
+                                                      precincts[improving].tolist(),
+                                                      from_dists[improving].tolist(), 
+                                                      to_dists[improving].tolist()):
+            heapq.heappush(heap, (-gain, precinct, from_dist, to_dist,
+                                  version[from_dist], version[to_dist]))
+
+    push_moves()
+    moved = 0
+    stale = 0
+    disconnecting = 0
+    balanced = part.population_deviation() <= allowed_deviation
+    while heap and not balanced:
+        _, precinct, from_dist, to_dist, from_version, to_version = heapq.heappop(heap)
+        if (part.assignment[precinct] != from_dist or version[from_dist] != from_version
+            or version[to_dist] != to_version):
+            stale += 1
+            continue
+        if would_disconnect(part, precinct):
+            disconnecting += 1
+            continue
+        part.assign(precinct, to_dist)
+        version[from_dist] += 1
+        version[to_dist] += 1
+        moved += 1
+        balanced = part.population_deviation() <= allowed_deviation
+        push_moves((from_dist, to_dist))
+
+    inst = get_instrument()
+    inst.count('precincts_moved', moved)
+    inst.count('stale_moves_skipped', stale)
+    inst.count('moves_skipped_contiguity', disconnecting)
+    return moved
+
+
+@timed
+def priority_pop_swap(df, allowed_deviation=70000, plot_each_step=False, stop_after=20):
+    '''
+    Balances district populations by moving border precincts, always making
+    the move that improves balance the most, until populations of districts
+    are within allowable deviation range. Takes the same inputs as 
+    repeated_pop_swap, but finishes in seconds rather than minutes.
+
+    Each cycle runs balance_boundary; cycles repeat until balanced, until a
+    cycle makes no moves, or until stop_after cycles. Moves that would break
+    a district's contiguity are never made, so no orphan cleanup is needed.
+
+    Inputs:
+        -df (geopandas GeoDataFrame or Partition): state-level precinct/VTD 
+        data. Should have dist_ids assigned to every precinct.
+        -allowed_deviation (int): Largest allowable difference between the 
+        population of the most populous district and the population of the 
+        least populous district.
+        -plot_each_step (boolean): if True, exports a map after each cycle
+        (see map_plot.step_renderer). Requires df to be the state DataFrame
+        from load_state, not a Partition.
+        -stop_after (int): manual number of cycles to stop after if procedure
+        hasn't yet terminated.
+
+    Returns: None, modifies df in place
+    '''
+    inst = get_instrument()
+    part = as_partition(df)
+    count = 0
+    renderer = None
+    if plot_each_step:
+        renderer = step_renderer(df)
+        plot_prefix = 'redistricting_redux/maps/test_' + datetime.now().strftime("%m%d-%H%M%S")
+    try:
+        while population_deviation(part) > allowed_deviation:
+            count += 1
+            if count > stop_after:
+                inst.event('stop', f"You've now done {count-1} balancing cycles. Stopping",
+                           reason='stop_after')
+                break
+            inst.event('balance_cycle', f"Now doing balancing cycle #{count}...", cycle=count)
+            inst.count('balance_cycles')
+            moved = balance_boundary(part, allowed_deviation)
+            if plot_each_step:
+                renderer.render(part.assignment, f"{plot_prefix}_cycle_{count:02d}.png",
+                                title=f"After balancing cycle #{count}")
+            deviation = population_deviation(part)
+            inst.record('deviation', deviation)
+            inst.event('deviation', f"Moved {moved} precincts. The most and least populous district differ by: {deviation}",
+                       cycle=count, moved=moved, deviation=deviation)
+            if moved == 0:
+                inst.event('stop', "No remaining move improves population balance. Stopping",
+                           reason='no_improving_move')
+                break
+    finally:
+        if renderer is not None:
+            renderer.close()
+    sync_partition(df, part)
+    if population_deviation(part) <= allowed_deviation:
+        inst.event('balanced', "You've reached your population balance target. Hooray!")
@@ -0,0 +1,307 @@
+'''
+ReCom ("recombination") Markov chain for drawing many population-balanced
+maps of a state.
+
+Each step picks two neighboring districts, merges them, draws a random
+spanning tree of the merged precincts, and cuts one tree edge that splits the
+tree into two pieces of (nearly) equal population. Both pieces are
+connected by construction, so a balanced, contiguous plan stays balanced and
+contiguous after every step.
+
+Method from DeFord, Duchin and Solomon, "Recombination: A family of Markov
+chains for redistricting" (2019).
+'''
+import random
+import numpy as np
+from collections import deque
+from partition import as_partition, sync_partition
+from checkpoint import save_checkpoint, load_checkpoint
+from instrument import get_instrument, timed
+
+
+def random_spanning_tree(part, nodes, rng):
+    '''
+    Draws a random spanning tree of the precincts in a region, by running
+    Kruskal's algorithm with the region's edges in random order.
+
+    Inputs:
+        -part (Partition): supplies the adjacency
+        -nodes (NumPy int array): row positions of the precincts in the region
+        -rng (random.Random): random number generator
+
+    Returns (dict or None): tree adjacency, mapping each precinct to a list of
+    its tree neighbors. None if the region isn't connected.
+    '''
+    in_region = np.zeros(len(part), dtype=bool)
+    in_region[nodes] = True
+    src, dst = part.edges()
+    is_edge = in_region[src] & in_region[dst] & (src < dst)
+    edges = list(zip(src[is_edge].tolist(), dst[is_edge].tolist()))
+    rng.shuffle(edges)
+
+    #union-find
+    root_of = {node: node for node in nodes.tolist()}
+    def find(node):
+        while root_of[node] != node:
+            root_of[node] = root_of[root_of[node]]
+            node = root_of[node]
+        return node
+
+    tree = {node: [] for node in root_of}
+    tree_edges = 0
+    for u, v in edges:
+        root_u, root_v = find(u), find(v)
+        if root_u != root_v:
+            root_of[root_u] = root_v
+            tree[u].append(v)
+            tree[v].append(u)
+            tree_edges += 1
+            if tree_edges == len(nodes) - 1:
+                break
+
+    if tree_edges < len(nodes) - 1:
+        return None
+    return tree
+
+
+def balanced_cuts(tree, pop, target, tolerance, rest_districts=1):
+    '''
+    Finds every tree edge whose removal splits off a subtree that could be a
+    district on its own, leaving a remainder that could be split into
+    rest_districts more districts.
+
+    Inputs:
+        -tree (dict): tree adjacency from random_spanning_tree
+        -pop (NumPy int array): population of every precinct in the state
+        -target (int): ideal district population
+        -tolerance (float): largest allowed difference between a district's
+        population and the target
+        -rest_districts (int): number of districts the remainder will make
+
+    Returns (list of lists of ints): for each balanced cut, the row positions
+    of the precincts in the subtree it splits off
+    '''
+    root = next(iter(tree))
+    parent = {root: None}
+    order = [root]
+    queue = deque([root])
+    while queue:
+        node = queue.popleft()
+        for nabe in tree[node]:
+            if nabe not in parent:
+                parent[nabe] = node
+                order.append(nabe)
+                queue.append(nabe)
+
+    subtree_pop = {node: int(pop[node]) for node in order}
+    for node in reversed(order[1:]):
+        subtree_pop[parent[node]] += subtree_pop[node]
+    total = subtree_pop[root]
+
+    cut_roots = []
+    for node in order[1:]:
+        district_pop = subtree_pop[node]
+        rest_pop = total - district_pop
+        if (abs(district_pop - target) <= tolerance and
+            abs(rest_pop - rest_districts * target) <= rest_districts * tolerance):
+            cut_roots.append(node)
+
+    cuts = []
+    for cut_root in cut_roots:
+        subtree = [cut_root]
+        stack = [cut_root]
+        while stack:
+            node = stack.pop()
+            for nabe in tree[node]:
+                if nabe != parent[node]:
+                    subtree.append(nabe)
+                    stack.append(nabe)
+        cuts.append(subtree)
+    return cuts
+
+
+def bipartition_tree(part, nodes, target, tolerance, rng, rest_districts=1, max_attempts=100):
+    '''
+    Splits a region into a district near the target population and a
+    remainder, by drawing spanning trees until one has a balanced cut.
+
+    Inputs:
+        -part (Partition): supplies adjacency and populations
+        -nodes (NumPy int array): row positions of the precincts in the region
+        -target (int): ideal district population
+        -tolerance (float): largest allowed difference between a district's
+        population and the target
+        -rng (random.Random): random number generator
+        -rest_districts (int): number of districts the remainder will make
+        -max_attempts (int): number of spanning trees to try
+
+    Returns (list of ints or None): row positions of the precincts in the
+    new district, or None if no balanced cut was found
+    '''
+    inst = get_instrument()
+    for _ in range(max_attempts):
+        tree = random_spanning_tree(part, nodes, rng)
+        inst.count('spanning_trees')
+        if tree is None:
+            return None
+        cuts = balanced_cuts(tree, part.pop, target, tolerance, rest_districts)
+        if cuts:
+            return rng.choice(cuts)
+    return None
+
+
+def recursive_tree_partition(df, num_districts, allowed_deviation=70000, seed=2023,
+                             max_attempts=1000):
+    '''
+    Draws a population-balanced, contiguous starting map by splitting off
+    one district at a time with bipartition_tree. Unlike
+    draw_dart_throw_map, the result needs no balancing afterwards, so it can
+    be used as the first plan of a ReCom chain.
+
+    Inputs:
+        -df (geopandas GeoDataFrame or Partition): state data by precinct/VTD
+        -num_districts (int): Number of districts to draw
+        -allowed_deviation (int): Largest allowable difference between the
+        population of the most populous district and the population of the
+        least populous district.
+        -seed (int or random.Random): seed for random number generation, or
+        a generator to draw from
+        -max_attempts (int): number of spanning trees to try per district
+
+    Returns: None, modifies df in-place. Raises a ValueError if a district
+    can't be split off.
+    '''
+    rng = seed if isinstance(seed, random.Random) else random.Random(seed)
+    part = as_partition(df, num_districts)
+    part.clear()
+    target = part.target_pop
+    tolerance = allowed_deviation / 2
+
+    for id in range(1, num_districts):
+        remaining = part.members(0)
+        district = bipartition_tree(part, remaining, target, tolerance, rng,
+                                    rest_districts=num_districts - id,
+                                    max_attempts=max_attempts)
+        if district is None:
+            raise ValueError(f"Couldn't split off district {id} within allowed_deviation={allowed_deviation}")
+        for precinct in district:
+            part.assign(precinct, id)
+    for precinct in part.members(0):
+        part.assign(precinct, num_districts)
+
+    sync_partition(df, part)
+
+
+def recom_step(part, rng, allowed_deviation=70000, max_attempts=100):
+    '''
+    One step of the ReCom chain: merges two random neighboring districts and
+    splits them again along a balanced cut of a random spanning tree.
+
+    Inputs:
+        -part (Partition): map with every precinct assigned
+        -rng (random.Random): random number generator
+        -allowed_deviation (int): Largest allowable difference between the
+        population of the most populous district and the population of the
+        least populous district.
+        -max_attempts (int): number of spanning trees to try
+
+    Returns (boolean): True if the districts were redrawn; False if no
+    balanced cut was found, or if no two districts border each other (e.g.
+    a single-district state), so there is nothing to merge (the map is left
+    as it was)
+    '''
+    src, dst = part.edges()
+    cut_edges = np.flatnonzero(part.assignment[src] != part.assignment[dst])
+    if len(cut_edges) == 0:
+        return False
+    edge = cut_edges[rng.randrange(len(cut_edges))]
+    dist_a, dist_b = int(part.assignment[src[edge]]), int(part.assignment[dst[edge]])
+
+    nodes = np.flatnonzero((part.assignment == dist_a) | (part.assignment == dist_b))
+    district = bipartition_tree(part, nodes, part.target_pop, allowed_deviation / 2,
+                                rng, max_attempts=max_attempts)
+    if district is None:
+        return False
+    for precinct in nodes:
+        part.assign(precinct, dist_b)
+    for precinct in district:
+        part.assign(precinct, dist_a)
+    return True
+
+
+def recom_chain(part, steps, allowed_deviation=70000, seed=2023):
+    '''
+    Runs the ReCom chain from a starting map, yielding the map after each
+    step. The same Partition is modified and yielded every time, so call
+    .copy() on it to keep a plan.
+
+    Inputs:
+        -part (Partition): population-balanced, contiguous starting map (e.g.
+        from recursive_tree_partition)
+        -steps (int): number of steps to run
+        -allowed_deviation (int): Largest allowable difference between the
+        population of the most populous district and the population of the
+        least populous district.
+        -seed (int or random.Random): seed for random number generation, or
+        a generator to draw from
+
+    Yields (Partition): the map after each step
+    '''
+    rng = seed if isinstance(seed, random.Random) else random.Random(seed)
+    inst = get_instrument()
+    for _ in range(steps):
+        if recom_step(part, rng, allowed_deviation):
+            inst.count('recom_steps')
+        else:
+            inst.count('recom_steps_rejected')
+        yield part
+
+
+@timed
+def draw_recom_map(df, num_districts, steps=100, allowed_deviation=70000, seed=2023,
+                   checkpoint_path=None, resume=False, checkpoint_every=10):
+    '''
+    Draws a random population-balanced, contiguous map: a starting map from
+    recursive_tree_partition followed by a run of ReCom steps. Drop-in
+    alternative to draw_dart_throw_map followed by repeated_pop_swap; the
+    result can go straight to dissolve_map.
+
+    Inputs:
+        -df (geopandas GeoDataFrame or Partition): state data by precinct/VTD
+        -num_districts (int): Number of districts to draw
+        -steps (int): number of ReCom steps to run after the starting map
+        -allowed_deviation (int): Largest allowable difference between the
+        population of the most populous district and the population of the
+        least populous district.
+        -seed (int or random.Random): seed for random number generation, or
+        a generator to draw from
+        -checkpoint_path (str): if given, saves a checkpoint (see 
+        checkpoint.py), including the random number generator's state, to
+        this file every checkpoint_every steps
+        -resume (boolean): if True, picks up from the checkpoint at 
+        checkpoint_path. The finished map is the same as an uninterrupted
+        run's.
+        -checkpoint_every (int): steps between checkpoints
+
+    Returns: None, modifies df in-place
+    '''
+    rng = seed if isinstance(seed, random.Random) else random.Random(seed)
+    part = as_partition(df, num_districts)
+    if resume:
+        saved = load_checkpoint(checkpoint_path)
+        part.assignment[:] = saved['assignment']
+        part.recount()
+        rng.setstate(saved['rng_state'])
+        done = saved['counters']['step']
+    else:
+        recursive_tree_partition(part, num_districts, allowed_deviation, rng)
+        done = 0
+    job = {'function': 'draw_recom_map', 'num_districts': num_districts, 'steps': steps,
+           'allowed_deviation': allowed_deviation}
+
+    for step, _ in enumerate(recom_chain(part, steps - done, allowed_deviation, rng),
+                             start=done + 1):
+        if checkpoint_path is not None and step % checkpoint_every == 0:
+            save_checkpoint(checkpoint_path, part.assignment, job,
+                            counters={'step': step}, rng=rng)
+    sync_partition(df, part)
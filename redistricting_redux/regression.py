@@ -189,20 +189,24 @@ def create_linear_model(ntrials):
 
     return model
 
-def predict_state_voteshare(state, ntrials):
+def predict_state_voteshare(state, ntrials, gdf=None):
     """
     Predicts the expected partisan balance of a state based on our model.
     Inputs:
         state (str): the two-letter abbreviation of the state
         ntrials (int): the number of datapoints to generate - a larger number
             will result in a more accurate estimate at the expense of runtime
+        gdf (GeoDataFrame): the state's data with neighbors, if it has
+            already been loaded - otherwise it is loaded here
     Returns:
         Nothing - prints the expected partisan balance
     """
     model = create_linear_model(ntrials)
 
     print("applying model to state")
-    gdf = load_state_data.load_state(state)
+    if gdf is None:
+        gdf = load_state_data.load_state(state, geometry=False,
+                                         columns=["G20PREDBID", "G20PRERTRU"])
     neighbors_dict = load_state_data.make_neighbors_dict(gdf)
 
     var = gdf["dem_voteshare"].var()
@@ -0,0 +1,268 @@
+'''
+State bundle cache: a one-time columnar snapshot of each state's merged
+shapefile and adjacency, so that loading a state doesn't mean parsing the
+shapefile every time.
+
+The cache for a state lives in redistricting_redux/cache/{state}/ and holds:
+    columns/{name}.npy    every attribute column, one NumPy array each
+                          (numbers as numbers, text as fixed-width str)
+    indptr.npy,           CSR adjacency, as in adjacency.py
+    indices.npy
+    geometry.npy,         every precinct's geometry as WKB, all in one byte
+    geometry_offsets.npy  array; precinct i is bytes offsets[i]:offsets[i+1]
+    manifest.json         column order and dtypes, the CRS, and the size,
+                          modification time and SHA-256 hash of every source
+                          file the cache was made from
+The cache is out of date as soon as any source file's hash changes. Since
+.npy files can be memory-mapped, code that only needs numbers (populations,
+votes, adjacency) can open them in milliseconds without touching geometry.
+'''
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+
+CACHE_DIR = 'redistricting_redux/cache'
+SHP_DIR = 'redistricting_redux/merged_shps'
+CACHE_VERSION = 1
+
+
+def cache_path(state_postal):
+    '''
+    Returns (str): the cache directory of a state
+    '''
+    return os.path.join(CACHE_DIR, state_postal)
+
+
+def source_files(state_postal):
+    '''
+    Lists the files a state's cache is made from: the parts of its merged
+    shapefile and its binary adjacency file, whichever of them exist.
+
+    Inputs:
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+
+    Returns (list of str): filepaths
+    '''
+    names = [f"{state_postal}_VTD_merged{ext}" for ext in ('.shp', '.shx', '.dbf', '.prj', '.cpg')]
+    names.append(f"{state_postal}_2020_adjacency.npz")
+    paths = [os.path.join(SHP_DIR, name) for name in names]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def file_hash(filepath, chunk_size=1 << 20):
+    '''
+    Returns (str): hex SHA-256 hash of a file's contents
+    '''
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(filepath, known=None):
+    '''
+    Describes a source file for the manifest. The hash is only recomputed if
+    the file's size or modification time differ from an earlier fingerprint.
+
+    Inputs:
+        -filepath (str): the file
+        -known (dict): earlier fingerprint of the same file, if any
+
+    Returns (dict): 'size', 'mtime_ns' and 'sha256'
+    '''
+    stat = os.stat(filepath)
+    if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+        return dict(known)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash(filepath)}
+
+
+def read_manifest(state_postal):
+    '''
+    Returns (dict): the manifest of a state's cache, or None if there is no
+    cache
+    '''
+    manifest_fp = os.path.join(cache_path(state_postal), 'manifest.json')
+    if not os.path.exists(manifest_fp):
+        return None
+    with open(manifest_fp) as f:
+        return json.load(f)
+
+
+def cache_is_current(state_postal):
+    '''
+    Checks whether a state's cache exists and was made from the source files
+    as they are now (same set of files, same hashes).
+
+    Inputs:
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+
+    Returns (boolean)
+    '''
+    manifest = read_manifest(state_postal)
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return False
+    sources = manifest['sources']
+    current = source_files(state_postal)
+    if sorted(os.path.basename(path) for path in current) != sorted(sources):
+        return False
+    for path in current:
+        known = sources[os.path.basename(path)]
+        if fingerprint(path, known)['sha256'] != known['sha256']:
+            return False
+    return True
+
+
+def write_state_cache(df, state_postal, indptr, indices):
+    '''
+    Writes (or rewrites) the cache of a state. The new cache is put together
+    in a temporary directory and swapped in at the end, so an interrupted
+    write never leaves a half-finished cache behind.
+
+    Inputs:
+        -df (geopandas GeoDataFrame): the state's merged shapefile, as read
+        by gpd.read_file (no neighbors or dist_id columns)
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+        -indptr, indices (NumPy int arrays): CSR adjacency of the rows of df
+
+    Returns: None, writes files
+    '''
+    final_dir = cache_path(state_postal)
+    tmp_dir = final_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_dir, 'columns'))
+
+    columns = []
+    for name in df.columns:
+        if name == df.geometry.name:
+            continue
+        values = df[name]
+        entry = {'name': name, 'dtype': str(values.dtype)}
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            array = values.to_numpy()
+        else:
+            nulls = values.isna().to_numpy()
+            array = values.fillna('').astype(str).to_numpy(dtype=str)
+            if nulls.any():
+                np.save(os.path.join(tmp_dir, 'columns', f"{name}.nulls.npy"), nulls)
+                entry['nulls'] = True
+        np.save(os.path.join(tmp_dir, 'columns', f"{name}.npy"), array)
+        columns.append(entry)
+
+    np.save(os.path.join(tmp_dir, 'indptr.npy'), np.asarray(indptr, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, 'indices.npy'), np.asarray(indices, dtype=np.int32))
+
+    wkb = shapely.to_wkb(df.geometry.values)
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    np.cumsum([len(blob) for blob in wkb], out=offsets[1:])
+    np.save(os.path.join(tmp_dir, 'geometry.npy'), np.frombuffer(b''.join(wkb), dtype=np.uint8))
+    np.save(os.path.join(tmp_dir, 'geometry_offsets.npy'), offsets)
+
+    old = read_manifest(state_postal) or {'sources': {}}
+    manifest = {'version': CACHE_VERSION, 'rows': len(df), 'columns': columns,
+                'geometry_name': df.geometry.name,
+                'crs': df.crs.to_wkt() if df.crs is not None else None,
+                'sources': {os.path.basename(path):
+                            fingerprint(path, old['sources'].get(os.path.basename(path)))
+                            for path in source_files(state_postal)}}
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+
+
+def read_cached_columns(state_postal, columns=None, mmap_mode='r'):
+    '''
+    Opens attribute columns from a state's cache.
+
+    Inputs:
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+        -columns (list of str): which columns. Defaults to all of them, in
+        shapefile order
+        -mmap_mode (str): passed to np.load. 'r' memory-maps the arrays
+        read-only; None reads them into memory
+
+    Returns (dict): column name -> NumPy array (text columns with missing
+    values come back as object arrays with None in them)
+    '''
+    manifest = read_manifest(state_postal)
+    entries = {entry['name']: entry for entry in manifest['columns']}
+    if columns is None:
+        columns = list(entries)
+    column_dir = os.path.join(cache_path(state_postal), 'columns')
+
+    arrays = {}
+    for name in columns:
+        array = np.load(os.path.join(column_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+        if entries[name].get('nulls'):
+            array = array.astype(object)
+            array[np.load(os.path.join(column_dir, f"{name}.nulls.npy"))] = None
+        arrays[name] = array
+    return arrays
+
+
+def read_cached_adjacency(state_postal, mmap_mode='r'):
+    '''
+    Opens the CSR adjacency from a state's cache.
+
+    Returns (tuple of NumPy int32 arrays): indptr, indices
+    '''
+    directory = cache_path(state_postal)
+    return (np.load(os.path.join(directory, 'indptr.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, 'indices.npy'), mmap_mode=mmap_mode))
+
+
+def read_cached_geometry(state_postal, index=None):
+    '''
+    Reads the precinct geometries from a state's cache.
+
+    Inputs:
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+        -index (pandas Index): index to give the GeoSeries. Defaults to a
+        RangeIndex, as from gpd.read_file
+
+    Returns (geopandas GeoSeries): geometries in row order, with the
+    shapefile's CRS
+    '''
+    manifest = read_manifest(state_postal)
+    directory = cache_path(state_postal)
+    buffer = np.load(os.path.join(directory, 'geometry.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(directory, 'geometry_offsets.npy'))
+    wkb = [buffer[start:end].tobytes() for start, end in zip(offsets[:-1], offsets[1:])]
+    return gpd.GeoSeries(shapely.from_wkb(wkb), index=index, crs=manifest['crs'],
+                         name=manifest['geometry_name'])
+
+
+def read_cached_frame(state_postal, columns=None, geometry=True):
+    '''
+    Rebuilds a state's merged shapefile from its cache, with the same
+    columns, dtypes and CRS gpd.read_file gives.
+
+    Inputs:
+        -state_postal (2-character string): postal code for a state supported
+        by the program, e.g. "GA" for Georgia
+        -columns (list of str): which attribute columns. Defaults to all
+        -geometry (boolean): if False, skips reading the polygons
+
+    Returns (geopandas GeoDataFrame, or pandas DataFrame if geometry is False)
+    '''
+    manifest = read_manifest(state_postal)
+    dtypes = {entry['name']: entry['dtype'] for entry in manifest['columns']}
+    arrays = read_cached_columns(state_postal, columns, mmap_mode=None)
+    df = pd.DataFrame({name: pd.Series(array).astype(dtypes[name])
+                       for name, array in arrays.items()})
+    if not geometry:
+        return df
+    return gpd.GeoDataFrame(df, geometry=read_cached_geometry(state_postal, df.index),
+                            crs=manifest['crs'])